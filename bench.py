@@ -0,0 +1,1698 @@
+"""Benchmarks for the device-assistant server.
+
+Usage:
+    python bench.py dispatch [--shell-clients 4] [--duration 5] [--json results.json]
+    python bench.py matcher [--iterations 2000]
+    python bench.py classifier [--iterations 2000]   (local intent classifier: accuracy on held-out phrasings, load and classify latency)
+    python bench.py prompt [--live 5]   (token report; --live also measures time to first byte against the API)
+    python bench.py loadtest [--clients 10] [--duration 5] [--snapshot] [--json results.json]
+    python bench.py telemetry [--clients 10] [--interval-ms 50] [--duration 5]
+    python bench.py fleet [--agents 200] [--real-agents 2] [--duration 5]
+    python bench.py setters [--duration 5]   (backend writes for a slider drag, with and without the setter queue, and through the websocket)
+    python bench.py coldstart [--restarts 5]   (time from process start to the first get_memory_usage reply)
+    python bench.py history [--history-days 3]   (metric history: recording cost, size on disk, range-query latency)
+    python bench.py workers [--workers 1,2,4] [--client-procs 8] [--duration 5]   (connections/s and messages/s per worker count)
+    python bench.py admission [--clients 10] [--duration 5]   (connection cap, rate limits, LLM concurrency cap and slow consumers, limits on vs off)
+    python bench.py gateway [--iterations 200] [--llm-latency 0.3]   (LLM gateway: hedging, retries, deadline and circuit breaker against a fake OpenAI server)
+    python bench.py streaming [--iterations 10] [--llm-latency 0.3]   (time to progress frame, first action and reply, LLM answer streamed vs buffered)
+    python bench.py batch [--llm-latency 0.3]   (scene completion: sequential vs batch, one LLM call per action vs one per scene)
+    python bench.py stub-server --port 8765   (the server with fake devices and a fake LLM, for manual testing)
+    python bench.py fake-openai --port 8081 [--error-rate 0.1]   (an OpenAI-compatible HTTP server for OPENAI_BASE_URL, for manual testing)
+
+Each benchmark prints a summary table and can write its raw results as JSON so runs can be compared.
+Benchmarks that need a server start main.py with stubbed device backends and a fake OpenAI client,
+so they run on any plain Linux box without audio, radios, a battery or an API key.
+"""
+import argparse
+import asyncio
+import collections
+import contextlib
+import http
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+import types
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers (0 when empty)."""
+    if not samples: return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples_ms):
+    """Latency summary in milliseconds."""
+    return {
+        "count": len(samples_ms),
+        "p50_ms": round(percentile(samples_ms, 50), 3),
+        "p95_ms": round(percentile(samples_ms, 95), 3),
+        "p99_ms": round(percentile(samples_ms, 99), 3),
+        "max_ms": round(max(samples_ms), 3) if samples_ms else 0.0,
+    }
+
+
+def import_main(**env):
+    """Imports main.py with the given environment overrides applied first."""
+    os.environ.update(env)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    logging.getLogger().setLevel(logging.ERROR) # Keep per-request logging out of the measurements
+    return main
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"{'case':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in rows.items():
+        print(f"{name:<32}{stats['count']:>8}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}")
+
+
+# --- dispatch: get_memory_usage latency while shell commands run on other connections ---
+async def _probe_latency(call, duration, interval=0.01):
+    """Issues a call every `interval` seconds; latency runs from the scheduled send time so loop stalls count."""
+    samples = []
+    start = time.perf_counter()
+    scheduled = start
+    while scheduled < start + duration:
+        await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+        await call()
+        finished = time.perf_counter()
+        samples.append((finished - scheduled) * 1000)
+        scheduled = max(scheduled + interval, finished)
+    return samples
+
+
+async def _shell_load(call, stop):
+    while not stop.is_set():
+        await call()
+        await asyncio.sleep(0)
+
+
+async def _dispatch_case(main, shell_clients, duration, use_dispatcher):
+    def inline(intent, parameters):
+        # The pre-dispatcher behaviour: sync handlers called directly on the event loop
+        async def run():
+            return main.INTENT_HANDLERS[intent](**parameters)
+        return run()
+    dispatch = main.dispatch_intent if use_dispatcher else inline
+    stop = asyncio.Event()
+    shell_command = {"command": "sleep 0.5"}
+    load = [asyncio.create_task(_shell_load(lambda: dispatch("run_shell_command", shell_command), stop)) for _ in range(shell_clients)]
+    samples = await _probe_latency(lambda: dispatch("get_memory_usage", {}), duration)
+    stop.set()
+    await asyncio.gather(*load)
+    return samples
+
+
+async def bench_dispatch(args):
+    main = import_main(ALLOW_SHELL_EXECUTION="true")
+    results = {}
+    results["dispatcher, idle"] = summarize(await _dispatch_case(main, 0, args.duration, True))
+    results[f"dispatcher, {args.shell_clients} shell clients"] = summarize(await _dispatch_case(main, args.shell_clients, args.duration, True))
+    results[f"inline, {args.shell_clients} shell clients"] = summarize(await _dispatch_case(main, args.shell_clients, args.duration, False))
+    print_table("get_memory_usage latency", results)
+    return results
+
+
+# --- matcher: fast-path hit rate and per-match cost over a corpus of phrasings ---
+# (command, expected intent, expected parameters); None marks commands that should go to the LLM
+MATCHER_CORPUS = [
+    ("get cpu usage", "get_cpu_usage", {}),
+    ("get memory usage", "get_memory_usage", {}),
+    ("get_volume", "get_volume", {}),
+    ("get_battery_status", "get_battery_status", {}),
+    ("get wifi status", "get_wifi_status", {}),
+    ("get bluetooth status", "get_bluetooth_status", {}),
+    ("what's the wifi status", "get_wifi_status", {}),
+    ("is wifi on?", "get_wifi_status", {}),
+    ("is bluetooth enabled", "get_bluetooth_status", {}),
+    ("set volume to 40", "set_volume", {"level": 40}),
+    ("Set the volume to 75%", "set_volume", {"level": 75}),
+    ("volume 20", "set_volume", {"level": 20}),
+    ("turn the sound down to 10 percent", "set_volume", {"level": 10}),
+    ("60% volume", "set_volume", {"level": 60}),
+    ("mute", "set_volume", {"level": 0}),
+    ("please mute the speakers", "set_volume", {"level": 0}),
+    ("what is the volume", "get_volume", {}),
+    ("how loud is the sound right now", "get_volume", {}),
+    ("set brightness to 70", "set_brightness", {"level": 70}),
+    ("brightness 30%", "set_brightness", {"level": 30}),
+    ("dim the screen to 25", "set_brightness", {"level": 25}),
+    ("set display brightness to 100", "set_brightness", {"level": 100}),
+    ("max brightness", "set_brightness", {"level": 100}),
+    ("turn wifi off", "toggle_wifi", {"state": "off"}),
+    ("turn on the wifi", "toggle_wifi", {"state": "on"}),
+    ("disable wi-fi", "toggle_wifi", {"state": "off"}),
+    ("enable wifi", "toggle_wifi", {"state": "on"}),
+    ("wifi on", "toggle_wifi", {"state": "on"}),
+    ("turn bluetooth on", "toggle_bluetooth", {"state": "on"}),
+    ("switch off bluetooth", "toggle_bluetooth", {"state": "off"}),
+    ("disable bluetooth", "toggle_bluetooth", {"state": "off"}),
+    ("what's my battery", "get_battery_status", {}),
+    ("is it charging", "get_battery_status", {}),
+    ("battery level", "get_battery_status", {}),
+    ("how much power level is left", "get_battery_status", {}),
+    ("cpu usage", "get_cpu_usage", {}),
+    ("what's the cpu load", "get_cpu_usage", {}),
+    ("show processor utilization", "get_cpu_usage", {}),
+    ("cpu usage over the last 5 seconds", "get_cpu_usage", {"window": 5.0}),
+    ("show cpu per core", "get_cpu_per_core", {}),
+    ("cpu usage of each core", "get_cpu_per_core", {}),
+    ("cpu averages", "get_cpu_averages", {}),
+    ("how much ram is used", "get_memory_usage", {}),
+    ("memory usage", "get_memory_usage", {}),
+    ("how much memory is free", "get_memory_usage", {}),
+    ("open firefox", None, None),
+    ("install htop", None, None),
+    ("list files in my home directory", None, None),
+    ("make it louder", None, None),
+    ("turn it off again", None, None),
+    # Relative changes and numbers that are not levels look like setters but must be left to the LLM
+    ("increase volume by 10", None, None),
+    ("turn brightness down by 20", None, None),
+    ("lock screen after 5 minutes", None, None),
+    ("set volume to 1000", None, None),
+]
+
+
+async def bench_matcher(args):
+    main = import_main()
+    threshold = main.FAST_MATCH_THRESHOLD
+    hits = correct = false_hits = 0
+    misses = []
+    for command, intent, parameters in MATCHER_CORPUS:
+        interpretation, confidence = main.intent_matcher.match(command)
+        matched = interpretation is not None and confidence >= threshold
+        if intent is None:
+            if matched: false_hits += 1; misses.append((command, interpretation))
+            continue
+        if matched:
+            hits += 1
+            if interpretation == {"intent": intent, "parameters": parameters}: correct += 1
+            else: misses.append((command, interpretation))
+        else:
+            misses.append((command, None))
+    iterations = max(1, args.iterations)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for command, _, _ in MATCHER_CORPUS:
+            main.intent_matcher.match(command)
+    per_match_us = (time.perf_counter() - start) / (iterations * len(MATCHER_CORPUS)) * 1e6
+    routine = sum(1 for _, intent, _ in MATCHER_CORPUS if intent is not None)
+    results = {
+        "corpus_size": len(MATCHER_CORPUS),
+        "routine_commands": routine,
+        "hit_rate": round(hits / routine, 4),
+        "accuracy_of_hits": round(correct / hits, 4) if hits else 0.0,
+        "false_hits_on_llm_commands": false_hits,
+        "per_match_us": round(per_match_us, 3),
+        "threshold": threshold,
+        "mismatches": [{"command": c, "got": i} for c, i in misses],
+    }
+    print(f"\nfast-path matcher over {len(MATCHER_CORPUS)} phrasings (threshold {threshold})")
+    print(f"hit rate {results['hit_rate']:.1%}, accuracy of hits {results['accuracy_of_hits']:.1%}, "
+          f"false hits {false_hits}, {per_match_us:.2f} us/match")
+    for c, i in misses: print(f"  mismatch: {c!r} -> {i}")
+    return results
+
+
+# --- classifier: offline evaluation of the local intent classifier ---
+CLASSIFIER_EVAL = [
+    # Held out from intent_corpus.json; most are phrasings the fast-path matcher does not resolve
+    ("could you dim the screen to 30 percent", "set_brightness", {"level": 30}),
+    ("make the display a bit darker, like 20", "set_brightness", {"level": 20}),
+    ("backlight 55", "set_brightness", {"level": 55}),
+    ("crank the brightness all the way", "set_brightness", {"level": 100}),
+    ("brighter screen please, 90", "set_brightness", {"level": 90}),
+    ("set screen brightnes to 65", "set_brightness", {"level": 65}),
+    ("lower the speakers to 25", "set_volume", {"level": 25}),
+    ("audio 40 percent", "set_volume", {"level": 40}),
+    ("turn the sound down to 5", "set_volume", {"level": 5}),
+    ("mute the speakers", "set_volume", {"level": 0}),
+    ("silence audio", "set_volume", {"level": 0}),
+    ("volum to 70", "set_volume", {"level": 70}),
+    ("how loud is the sound right now", "get_volume", {}),
+    ("what level is the audio at", "get_volume", {}),
+    ("is the audio muted", "get_volume", {}),
+    ("switch the wireless off", "toggle_wifi", {"state": "off"}),
+    ("please enable the wlan", "toggle_wifi", {"state": "on"}),
+    ("wi-fi back on", "toggle_wifi", {"state": "on"}),
+    ("shut down the wifi radio", "toggle_wifi", {"state": "off"}),
+    ("disable bluetooth radio", "toggle_bluetooth", {"state": "off"}),
+    ("turn on the bt", "toggle_bluetooth", {"state": "on"}),
+    ("bluetooth, switch it on", None, None), # "it": left to the LLM
+    ("am i on wireless right now", "get_wifi_status", {}),
+    ("check if the wifi is enabled", "get_wifi_status", {}),
+    ("is bluetooth active", "get_bluetooth_status", {}),
+    ("check the bt state", "get_bluetooth_status", {}),
+    ("how much juice is left", "get_battery_status", {}),
+    ("battery percent please", "get_battery_status", {}),
+    ("am i running on battery", "get_battery_status", {}),
+    ("how loaded is the cpu right now", "get_cpu_usage", {}),
+    ("processor load over the last 3 seconds", "get_cpu_usage", {"window": 3.0}),
+    ("cpu utilization", "get_cpu_usage", {}),
+    ("load of each cpu core", "get_cpu_per_core", {}),
+    ("per-core cpu load", "get_cpu_per_core", {}),
+    ("show me the load averages", "get_cpu_averages", {}),
+    ("how much memory is in use", "get_memory_usage", {}),
+    ("ram free", "get_memory_usage", {}),
+    ("give me a system overview", "get_system_snapshot", {}),
+    ("how is my machine doing overall", "get_system_snapshot", {}),
+    ("cpu history for the last 2 hours", "get_metric_history", {"window": 7200, "metrics": ["cpu"]}),
+    ("memory over the past day", "get_metric_history", {"window": 86400, "metrics": ["memory"]}),
+    ("battery trend today", "get_metric_history", {"window": 86400, "metrics": ["battery"]}),
+    # Commands that must be left to the LLM
+    ("open the file manager", None, None),
+    ("install vlc", None, None),
+    ("what's the capital of france", None, None),
+    ("make it a bit quieter", None, None),
+    ("turn that off", None, None),
+    ("restart bluetooth service and reconnect my headphones", None, None),
+    ("how big is my home folder", None, None),
+    ("play the next song", None, None),
+    ("set an alarm for 7", None, None),
+    ("brightness up a little", None, None),
+    ("toggle wifi", None, None),
+    ("turn brightness down by 20", None, None),
+    ("volume up 10", None, None),
+    ("is the brightness 40", None, None), # Questions never become writes
+    ("wifi on?", None, None),
+]
+CLASSIFIER_ITERATIONS = 2000
+
+
+def _evaluate_interpreter(interpret, cases):
+    """Routine commands resolved, exactly right and wrongly claimed LLM-only ones, for an interpret(command) function."""
+    resolved = correct = false_claims = 0
+    misses = []
+    for command, intent, parameters in cases:
+        interpretation = interpret(command)
+        if intent is None:
+            if interpretation: false_claims += 1; misses.append((command, interpretation))
+        elif interpretation:
+            resolved += 1
+            if interpretation == {"intent": intent, "parameters": parameters}: correct += 1
+            else: misses.append((command, interpretation))
+    routine = sum(1 for _, intent, _ in cases if intent is not None)
+    return {"routine_commands": routine, "llm_commands": len(cases) - routine, "resolved_rate": round(resolved / routine, 4),
+            "accuracy_of_resolved": round(correct / resolved, 4) if resolved else 0.0, "false_claims": false_claims,
+            "mismatches": [{"command": c, "got": i} for c, i in misses]}
+
+
+async def bench_classifier(args):
+    main = import_main()
+    start = time.perf_counter()
+    import numpy as np
+    numpy_import_ms = (time.perf_counter() - start) * 1000
+    with open(main.INTENT_CLASSIFIER_CORPUS, encoding="utf-8") as f:
+        corpus = json.load(f)["intents"]
+    start = time.perf_counter()
+    classifier = main.IntentClassifier(np, corpus)
+    train_ms = (time.perf_counter() - start) * 1000
+
+    # Leave-one-out over the training corpus: intent accuracy of a model that never saw the phrasing
+    loo_correct = loo_total = 0
+    for intent, phrasings in corpus.items():
+        for i, phrasing in enumerate(phrasings):
+            held_out = dict(corpus, **{intent: phrasings[:i] + phrasings[i + 1:]})
+            loo_total += 1; loo_correct += main.IntentClassifier(np, held_out).classify(phrasing)[0] == intent
+
+    def local(command):
+        interpretation, confidence = main.intent_matcher.match(command)
+        if interpretation and confidence >= main.FAST_MATCH_THRESHOLD: return interpretation
+        return classifier.interpret(command)[0]
+
+    cases = {
+        "classifier on held-out phrasings": (lambda command: classifier.interpret(command)[0], CLASSIFIER_EVAL),
+        "matcher alone on held-out phrasings": (lambda command: main.intent_matcher.match(command)[0] if main.intent_matcher.match(command)[1] >= main.FAST_MATCH_THRESHOLD else None, CLASSIFIER_EVAL),
+        "matcher + classifier on held-out phrasings": (local, CLASSIFIER_EVAL),
+        "matcher + classifier on the matcher corpus": (local, MATCHER_CORPUS),
+    }
+    evaluations = {name: _evaluate_interpreter(interpret, evaluated) for name, (interpret, evaluated) in cases.items()}
+
+    commands = [command for command, _, _ in CLASSIFIER_EVAL]
+    samples = []
+    for _ in range(max(1, args.iterations // len(commands))):
+        for command in commands:
+            start = time.perf_counter(); classifier.interpret(command); samples.append((time.perf_counter() - start) * 1000)
+
+    results = {"corpus_phrasings": classifier.examples, "intents": len(classifier.intents), "features": len(classifier.vocabulary),
+               "numpy_import_ms": round(numpy_import_ms, 1), "train_ms": round(train_ms, 2),
+               "leave_one_out_accuracy": round(loo_correct / loo_total, 4), "classify": summarize(samples),
+               "min_score": main.CLASSIFIER_MIN_SCORE, "min_margin": main.CLASSIFIER_MIN_MARGIN, "evaluations": evaluations}
+    print(f"\nlocal intent classifier: {classifier.examples} phrasings, {len(classifier.intents)} intents, {len(classifier.vocabulary)} features")
+    print(f"load: numpy import {numpy_import_ms:.1f} ms, training {train_ms:.2f} ms; leave-one-out intent accuracy {loo_correct / loo_total:.1%}")
+    for name, evaluation in evaluations.items():
+        print(f"{name}: resolved {evaluation['resolved_rate']:.1%} of {evaluation['routine_commands']} routine commands, "
+              f"{evaluation['accuracy_of_resolved']:.1%} of those exactly right, {evaluation['false_claims']} of {evaluation['llm_commands']} LLM commands claimed")
+    print_table("classify latency", {"interpret": results["classify"]})
+    for miss in evaluations["matcher + classifier on held-out phrasings"]["mismatches"]: print(f"  mismatch: {miss['command']!r} -> {miss['got']}")
+    return results
+
+
+# --- prompt: input tokens per LLM call, verbatim vs compacted history ---
+def _shell_result(command, stdout="", stderr="", exit_code=0):
+    return json.dumps({"command": command, "command_id": "bench", "success": exit_code == 0, "exit_code": exit_code,
+                       "stdout": stdout, "stderr": stderr, "error_message": None, "truncated_bytes": 0, "cancelled": False})
+
+
+# A session that listed packages, read a log and hit an error before asking a follow-up question
+PROMPT_SESSION = [
+    ("user", "what's my battery"),
+    ("assistant", json.dumps({"percent": 81, "charging": False, "status": "Discharging", "time_left": "2:00:00"})),
+    ("user", "list installed packages"),
+    ("assistant", _shell_result("dpkg -l", "\n".join(f"ii  package-{i:<28} {i}.{i % 7}.{i % 3}-1  amd64  Example package number {i}" for i in range(400)))),
+    ("user", "show me the last boot log"),
+    ("assistant", _shell_result("journalctl -b -n 200", "\n".join(f"Oct 18 12:{i // 60:02d}:{i % 60:02d} host systemd[1]: Started unit-{i}.service - Example unit {i}." for i in range(200)))),
+    ("user", "restart the ssh daemon"),
+    ("assistant", _shell_result("systemctl restart sshd", stderr="Failed to restart sshd.service: Unit sshd.service not found.", exit_code=5)),
+]
+PROMPT_COMMAND = "try that again with the right unit name"
+
+
+def count_tokens(messages):
+    """Tokens in a message list: tiktoken's o200k_base when installed, main.estimate_tokens otherwise."""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("o200k_base")
+        count = lambda text: len(encoding.encode(text))
+    except ImportError:
+        from main import estimate_tokens as count
+    return sum(count(m["content"]) + 4 for m in messages)
+
+
+async def _time_to_first_byte(client, messages, samples):
+    """Streams one live completion and returns the milliseconds until the first chunk."""
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        stream = await client.chat.completions.create(model="o4-mini", messages=messages, response_format={"type": "json_object"}, stream=True)
+        async for _ in stream:
+            latencies.append((time.perf_counter() - start) * 1000)
+            break
+        await stream.close()
+    return latencies
+
+
+async def bench_prompt(args):
+    main = import_main()
+    distro = await main.distro_backend.aget()
+    system_prompt = lambda: main.build_system_prompt.__wrapped__(distro, main.ALLOW_SHELL_EXECUTION, main.is_linux)
+    history = PROMPT_SESSION[-main.HISTORY_MAX_LEN:]
+
+    def verbatim():
+        # The previous behaviour: the prompt f-string rebuilt per call and the raw history appended
+        messages = [{"role": "system", "content": system_prompt()}]
+        messages += [{"role": role, "content": str(content)} for role, content in history]
+        return messages + [{"role": "user", "content": PROMPT_COMMAND}]
+
+    cases = {"verbatim": verbatim, "compacted": lambda: main.build_llm_messages(PROMPT_COMMAND, distro, history)}
+    iterations = max(1, args.iterations)
+    results = {}
+    for name, build in cases.items():
+        messages = build()
+        start = time.perf_counter()
+        for _ in range(iterations): build()
+        results[name] = {
+            "messages": len(messages),
+            "system_tokens": count_tokens(messages[:1]),
+            "history_tokens": count_tokens(messages[1:-1]),
+            "input_tokens": count_tokens(messages),
+            "assembly_us": round((time.perf_counter() - start) / iterations * 1e6, 2),
+        }
+        if args.live:
+            client = await main.get_openai_client()
+            if not client: raise SystemExit("--live needs OPENAI_API_KEY")
+            results[name]["ttfb"] = summarize(await _time_to_first_byte(client, messages, args.live))
+    saved = 1 - results["compacted"]["input_tokens"] / results["verbatim"]["input_tokens"]
+    results["input_tokens_saved"] = round(saved, 4)
+    results["history_token_budget"] = main.LLM_HISTORY_TOKEN_BUDGET
+    print(f"\nLLM input for one follow-up command after {len(history)} history entries (budget {main.LLM_HISTORY_TOKEN_BUDGET} tokens)")
+    print(f"{'case':<12}{'messages':>10}{'system':>10}{'history':>10}{'total':>10}{'build us':>10}")
+    for name in cases:
+        r = results[name]
+        print(f"{name:<12}{r['messages']:>10}{r['system_tokens']:>10}{r['history_tokens']:>10}{r['input_tokens']:>10}{r['assembly_us']:>10.2f}")
+    print(f"input tokens saved: {saved:.1%}")
+    if args.live: print_table("time to first byte (live API)", {name: results[name]["ttfb"] for name in cases})
+    return results
+
+
+# --- Stubbed backends: the server runs its real code paths against fake devices and a fake LLM ---
+class FakePsutil:
+    """Seeded stand-in for the psutil calls main.py makes. CPU load and memory use wander like a real machine's."""
+    CpuTimes = collections.namedtuple("scputimes", "user system idle")
+    Memory = collections.namedtuple("svmem", "total available percent used free")
+    Battery = collections.namedtuple("sbattery", "percent secsleft power_plugged")
+
+    def __init__(self, cores=4, seed=1):
+        self.cores = cores
+        self._rng = random.Random(seed)
+        self._last = time.monotonic()
+        self._times = [[0.0, 0.0, 0.0] for _ in range(cores)] # Cumulative user, system, idle per core
+
+    def cpu_times(self, percpu=False):
+        now = time.monotonic()
+        elapsed, self._last = now - self._last, now
+        for core in self._times:
+            busy = self._rng.uniform(0.05, 0.6)
+            core[0] += elapsed * busy * 0.8; core[1] += elapsed * busy * 0.2; core[2] += elapsed * (1 - busy)
+        per_core = [self.CpuTimes(*core) for core in self._times]
+        return per_core if percpu else self.CpuTimes(*(sum(t[i] for t in per_core) for i in range(3)))
+
+    def cpu_percent(self, interval=None, percpu=False):
+        if interval: time.sleep(interval)
+        return [25.0] * self.cores if percpu else 25.0
+
+    def virtual_memory(self):
+        percent = round(37.5 + self._rng.uniform(-0.5, 0.5), 1)
+        used = int((8 << 30) * percent / 100)
+        return self.Memory(total=8 << 30, available=(8 << 30) - used, percent=percent, used=used, free=(8 << 30) - used)
+
+    def sensors_battery(self):
+        return self.Battery(percent=81.0, secsleft=7200, power_plugged=False)
+
+
+FAKE_COMMAND_OUTPUT = {
+    "nmcli radio wifi": "enabled",
+    "rfkill list bluetooth": "0: hci0: Bluetooth\n\tSoft blocked: no\n\tHard blocked: no",
+    "amixer sget Master": "Simple mixer control 'Master',0\n  Front Left: Playback 65536 [50%] [-10.00dB] [on]",
+}
+
+
+async def fake_run_command(command):
+    await asyncio.sleep(0.002) # Roughly the cost of a fork/exec round trip
+    return FAKE_COMMAND_OUTPUT.get(command, "")
+
+
+def fake_interpretation(command):
+    """The interpretation the fake LLMs return for a command, chosen by keyword."""
+    command = command.lower()
+    if command.startswith("run "): return {"intent": "run_shell_command", "parameters": {"command": command[4:]}}
+    if "battery" in command or "juice" in command: return {"intent": "get_battery_status", "parameters": {}}
+    if "loud" in command: return {"intent": "set_volume", "parameters": {"level": 70}}
+    if "movie mode" in command: return {"intent": "batch", "parameters": {"actions": [
+        {"intent": intent, "parameters": parameters} for intent, parameters, _ in BATCH_SCENE]}}
+    return {"intent": "unknown", "parameters": {"error": "Command not understood or parameters missing."}}
+
+
+def fake_tokens(content):
+    """Splits a completion into roughly token-sized pieces for streaming."""
+    return [content[i:i + 4] for i in range(0, len(content), 4)]
+
+
+class FakeAsyncOpenAI:
+    """Answers chat.completions.create after a fixed delay with an interpretation chosen by keyword."""
+
+    def __init__(self, latency=0.3):
+        self.latency = latency
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, messages, stream=False, **kwargs):
+        await asyncio.sleep(self.latency)
+        content = json.dumps(fake_interpretation(messages[-1]["content"]))
+        usage = types.SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages) // 4, completion_tokens=len(content) // 4)
+        if stream: return self._stream(content, usage)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))], usage=usage)
+
+    @staticmethod
+    async def _stream(content, usage):
+        for piece in fake_tokens(content):
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=piece))], usage=None)
+        yield types.SimpleNamespace(choices=[], usage=usage)
+
+
+class FakeOpenAIServer:
+    """An OpenAI-compatible HTTP server (POST /v1/chat/completions) that injects latency and errors.
+
+    Each request takes `latency` seconds, or `slow_latency` for a `slow_fraction` of them, plus `token_latency`
+    per token of the answer, and fails with `error_status` for an `error_rate` fraction. "stream": true requests
+    get server-sent chunks paced by `token_latency`. The knobs can be changed while it runs. Answers are chosen
+    like FakeAsyncOpenAI's, so the real SDK, its connection pool and the gateway can be measured.
+    """
+
+    def __init__(self, latency=0.3, slow_fraction=0.0, slow_latency=3.0, error_rate=0.0, error_status=500, token_latency=0.0, seed=1):
+        self.latency, self.slow_fraction, self.slow_latency, self.token_latency = latency, slow_fraction, slow_latency, token_latency
+        self.error_rate, self.error_status = error_rate, error_status
+        self.rng = random.Random(seed)
+        self.requests = self.connections = self.errors = 0
+        self.handlers = set() # Connection tasks, stopped by close() even while a hung request sleeps
+        self.server = None
+        self.port = None
+
+    async def start(self, port=0):
+        self.server = await asyncio.start_server(self._serve, "localhost", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        for task in self.handlers: task.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True: # HTTP/1.1 keep-alive: one request after another on the connection
+                request_line = await reader.readline()
+                if not request_line: return
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await self._complete(request_line.split()[1].decode(), body)
+                if isinstance(payload, dict):
+                    data = json.dumps(payload).encode()
+                    writer.write(f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\n"
+                                 f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                    await writer.drain()
+                    continue
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+                async for event in payload:
+                    data = f"data: {event}\n\n".encode()
+                    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    await writer.drain()
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError): pass # Cancelled by close()
+        finally: writer.close(); self.handlers.discard(asyncio.current_task())
+
+    async def _complete(self, path, body):
+        self.requests += 1
+        await asyncio.sleep(self.slow_latency if self.rng.random() < self.slow_fraction else self.latency)
+        if not path.endswith("/chat/completions"): return 404, {"error": {"message": f"Unknown path {path}", "type": "invalid_request_error"}}
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            return self.error_status, {"error": {"message": "Injected failure", "type": "server_error"}}
+        request = json.loads(body)
+        messages = request["messages"]
+        content = json.dumps(fake_interpretation(messages[-1]["content"]))
+        tokens = fake_tokens(content)
+        usage = {"prompt_tokens": sum(len(m["content"]) for m in messages) // 4, "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if request.get("stream"): return 200, self._stream(tokens, usage)
+        await asyncio.sleep(self.token_latency * len(tokens))
+        return 200, {"id": f"chatcmpl-{self.requests}", "object": "chat.completion", "created": int(time.time()), "model": "fake",
+                     "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}], "usage": usage}
+
+    async def _stream(self, tokens, usage):
+        """Server-sent event payloads of a streamed completion, one token per chunk."""
+        chunk = {"id": f"chatcmpl-{self.requests}", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake"}
+        yield json.dumps({**chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        for token in tokens:
+            await asyncio.sleep(self.token_latency)
+            yield json.dumps({**chunk, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+        yield json.dumps({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        yield json.dumps({**chunk, "choices": [], "usage": usage})
+        yield "[DONE]"
+
+
+def install_stubs(main, llm_latency=0.3):
+    """Swaps the device backends and the OpenAI client of an imported main module for fakes."""
+    main.psutil = FakePsutil()
+    main._run_command = fake_run_command
+    main.client = FakeAsyncOpenAI(llm_latency)
+    main.openai_available = True
+    main.device_state.start = lambda: None # No PulseAudio / rfkill / NetworkManager event sources
+
+
+def read_rss_bytes(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+async def _loop_lag_monitor(stats_file, interval=0.1):
+    """Records how late the event loop wakes up and periodically writes the stats to a JSON file."""
+    loop = asyncio.get_running_loop()
+    lags = collections.deque(maxlen=100_000)
+    last_write = loop.time()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append((loop.time() - start - interval) * 1000)
+        if loop.time() - last_write >= 1.0:
+            last_write = loop.time()
+            samples = list(lags)
+            with open(stats_file + ".tmp", "w") as f:
+                json.dump({"event_loop_lag": summarize(samples), "rss_bytes": read_rss_bytes()}, f)
+            os.replace(stats_file + ".tmp", stats_file)
+
+
+async def bench_stub_server(args):
+    """Runs main() with stubbed backends (used as the loadtest child process)."""
+    env = {"ALLOW_SHELL_EXECUTION": "true", "DEVICE_ASSISTANT_PORT": str(args.port),
+           "INTERPRETATION_CACHE_PATH": os.path.join(tempfile.gettempdir(), f"bench-interpretations-{os.getpid()}.db")}
+    main = import_main(**env)
+    install_stubs(main, args.llm_latency)
+    if args.stats_file: asyncio.create_task(_loop_lag_monitor(args.stats_file))
+    await main.main()
+
+
+# --- loadtest: N simulated quick-settings clients against the stubbed server ---
+DASHBOARD_POLLS = [
+    ("get_cpu_usage", "get cpu usage"),
+    ("get_memory_usage", "get memory usage"),
+    ("get_volume", "get_volume"),
+    ("get_battery_status", "get_battery_status"),
+    ("get_wifi_status", "get wifi status"),
+    ("get_bluetooth_status", "get bluetooth status"),
+]
+SNAPSHOT_POLLS = [("get_system_snapshot", "get system snapshot")] # --snapshot: one request per tick instead of six
+NL_COMMANDS = [("nl_llm", "how much juice do I have left"), ("nl_llm", "make it loud"), ("nl_llm", "sing me a song")]
+SHELL_COMMANDS = [("run_shell_command", "run echo bench")]
+
+
+async def _simulated_client(url, duration, poll_interval, nl_probability, shell_probability, samples, rng, polls=DASHBOARD_POLLS):
+    import websockets
+    pending = {}
+    next_id = 0
+    async with websockets.connect(url, max_queue=None) as ws:
+        async def receive():
+            async for raw in ws:
+                frame = json.loads(raw)
+                if frame.get("type") == "progress": continue
+                sent = pending.pop(frame.get("id"), None)
+                if sent is not None: samples[sent[0]].append((time.perf_counter() - sent[1]) * 1000)
+
+        receiver = asyncio.create_task(receive())
+        await asyncio.sleep(rng.random() * poll_interval) # Spread clients across the tick
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            tick = time.perf_counter()
+            batch = list(polls)
+            if rng.random() < nl_probability: batch.append(rng.choice(NL_COMMANDS))
+            if rng.random() < shell_probability: batch.append(rng.choice(SHELL_COMMANDS))
+            for label, command in batch:
+                next_id += 1
+                pending[next_id] = (label, time.perf_counter())
+                await ws.send(json.dumps({"type": "request", "id": next_id, "command": command}))
+            await asyncio.sleep(max(0.0, poll_interval - (time.perf_counter() - tick)))
+        await asyncio.sleep(min(2.0, poll_interval * 2)) # Let outstanding replies arrive
+        receiver.cancel()
+    for label, _ in pending.values(): samples[f"{label} (unanswered)"].append(0.0)
+
+
+async def bench_loadtest(args):
+    port = args.port or _free_port()
+    stats_file = os.path.join(tempfile.gettempdir(), f"bench-server-stats-{os.getpid()}.json")
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "stub-server", "--port", str(port), "--stats-file", stats_file,
+        "--llm-latency", str(args.llm_latency))
+    try:
+        url = f"ws://localhost:{port}"
+        await _wait_for_server(url)
+        samples = collections.defaultdict(list)
+        rng = random.Random(args.seed)
+        start = time.perf_counter()
+        await asyncio.gather(*(_simulated_client(url, args.duration, args.poll_interval, args.nl_probability,
+                                                 args.shell_probability, samples, random.Random(rng.random()),
+                                                 SNAPSHOT_POLLS if args.snapshot else DASHBOARD_POLLS)
+                               for _ in range(args.clients)))
+        elapsed = time.perf_counter() - start
+        rss = read_rss_bytes(server.pid)
+        await asyncio.sleep(1.1) # One more stats write from the server
+        with open(stats_file) as f: server_stats = json.load(f)
+    finally:
+        server.terminate()
+        await server.wait()
+    per_intent = {label: summarize(values) for label, values in sorted(samples.items())}
+    responses = sum(len(v) for k, v in samples.items() if not k.endswith("(unanswered)"))
+    results = {
+        "clients": args.clients,
+        "polling": "snapshot" if args.snapshot else "per-metric",
+        "duration_s": args.duration,
+        "responses": responses,
+        "throughput_rps": round(responses / elapsed, 1),
+        "latency": per_intent,
+        "event_loop_lag": server_stats["event_loop_lag"],
+        "server_rss_bytes": rss or server_stats["rss_bytes"],
+    }
+    print_table(f"{args.clients} clients, {responses} responses, {results['throughput_rps']} responses/s", per_intent)
+    lag = results["event_loop_lag"]
+    print(f"\nevent-loop lag p50 {lag['p50_ms']} ms, p99 {lag['p99_ms']} ms, max {lag['max_ms']} ms; "
+          f"server RSS {results['server_rss_bytes'] / 2**20:.1f} MiB")
+    return results
+
+
+# --- telemetry: bandwidth and server CPU of the telemetry encodings at a high refresh rate ---
+TELEMETRY_CASES = [
+    # (name, subscribe options, permessage-deflate)
+    ("full json", {}, True),
+    ("full json, no deflate", {}, False),
+    ("delta json", {"delta": True}, True),
+    ("delta json, no deflate", {"delta": True}, False),
+    ("delta msgpack", {"delta": True, "encoding": "msgpack"}, True),
+    ("delta msgpack, no deflate", {"delta": True, "encoding": "msgpack"}, False),
+]
+
+
+def read_cpu_seconds(pid):
+    """User + system CPU seconds consumed by a process so far."""
+    with open(f"/proc/{pid}/stat") as f: fields = f.read().rpartition(")")[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def _telemetry_client(url, options, deflate, duration, totals):
+    import websockets
+    async with websockets.connect(url, compression="deflate" if deflate else None, max_queue=None) as ws:
+        receive_bytes = ws.data_received
+        def count_wire_bytes(data):
+            totals["wire_bytes"] += len(data)
+            receive_bytes(data)
+        ws.data_received = count_wire_bytes # Bytes off the socket, i.e. after compression
+        await ws.send(json.dumps({"type": "subscribe", **options}))
+        deadline = time.perf_counter() + duration
+        try:
+            while True:
+                message = await asyncio.wait_for(ws.recv(), timeout=max(0.001, deadline - time.perf_counter()))
+                totals["messages"] += 1; totals["payload_bytes"] += len(message)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def bench_telemetry(args):
+    port = args.port or _free_port()
+    server = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "stub-server", "--port", str(port))
+    results = {}
+    try:
+        url = f"ws://localhost:{port}"
+        await _wait_for_server(url)
+        for name, options, deflate in TELEMETRY_CASES:
+            options = {"interval_ms": args.interval_ms, **options}
+            totals = collections.Counter()
+            cpu_before = read_cpu_seconds(server.pid)
+            await asyncio.gather(*(_telemetry_client(url, options, deflate, args.duration, totals) for _ in range(args.clients)))
+            cpu = read_cpu_seconds(server.pid) - cpu_before
+            per_client_second = args.clients * args.duration
+            results[name] = {
+                "messages_per_client_s": round(totals["messages"] / per_client_second, 1),
+                "payload_bytes_per_client_s": round(totals["payload_bytes"] / per_client_second),
+                "wire_bytes_per_client_s": round(totals["wire_bytes"] / per_client_second),
+                "server_cpu_percent": round(cpu / args.duration * 100, 1),
+            }
+    finally:
+        server.terminate()
+        await server.wait()
+    print(f"\n{args.clients} subscribers at {args.interval_ms} ms for {args.duration:g}s per case")
+    print(f"{'case':<28}{'msgs/s':>10}{'payload B/s':>14}{'wire B/s':>12}{'server CPU':>12}")
+    for name, r in results.items():
+        print(f"{name:<28}{r['messages_per_client_s']:>10}{r['payload_bytes_per_client_s']:>14}{r['wire_bytes_per_client_s']:>12}{r['server_cpu_percent']:>11}%")
+    return results
+
+
+# --- fleet: one hub, hundreds of simulated agents, a dashboard fanning out commands ---
+FLEET_BENCH_TOKEN = "bench-fleet-token" # Agents register and the dashboard sends fleet_* frames with it
+class SimulatedAgent:
+    """Speaks the agent side of the hub protocol without running main.py: registers, streams delta
+    telemetry when the hub subscribes, and answers requests after a short random delay."""
+
+    def __init__(self, device_id, rng, reply_delay):
+        self.device_id = device_id
+        self.rng = rng
+        self.reply_delay = reply_delay # Seconds; slow agents get one longer than the fan-out timeout
+
+    async def run(self, url, registered):
+        import websockets
+        async with websockets.connect(url, max_queue=None) as ws:
+            await ws.send(json.dumps({"type": "register", "device_id": self.device_id, "token": FLEET_BENCH_TOKEN, "info": {"simulated": True}}))
+            if json.loads(await ws.recv()).get("type") != "registered": raise RuntimeError(f"{self.device_id} was not registered")
+            registered.append(time.perf_counter())
+            tasks = set()
+            try:
+                async for message in ws:
+                    frame = json.loads(message)
+                    if frame.get("type") == "subscribe":
+                        await ws.send(json.dumps({"type": "subscribed"}))
+                        task = asyncio.create_task(self._telemetry(ws, frame.get("interval_ms", 1000) / 1000))
+                    elif frame.get("type") == "request":
+                        task = asyncio.create_task(self._reply(ws, frame))
+                    else: continue
+                    tasks.add(task); task.add_done_callback(tasks.discard)
+            finally:
+                for task in tasks: task.cancel()
+
+    async def _telemetry(self, ws, interval):
+        metrics = {"cpu": {"percent": 10.0}, "memory": {"percent": 40.0}, "volume": {"level": 50, "muted": False},
+                   "battery": {"percent": 90, "charging": True}, "wifi": {"enabled": True, "state": "enabled"},
+                   "bluetooth": {"enabled": False, "state": "off"}}
+        seq = 0
+        await asyncio.sleep(self.rng.random() * interval)
+        while True:
+            seq += 1
+            frame = {"type": "telemetry", "seq": seq, "ts": time.time(), "keyframe": seq == 1, "metrics": metrics if seq == 1 else {}}
+            frame["metrics"]["cpu"] = {"percent": round(self.rng.uniform(1, 90), 1)}
+            frame["metrics"]["memory"] = {"percent": round(self.rng.uniform(30, 60), 1)}
+            await ws.send(json.dumps(frame))
+            await asyncio.sleep(interval)
+
+    async def _reply(self, ws, frame):
+        await asyncio.sleep(self.reply_delay)
+        intent = frame.get("intent") or "command"
+        await ws.send(json.dumps({"id": frame["id"], "response": f"Simulated {intent} on {self.device_id}: {json.dumps(frame.get('parameters') or {})}"}))
+
+
+async def _fleet_dashboard(url, duration, timeout, expected, totals):
+    """Subscribes to fleet telemetry and fans set_volume out to every device once per second."""
+    import websockets
+    latencies, outcomes = [], collections.Counter()
+    async with websockets.connect(url, max_queue=None) as ws:
+        await ws.send(json.dumps({"type": "fleet_subscribe", "token": FLEET_BENCH_TOKEN}))
+        pending = {}
+        async def fan_out():
+            for n in range(int(duration)):
+                pending[n] = time.perf_counter()
+                await ws.send(json.dumps({"type": "fleet_request", "token": FLEET_BENCH_TOKEN, "id": n, "devices": "*", "intent": "set_volume",
+                                          "parameters": {"level": 40 + n % 10}, "timeout": timeout}))
+                await asyncio.sleep(1.0)
+        sender = asyncio.create_task(fan_out())
+        deadline = time.perf_counter() + duration + timeout + 1
+        try:
+            while time.perf_counter() < deadline:
+                message = await asyncio.wait_for(ws.recv(), timeout=max(0.001, deadline - time.perf_counter()))
+                frame = json.loads(message)
+                if frame.get("type") == "fleet_telemetry":
+                    totals["telemetry_frames"] += 1; totals["telemetry_bytes"] += len(message)
+                    totals["device_updates"] += len(frame["devices"])
+                elif frame.get("type") == "fleet_response":
+                    latencies.append((time.perf_counter() - pending.pop(frame["id"])) * 1000)
+                    for result in frame["devices"].values():
+                        if "response" in result: outcomes["ok"] += 1
+                        elif "No reply" in result.get("error", ""): outcomes["timeout"] += 1
+                        else: outcomes["error"] += 1
+                    totals["devices_per_response"] = len(frame["devices"])
+                    if not pending and sender.done(): break
+        except asyncio.TimeoutError:
+            pass
+        sender.cancel()
+        # Real agents run main.py end to end: check a non-streamed shell command comes back whole
+        real = [d["device_id"] for d in (await _fleet_devices(ws)) if d["device_id"].startswith("real-")]
+        if real:
+            await ws.send(json.dumps({"type": "fleet_request", "token": FLEET_BENCH_TOKEN, "id": "shell", "devices": real, "intent": "run_shell_command",
+                                      "parameters": {"command": "echo fleet"}, "timeout": 10}))
+            while True:
+                frame = json.loads(await ws.recv())
+                if frame.get("id") == "shell": totals["real_agent_shell"] = frame["devices"]; break
+    return latencies, outcomes
+
+
+async def _fleet_devices(ws):
+    await ws.send(json.dumps({"type": "fleet_devices", "token": FLEET_BENCH_TOKEN, "id": "devices"}))
+    while True:
+        frame = json.loads(await ws.recv())
+        if frame.get("id") == "devices": return frame["devices"]
+
+
+async def bench_fleet(args):
+    import websockets
+    port = args.port or _free_port()
+    url = f"ws://localhost:{port}"
+    hub_env = {**os.environ, "FLEET_HUB": "true", "FLEET_TOKEN": FLEET_BENCH_TOKEN, "FLEET_TELEMETRY_INTERVAL_MS": str(args.agent_interval_ms)}
+    hub = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "stub-server", "--port", str(port), env=hub_env)
+    processes = [hub]
+    tasks = []
+    try:
+        await _wait_for_server(url)
+        for i in range(args.real_agents): # main.py agents with stubbed devices, dialling in with HUB_URL
+            agent_env = {**os.environ, "HUB_URL": url, "DEVICE_ID": f"real-{i}", "FLEET_TOKEN": FLEET_BENCH_TOKEN, "FLEET_TELEMETRY_INTERVAL_MS": str(args.agent_interval_ms)}
+            processes.append(await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "stub-server",
+                                                                  "--port", str(_free_port()), env=agent_env))
+        rng = random.Random(args.seed)
+        slow = set(rng.sample(range(args.agents), int(args.agents * args.slow_agents)))
+        registered = []
+        start = time.perf_counter()
+        for i in range(args.agents):
+            delay = args.fleet_timeout * 2 if i in slow else rng.uniform(0.001, 0.02)
+            tasks.append(asyncio.create_task(SimulatedAgent(f"sim-{i:04d}", random.Random(rng.random()), delay).run(url, registered)))
+        expected = args.agents + args.real_agents
+        async with websockets.connect(url) as ws:
+            while len(await _fleet_devices(ws)) < expected:
+                if time.perf_counter() - start > 60: raise SystemExit("Agents did not all register within 60 s")
+                await asyncio.sleep(0.1)
+        register_seconds = time.perf_counter() - start
+        totals = collections.Counter()
+        cpu_before = read_cpu_seconds(hub.pid)
+        measured = time.perf_counter()
+        latencies, outcomes = await _fleet_dashboard(url, args.duration, args.fleet_timeout, expected, totals)
+        elapsed = time.perf_counter() - measured
+        hub_cpu = read_cpu_seconds(hub.pid) - cpu_before
+        hub_rss = read_rss_bytes(hub.pid)
+    finally:
+        for task in tasks: task.cancel()
+        for process in processes: process.terminate()
+        for process in processes: await process.wait()
+    results = {
+        "agents": expected,
+        "simulated_agents": args.agents,
+        "real_agents": args.real_agents,
+        "slow_agents": len(slow),
+        "registration_seconds": round(register_seconds, 2),
+        "fan_out": summarize(latencies),
+        "device_outcomes": dict(outcomes),
+        "dashboard_telemetry_frames_per_s": round(totals["telemetry_frames"] / elapsed, 1),
+        "dashboard_telemetry_bytes_per_s": round(totals["telemetry_bytes"] / elapsed),
+        "device_updates_per_s": round(totals["device_updates"] / elapsed),
+        "real_agent_shell": totals.get("real_agent_shell"),
+        "hub_cpu_percent": round(hub_cpu / elapsed * 100, 1),
+        "hub_rss_bytes": hub_rss,
+    }
+    print(f"\n{expected} agents ({args.agents} simulated, {args.real_agents} running main.py, {len(slow)} slow) registered in {register_seconds:.2f}s")
+    print_table(f"set_volume fanned out to all devices (timeout {args.fleet_timeout:g}s)", {"fleet_request": results["fan_out"]})
+    print(f"device results: {dict(outcomes)}")
+    print(f"dashboard: {results['dashboard_telemetry_frames_per_s']} fleet frames/s, {results['device_updates_per_s']} device updates/s, "
+          f"{results['dashboard_telemetry_bytes_per_s']} B/s")
+    print(f"hub: {results['hub_cpu_percent']}% CPU, {hub_rss / 2**20:.1f} MiB RSS")
+    for device_id, result in (results["real_agent_shell"] or {}).items(): print(f"{device_id} shell: {json.dumps(result)[:120]}")
+    return results
+
+
+# --- batch: a scene as one batch vs one action (and one LLM call) at a time ---
+BATCH_SCENE = [
+    # (intent, parameters, simulated backend latency in seconds)
+    ("set_brightness", {"level": 30}, 0.12), # DDC/CI round trip
+    ("set_volume", {"level": 20}, 0.03),
+    ("toggle_bluetooth", {"state": "off"}, 0.25), # rfkill + state check
+    ("toggle_wifi", {"state": "on"}, 0.2),
+]
+BATCH_SCENE_COMMAND = "brightness 30, volume 20, bluetooth off and wifi on" # Split by the fast-path matcher
+
+
+def _install_scene_handlers(main):
+    """Replaces the scene's handlers with sleeps of their backend latency."""
+    def fake(name, latency):
+        async def handler(**parameters):
+            await asyncio.sleep(latency)
+            return f"{name} done"
+        return handler
+    for intent, _, latency in BATCH_SCENE:
+        main.INTENT_HANDLERS[intent] = fake(intent, latency)
+        main.INTENT_EXECUTION[intent] = ("async", 1)
+
+
+async def bench_batch(args):
+    main = import_main(INTERPRETATION_CACHE_PATH=os.path.join(tempfile.gettempdir(), f"bench-interpretations-{os.getpid()}.db"),
+                       RATE_LIMITS="telemetry=0,control=0,llm=0,shell=0") # One session runs every iteration back to back
+    install_stubs(main, args.llm_latency)
+    _install_scene_handlers(main)
+    session = main.ClientSession(None)
+    actions = [{"intent": intent, "parameters": parameters} for intent, parameters, _ in BATCH_SCENE]
+    iterations = max(1, min(args.iterations, 20))
+
+    async def sequential(i):
+        for action in actions: await main.run_intent(action["intent"], action["parameters"])
+
+    async def batch(i):
+        return await main.execute_batch(session, actions)
+
+    async def llm_per_action(i):
+        for n, action in enumerate(actions):
+            await main.call_openai_api(f"scene {i} step {n}") # Uncached phrasing: one round trip each
+            await main.run_intent(action["intent"], action["parameters"])
+
+    async def llm_batch(i):
+        return await main.process_message(session, f"movie mode {i}") # One call returns every action
+
+    async def fast_path_batch(i):
+        return await main.process_message(session, BATCH_SCENE_COMMAND)
+
+    cases = {"sequential": sequential, "batch": batch, "llm_per_action": llm_per_action,
+             "llm_batch": llm_batch, "fast_path_batch": fast_path_batch}
+    results = {}
+    for name, case in cases.items():
+        samples = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            await case(i)
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = summarize(samples)
+    last = await fast_path_batch(0)
+    slowest = max(latency for _, _, latency in BATCH_SCENE) * 1000
+    total = sum(latency for _, _, latency in BATCH_SCENE) * 1000
+    print(f"\nscene of {len(BATCH_SCENE)} actions: slowest {slowest:.0f} ms, sum {total:.0f} ms, LLM latency {args.llm_latency * 1000:.0f} ms")
+    print_table("scene completion time", results)
+    print(f"fast-path reply: ok={last['response']['ok']} failed={last['response']['failed']}")
+    return {"scene": [{"intent": i, "latency_ms": l * 1000} for i, _, l in BATCH_SCENE], "cases": results}
+
+
+# --- setters: a slider drag through the coalescing setter queue vs one write per event ---
+SLIDER_EVENT_HZ = 60 # Pointer-move events per second while dragging
+SETTER_WRITE_SECONDS = 0.03 # Roughly one `amixer sset Master` spawn
+
+
+async def _websocket_drag(main, drag):
+    """Sends the drag as v2 requests over one connection to an in-process server (rate limits on).
+
+    Returns the replies and when the last event was sent.
+    """
+    import websockets
+    port = _free_port()
+    async with websockets.serve(main.handler, "localhost", port), websockets.connect(f"ws://localhost:{port}") as ws:
+        for n, level in enumerate(drag):
+            await ws.send(json.dumps({"type": "request", "id": n, "intent": "set_volume", "parameters": {"level": level}}))
+            await asyncio.sleep(1 / SLIDER_EVENT_HZ)
+        released, replies = time.perf_counter(), {}
+        while len(replies) < len(drag):
+            frame = json.loads(await ws.recv())
+            if "id" in frame: replies[frame["id"]] = frame["response"]
+    return [replies[n] for n in range(len(drag))], released
+
+
+async def bench_setters(args):
+    main = import_main()
+    install_stubs(main)
+    applied = []
+
+    async def fake_set_volume(level: int) -> str:
+        await asyncio.sleep(SETTER_WRITE_SECONDS)
+        applied.append(level)
+        return f"Volume set to {level}%"
+    main.INTENT_HANDLERS["set_volume"] = fake_set_volume
+    rng = random.Random(args.seed)
+    level, drag = 50, []
+    for _ in range(int(args.duration * SLIDER_EVENT_HZ)):
+        level = max(0, min(100, level + rng.choice((-2, -1, 1, 2))))
+        drag.append(level)
+
+    results = {}
+    for name, run in (("one_write_per_event", main._run_intent), ("setter_queue", main.run_intent)):
+        applied.clear()
+        superseded = main.setter_queues["set_volume"].superseded
+        tasks = []
+        for level in drag:
+            tasks.append(asyncio.create_task(run("set_volume", {"level": level})))
+            await asyncio.sleep(1 / SLIDER_EVENT_HZ)
+        released = time.perf_counter()
+        replies = await asyncio.gather(*tasks)
+        results[name] = {
+            "events": len(drag),
+            "backend_writes": len(applied),
+            "superseded": main.setter_queues["set_volume"].superseded - superseded,
+            "final_value_applied": applied[-1] == drag[-1],
+            "settle_ms_after_release": round((time.perf_counter() - released) * 1000, 1),
+            "replies": len(replies),
+        }
+    # The same drag as the quick-settings app sends it: through the websocket, per-connection rate limits and all
+    applied.clear()
+    superseded = main.setter_queues["set_volume"].superseded
+    replies, released = await _websocket_drag(main, drag)
+    results["websocket_drag"] = {
+        "events": len(drag),
+        "backend_writes": len(applied),
+        "superseded": main.setter_queues["set_volume"].superseded - superseded,
+        "final_value_applied": bool(applied) and applied[-1] == drag[-1],
+        "settle_ms_after_release": round((time.perf_counter() - released) * 1000, 1),
+        "replies": len(replies),
+        "rate_limited": sum("Rate limit" in str(reply) for reply in replies),
+    }
+    print(f"\nslider drag: {len(drag)} events at {SLIDER_EVENT_HZ} Hz, {SETTER_WRITE_SECONDS * 1000:.0f} ms per write, "
+          f"queue rate limit {main.SETTER_RATE_HZ:g} Hz")
+    print(f"{'case':<24}{'writes':>8}{'superseded':>12}{'final ok':>10}{'settle ms':>12}{'limited':>9}")
+    for name, r in results.items():
+        print(f"{name:<24}{r['backend_writes']:>8}{r['superseded']:>12}{str(r['final_value_applied']):>10}{r['settle_ms_after_release']:>12.1f}"
+              f"{r.get('rate_limited', 0):>9}")
+    if not results["websocket_drag"]["final_value_applied"]: raise SystemExit("websocket drag: the final slider value was not applied")
+    return results
+
+
+# --- coldstart: process start to first served get_memory_usage, lazy vs eager startup ---
+async def _http_status(port, path):
+    reader, writer = await asyncio.open_connection("localhost", port)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+        return int((await reader.readline()).split()[1])
+    finally: writer.close()
+
+
+async def _cold_start(mode, timeout=30.0):
+    """Starts main.py and returns seconds until the port accepts, the first get_memory_usage reply and /ready is 200."""
+    import websockets
+    port = _free_port()
+    env = {**os.environ, "DEVICE_ASSISTANT_PORT": str(port), "STARTUP_MODE": mode,
+           "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "sk-bench-unused"), # So the warm-up really loads openai
+           "INTERPRETATION_CACHE_PATH": os.path.join(tempfile.gettempdir(), f"bench-coldstart-{os.getpid()}.db")}
+    start = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+                                                   env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    timings = {}
+    try:
+        while True:
+            try: ws = await websockets.connect(f"ws://localhost:{port}")
+            except OSError:
+                if time.perf_counter() - start > timeout: raise SystemExit(f"main.py did not start within {timeout:g}s")
+                await asyncio.sleep(0.002)
+                continue
+            break
+        timings["accepting"] = time.perf_counter() - start
+        async with ws:
+            await ws.send("get memory usage")
+            await ws.recv()
+        timings["first_memory_reply"] = time.perf_counter() - start
+        while await _http_status(port, "/ready") != 200: await asyncio.sleep(0.005)
+        timings["ready"] = time.perf_counter() - start
+    finally:
+        process.terminate()
+        await process.wait()
+    return timings
+
+
+async def bench_coldstart(args):
+    restarts = max(1, args.restarts)
+    results = {}
+    for mode in ("eager", "lazy"):
+        runs = [await _cold_start(mode) for _ in range(restarts)]
+        results[mode] = {stage: summarize([run[stage] * 1000 for run in runs]) for stage in runs[0]}
+    print(f"\ncold start of main.py, {restarts} restarts per mode (openai is loaded during warm-up)")
+    for mode, stages in results.items():
+        print_table(f"STARTUP_MODE={mode}: ms from process start", stages)
+    return results
+
+
+# --- history: recording cost, size on disk and range-query latency of the metric history ---
+HISTORY_QUERIES = [
+    # (case, window seconds, points)
+    ("dashboard_backfill_60s", 60, 60),
+    ("last_hour", 3600, 120),
+    ("last_day", 24 * 3600, 288),
+    ("last_30_days", 30 * 24 * 3600, 720),
+]
+
+
+async def bench_history(args):
+    main = import_main()
+    directory = tempfile.mkdtemp(prefix="bench-history-")
+    history = main.metric_history = main.MetricHistory(directory, main.HISTORY_TIERS)
+    history.start()
+    history._task.cancel() # Samples are synthesized below instead
+    rng = random.Random(args.seed)
+    days = max(1, args.history_days)
+    now = int(time.time())
+    first = now - days * 24 * 3600
+    cpu = memory = 40.0
+    start = time.perf_counter()
+    for ts in range(first, now):
+        cpu = max(0.0, min(100.0, cpu + rng.uniform(-3, 3))); memory = max(0.0, min(100.0, memory + rng.uniform(-0.2, 0.2)))
+        history.record(ts, (cpu, memory, 80.0, 50.0))
+    record_us = (time.perf_counter() - start) / (now - first) * 1e6
+    disk_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    results = {"simulated_days": days, "record_us": round(record_us, 2), "disk_bytes": disk_bytes,
+               "records": {name: len(ring) for name, ring in history.rings.items()}, "queries": {}}
+    iterations = max(1, min(args.iterations, 200))
+    for case, window, points in HISTORY_QUERIES:
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            reply = main.get_metric_history(window=window, points=points, end=now)
+            samples.append((time.perf_counter() - started) * 1000)
+        decoded = json.loads(reply)
+        results["queries"][case] = {**summarize(samples), "tier": decoded["tier"], "points": len(decoded["ts"]), "reply_bytes": len(reply)}
+    history.close()
+    for name in os.listdir(directory): os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    print(f"\n{days} simulated days of 1 s samples: {record_us:.2f} us per record (with roll-ups), {disk_bytes / 2**20:.2f} MiB on disk, "
+          f"records kept {results['records']}")
+    print_table("get_metric_history latency", {case: stats for case, stats in results["queries"].items()})
+    for case, stats in results["queries"].items(): print(f"  {case}: tier {stats['tier']}, {stats['points']} points, {stats['reply_bytes']} bytes")
+    return results
+
+
+# --- workers: connection and message throughput vs. number of worker processes (SO_REUSEPORT) ---
+WORKER_COMMANDS = ("get cpu usage", "get memory usage", "get system snapshot", "cpu usage per core")
+
+
+async def _throughput_load(url, mode, connections, duration):
+    """One client process: `connections` loops that either reconnect or send v2 requests until the deadline."""
+    import websockets
+    deadline = time.perf_counter() + duration
+    latencies, totals = [], collections.Counter()
+
+    async def reconnect():
+        while time.perf_counter() < deadline:
+            try:
+                async with websockets.connect(url): totals["connections"] += 1
+            except OSError: totals["errors"] += 1
+
+    async def request():
+        async with websockets.connect(url) as ws:
+            totals["connections"] += 1
+            n = 0
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                await ws.send(json.dumps({"type": "request", "id": n, "command": WORKER_COMMANDS[n % len(WORKER_COMMANDS)]}))
+                await ws.recv()
+                latencies.append((time.perf_counter() - started) * 1000)
+                n += 1
+
+    await asyncio.gather(*((reconnect if mode == "connections" else request)() for _ in range(connections)))
+    return {"totals": dict(totals), "latencies": latencies}
+
+
+def _throughput_client(url, mode, connections, duration):
+    return asyncio.run(_throughput_load(url, mode, connections, duration))
+
+
+async def bench_workers(args):
+    import concurrent.futures
+    import multiprocessing
+    counts = sorted({int(n) for n in args.workers.split(",")})
+    client_procs = args.client_procs or max(2, os.cpu_count() or 1)
+    loop = asyncio.get_running_loop()
+    results = {"cpu_count": os.cpu_count(), "client_processes": client_procs, "connections_per_process": args.clients, "cases": {}}
+    with concurrent.futures.ProcessPoolExecutor(client_procs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for count in counts:
+            port = _free_port()
+            env = {**os.environ, "WORKERS": str(count), "DEVICE_ASSISTANT_PORT": str(port), "HISTORY_DIR": "",
+                   "INTERPRETATION_CACHE_PATH": os.path.join(tempfile.gettempdir(), f"bench-workers-{os.getpid()}.db")}
+            env.pop("OPENAI_API_KEY", None)
+            server = await asyncio.create_subprocess_exec(sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+                                                          env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+            try:
+                url = f"ws://localhost:{port}"
+                await _wait_for_server(url)
+                await asyncio.sleep(1.0 + 0.25 * count) # Until every worker has bound the port
+                case = {}
+                for mode in ("connections", "messages"):
+                    runs = await asyncio.gather(*(loop.run_in_executor(pool, _throughput_client, url, mode, args.clients, args.duration)
+                                                  for _ in range(client_procs)))
+                    totals = collections.Counter()
+                    for run in runs: totals.update(run["totals"])
+                    latencies = [sample for run in runs for sample in run["latencies"]]
+                    if mode == "connections": case["connections_per_s"] = round(totals["connections"] / args.duration, 1); case["connect_errors"] = totals["errors"]
+                    else: case["messages_per_s"] = round(len(latencies) / args.duration, 1); case["message_latency"] = summarize(latencies)
+                results["cases"][count] = case
+            finally:
+                server.terminate()
+                await server.wait()
+    base = results["cases"][counts[0]]
+    print(f"\n{client_procs} client processes x {args.clients} connections, {args.duration:g}s per case, {os.cpu_count()} CPUs")
+    print(f"{'workers':<10}{'conn/s':>10}{'msg/s':>10}{'speedup':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for count, case in results["cases"].items():
+        print(f"{count:<10}{case['connections_per_s']:>10.1f}{case['messages_per_s']:>10.1f}{case['messages_per_s'] / max(base['messages_per_s'], 1e-9):>10.2f}"
+              f"{case['message_latency']['p50_ms']:>10.2f}{case['message_latency']['p99_ms']:>10.2f}")
+    return results
+
+
+# --- gateway: the LLM gateway against a fake OpenAI HTTP server with a latency tail, errors and an outage ---
+async def _gateway_calls(main, label, calls, concurrency=2):
+    """Runs `calls` uncached call_openai_api calls, `concurrency` at a time; returns latencies (ms) and failures."""
+    latencies, failures = [], 0
+    numbers = iter(range(calls))
+
+    async def worker():
+        nonlocal failures
+        for i in numbers:
+            started = time.perf_counter()
+            interpretation = await main.call_openai_api(f"how much juice is left ({label} {i})")
+            latencies.append((time.perf_counter() - started) * 1000)
+            failures += interpretation.get("intent") == "unknown"
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, failures
+
+
+async def bench_gateway(args):
+    fake = await FakeOpenAIServer(latency=args.llm_latency, slow_latency=args.llm_latency * 8, seed=args.seed).start()
+    main = import_main(OPENAI_API_KEY="sk-bench", OPENAI_BASE_URL=f"http://localhost:{fake.port}/v1", LLM_HEDGE_MIN_SECONDS="0.1",
+                       LLM_DEADLINE_SECONDS=str(args.llm_latency * 10), LLM_BREAKER_COOLDOWN="1", LLM_MAX_CONCURRENCY="8",
+                       INTERPRETATION_CACHE_PATH=os.path.join(tempfile.gettempdir(), f"bench-gateway-{os.getpid()}.db"))
+    gateway = main.llm_gateway
+    calls = max(20, min(args.iterations, 200))
+    cases = [
+        # (name, fake server settings, gateway settings)
+        ("2% slow, no hedging", {"slow_fraction": 0.02}, {"LLM_HEDGE": False}),
+        ("2% slow, hedged at p95", {"slow_fraction": 0.02}, {"LLM_HEDGE": True}),
+        ("20% errors, no retries", {"error_rate": 0.2}, {"LLM_RETRIES": 0}),
+        ("20% errors, 1 retry", {"error_rate": 0.2}, {"LLM_RETRIES": 1}),
+        ("hung API, deadline", {"latency": 3600}, {}),
+        ("outage, breaker", {"error_rate": 1.0}, {}),
+        ("recovered", {}, {}), # After the cooldown and one half-open trial call
+    ]
+    results = {}
+    for name, fake_settings, gateway_settings in cases:
+        for knob, value in {"latency": args.llm_latency, "slow_fraction": 0.0, "error_rate": 0.0, **fake_settings}.items(): setattr(fake, knob, value)
+        for knob, value in {"LLM_HEDGE": False, "LLM_RETRIES": 1, **gateway_settings}.items(): setattr(main, knob, value)
+        if name == "recovered": await asyncio.sleep(1.1); await main.call_openai_api("how much juice is left (trial)")
+        else: gateway.failures, gateway.open_until = 0, 0.0
+        requests, before = fake.requests, {key: value for key, value in main.LLM_ATTEMPTS.values.items()}
+        case_calls = 4 if name == "hung API, deadline" else calls
+        started = time.perf_counter()
+        latencies, failures = await _gateway_calls(main, name, case_calls)
+        attempts = {"/".join(key): int(value - before.get(key, 0)) for key, value in main.LLM_ATTEMPTS.values.items() if value - before.get(key, 0)}
+        results[name] = {"calls": case_calls, "failed": failures, "server_requests": fake.requests - requests, "attempts": attempts,
+                         "breaker": gateway.state, "elapsed_s": round(time.perf_counter() - started, 2), "latency": summarize(latencies)}
+    await fake.close()
+    results["pool"] = {"requests": fake.requests, "connections": fake.connections}
+    print(f"\n{calls} calls per case, 2 at a time, {args.llm_latency * 1000:.0f} ms per request, slow requests {args.llm_latency * 8000:.0f} ms, "
+          f"deadline {main.LLM_DEADLINE_SECONDS:g}s")
+    print_table("call_openai_api latency", {name: case["latency"] for name, case in results.items() if name != "pool"})
+    print(f"\n{'case':<28}{'failed':>8}{'requests':>10}{'breaker':>10}  attempts (kind/result)")
+    for name, case in results.items():
+        if name == "pool": continue
+        print(f"{name:<28}{case['failed']:>8}{case['server_requests']:>10}{case['breaker']:>10}  "
+              + ", ".join(f"{key} {value}" for key, value in sorted(case["attempts"].items())))
+    print(f"\nconnection pool: {results['pool']['requests']} requests over {results['pool']['connections']} connections")
+    return results
+
+
+# --- streaming: time to progress, first action and reply, with the LLM answer streamed vs buffered ---
+STREAMING_TOKEN_SECONDS = 0.02 # Per output token, roughly a hosted model's decode speed
+
+
+class _RecordingSocket:
+    """Stands in for a client connection; records every frame the server sends with its time."""
+    remote_address = ("bench", 0)
+
+    def __init__(self): self.frames = []
+
+    async def send(self, data): self.frames.append((time.perf_counter(), json.loads(data)))
+
+
+async def bench_streaming(args):
+    fake = await FakeOpenAIServer(latency=args.llm_latency, token_latency=STREAMING_TOKEN_SECONDS, seed=args.seed).start()
+    main = import_main(OPENAI_API_KEY="sk-bench", OPENAI_BASE_URL=f"http://localhost:{fake.port}/v1",
+                       INTERPRETATION_CACHE_PATH=os.path.join(tempfile.gettempdir(), f"bench-streaming-{os.getpid()}.db"),
+                       RATE_LIMITS="telemetry=0,control=0,llm=0,shell=0") # One session runs every iteration back to back
+    _install_scene_handlers(main)
+    started_at = []
+    for intent, handler in list(main.INTENT_HANDLERS.items()):
+        if intent not in {name for name, _, _ in BATCH_SCENE}: continue
+        async def timed(handler=handler, **parameters):
+            started_at.append(time.perf_counter())
+            return await handler(**parameters)
+        main.INTENT_HANDLERS[intent] = timed
+    iterations = max(1, min(args.iterations, 20))
+    commands = {"single intent": "make it loud ({i})", "batch": "movie mode {i}"} # "it" keeps them away from the local tiers
+    results = {}
+    for streaming in (False, True):
+        main.LLM_STREAMING = streaming
+        for name, command in commands.items():
+            progress, first_action, reply = [], [], []
+            for i in range(iterations):
+                socket_ = _RecordingSocket()
+                session = main.ClientSession(socket_)
+                await session.inflight.acquire()
+                started_at.clear()
+                started = time.perf_counter()
+                await main.process_request(session, i, command.format(i=f"{'on' if streaming else 'off'} {i}"))
+                frames = {frame.get("type", "reply"): at for at, frame in socket_.frames}
+                if "progress" in frames: progress.append((frames["progress"] - started) * 1000)
+                if started_at: first_action.append((min(started_at) - started) * 1000)
+                reply.append((frames["reply"] - started) * 1000)
+            results[f"{name}, {'streamed' if streaming else 'buffered'}"] = {
+                "progress": summarize(progress), "first_action": summarize(first_action), "reply": summarize(reply)}
+    await fake.close()
+    dispatched = {"/".join(key): int(value) for key, value in main.EARLY_DISPATCHES.values.items()}
+    print(f"\n{iterations} requests per case, {args.llm_latency * 1000:.0f} ms to the first token, "
+          f"{STREAMING_TOKEN_SECONDS * 1000:.0f} ms per token after it")
+    for metric in ("progress", "first_action", "reply"):
+        print_table(f"time to {metric.replace('_', ' ')}", {name: case[metric] for name, case in results.items()})
+    print(f"\nearly dispatches: {dispatched}")
+    return {"cases": results, "early_dispatches": dispatched}
+
+
+async def bench_fake_openai(args):
+    """Serves FakeOpenAIServer until interrupted (for OPENAI_BASE_URL=http://localhost:PORT/v1)."""
+    fake = await FakeOpenAIServer(latency=args.llm_latency, error_rate=args.error_rate, seed=args.seed).start(args.port or 8081)
+    print(f"Fake OpenAI API on http://localhost:{fake.port}/v1 ({args.llm_latency * 1000:.0f} ms per request, {args.error_rate:.0%} errors)")
+    await asyncio.Event().wait()
+
+
+# --- admission: each admission limit against a client that exceeds it, with the limits on and off ---
+ADMISSION_OFF = {"MAX_CONNECTIONS": "0", "RATE_LIMITS": "telemetry=0,control=0,llm=0,shell=0", "OUTBOUND_BUFFER_BYTES": "0", "LLM_MAX_CONCURRENCY": "0"}
+ADMISSION_MAX_CONNECTIONS = 50
+# A full telemetry frame is a few hundred bytes, so at the default 64 KiB a stalled subscriber takes minutes to
+# be noticed; the bench uses a lower threshold, 4 stalled subscribers per --clients and 4 * --duration of stalling.
+ADMISSION_OUTBOUND_BUFFER_BYTES = 16 * 1024
+
+
+async def _http_get(port, path):
+    """Returns (status, body) of a GET against the server's HTTP endpoints."""
+    reader, writer = await asyncio.open_connection("localhost", port)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+        head, _, body = (await reader.read()).partition(b"\r\n\r\n")
+        return int(head.split()[1]), body.decode()
+    finally: writer.close()
+
+
+async def _scrape(port, prefix):
+    """Samples of the metrics whose names start with `prefix`, as {"name{labels}": value}."""
+    _, body = await _http_get(port, "/metrics")
+    return {name: float(value) for name, _, value in (line.rpartition(" ") for line in body.splitlines() if line.startswith(prefix))}
+
+
+@contextlib.asynccontextmanager
+async def _stub_server(args, env):
+    """Runs the stub server in a subprocess with `env` applied; yields (process, port)."""
+    port = _free_port()
+    server = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "stub-server", "--port", str(port), "--llm-latency", str(args.llm_latency),
+        env={**os.environ, "HISTORY_DIR": "", **env})
+    try:
+        await _wait_for_server(f"ws://localhost:{port}")
+        yield server, port
+    finally:
+        server.terminate()
+        await server.wait()
+
+
+async def _admission_connections(url, port, attempts):
+    """Opens `attempts` connections at once and counts which stay open and which are closed with 1013."""
+    import websockets
+    connections = await asyncio.gather(*(websockets.connect(url) for _ in range(attempts)), return_exceptions=True)
+    await asyncio.sleep(0.5) # Rejections arrive as a close frame right after the handshake
+    opened = [ws for ws in connections if not isinstance(ws, BaseException)]
+    result = {"attempts": attempts, "open": sum(ws.close_code is None for ws in opened),
+              "rejected_1013": sum(ws.close_code == 1013 for ws in opened), "failed": attempts - len(opened)}
+    result["counters"] = await _scrape(port, "device_assistant_connections_rejected_total")
+    await asyncio.gather(*(ws.close() for ws in opened))
+    return result
+
+
+async def _flood(url, duration, window, totals):
+    """Sends requests back to back with `window` unanswered and counts replies served and rate limited."""
+    import websockets
+    async with websockets.connect(url, max_queue=None) as ws:
+        in_flight = asyncio.Semaphore(window)
+        async def receive():
+            async for raw in ws:
+                totals["rate_limited" if "Rate limit" in raw else "served"] += 1
+                in_flight.release()
+        receiver = asyncio.create_task(receive())
+        deadline = time.perf_counter() + duration
+        n = 0
+        while time.perf_counter() < deadline:
+            await in_flight.acquire()
+            n += 1
+            await ws.send(json.dumps({"type": "request", "id": n, "command": "get cpu usage"}))
+        await asyncio.sleep(0.5)
+        receiver.cancel()
+
+
+async def _admission_flood(url, port, duration, polite_clients, seed):
+    """One client flooding telemetry requests next to dashboards polling once a second."""
+    totals, samples = collections.Counter(), collections.defaultdict(list)
+    rng = random.Random(seed)
+    await asyncio.gather(_flood(url, duration, 16, totals),
+                         *(_simulated_client(url, duration, 1.0, 0.0, 0.0, samples, random.Random(rng.random())) for _ in range(polite_clients)))
+    polite = [sample for label, values in samples.items() if not label.endswith("(unanswered)") for sample in values]
+    return {"flooder_served_per_s": round(totals["served"] / duration, 1), "flooder_rate_limited": totals["rate_limited"],
+            "polite_latency": summarize(polite), "counters": await _scrape(port, "device_assistant_rate_limited_total")}
+
+
+async def _admission_llm(url, port, concurrent, burst):
+    """`concurrent` connections send one LLM command each at once; then one connection sends `burst` in a row."""
+    import websockets
+    peak = 0
+
+    async def one(i):
+        async with websockets.connect(url) as ws:
+            started = time.perf_counter()
+            await ws.send(json.dumps({"type": "request", "id": 1, "command": f"sing me song number {i}"}))
+            while (reply := await ws.recv()) and json.loads(reply).get("type") == "progress": pass
+            return (time.perf_counter() - started) * 1000, "busy" in reply
+
+    async def watch():
+        nonlocal peak
+        while True:
+            active = (await _scrape(port, "device_assistant_llm_calls")).get('device_assistant_llm_calls{state="active"}', 0)
+            peak = max(peak, int(active))
+            await asyncio.sleep(0.02)
+
+    watcher = asyncio.create_task(watch())
+    started = time.perf_counter()
+    replies = await asyncio.gather(*(one(i) for i in range(concurrent)))
+    elapsed = time.perf_counter() - started
+    watcher.cancel()
+    limited = 0
+    async with websockets.connect(url) as ws:
+        for i in range(burst): await ws.send(json.dumps({"type": "request", "id": i, "command": f"sing me song number {concurrent + i}"}))
+        for _ in range(burst):
+            while (reply := await ws.recv()) and json.loads(reply).get("type") == "progress": pass
+            limited += "Rate limit" in reply
+    return {"concurrent_calls": concurrent, "all_answered_s": round(elapsed, 2), "reply_latency": summarize([ms for ms, _ in replies]),
+            "busy_replies": sum(busy for _, busy in replies), "peak_active_calls": peak, "burst": burst, "burst_rate_limited": limited,
+            "counters": await _scrape(port, "device_assistant_llm")}
+
+
+async def _stalled_subscriber(port):
+    """Subscribes to telemetry over a socket with a small receive buffer and never reads from it again.
+
+    Uses the sans-I/O protocol, as a websockets client connection keeps reading into its own buffers.
+    """
+    from websockets.client import ClientProtocol
+    from websockets.protocol import State
+    from websockets.uri import parse_uri
+    loop = asyncio.get_running_loop()
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.setblocking(False)
+    await loop.sock_connect(sock, ("localhost", port))
+    protocol = ClientProtocol(parse_uri(f"ws://localhost:{port}"))
+    protocol.send_request(protocol.connect())
+    for data in protocol.data_to_send(): await loop.sock_sendall(sock, data)
+    while protocol.state is State.CONNECTING: protocol.receive_data(await loop.sock_recv(sock, 4096))
+    protocol.send_text(json.dumps({"type": "subscribe", "interval_ms": 50}).encode())
+    for data in protocol.data_to_send(): await loop.sock_sendall(sock, data)
+    return sock
+
+
+async def _admission_slow_consumers(url, port, server, stalled, duration):
+    """`stalled` subscribers stop reading next to one healthy subscriber."""
+    import websockets
+    rss_before = read_rss_bytes(server.pid)
+    connections = [await _stalled_subscriber(port) for _ in range(stalled)]
+    gaps = []
+    async with websockets.connect(url, max_queue=None) as ws:
+        await ws.send(json.dumps({"type": "subscribe", "interval_ms": 50}))
+        await ws.recv() # Subscription confirmation
+        last = time.perf_counter(); deadline = last + duration
+        try:
+            while True:
+                await asyncio.wait_for(ws.recv(), timeout=max(0.001, deadline - time.perf_counter()))
+                now = time.perf_counter(); gaps.append((now - last) * 1000); last = now
+        except asyncio.TimeoutError: pass
+    rss_after = read_rss_bytes(server.pid)
+    for sock in connections: sock.close()
+    return {"stalled": stalled, "healthy_frames_per_s": round(len(gaps) / duration, 1), "healthy_frame_gap": summarize(gaps),
+            "server_rss_growth_mib": round((rss_after - rss_before) / 2**20, 1),
+            "counters": await _scrape(port, "device_assistant_outbound_dropped_total")}
+
+
+async def bench_admission(args):
+    cases = {"limits on": {"MAX_CONNECTIONS": str(ADMISSION_MAX_CONNECTIONS), "OUTBOUND_BUFFER_BYTES": str(ADMISSION_OUTBOUND_BUFFER_BYTES),
+                           "SLOW_CONSUMER_SECONDS": str(args.duration)},
+             "limits off": ADMISSION_OFF}
+    results = {}
+    for name, env in cases.items():
+        case = results[name] = {}
+        async with _stub_server(args, env) as (server, port):
+            url = f"ws://localhost:{port}"
+            case["connections"] = await _admission_connections(url, port, ADMISSION_MAX_CONNECTIONS * 2)
+            case["flood"] = await _admission_flood(url, port, args.duration, args.clients, args.seed)
+            case["llm"] = await _admission_llm(url, port, 16, 12)
+            case["slow_consumers"] = await _admission_slow_consumers(url, port, server, args.clients * 4, args.duration * 4)
+    for name, case in results.items():
+        connections, flood, llm, slow = case["connections"], case["flood"], case["llm"], case["slow_consumers"]
+        print(f"\n{name}")
+        print(f"  connections     {connections['open']} of {connections['attempts']} open, {connections['rejected_1013']} closed with 1013")
+        print(f"  flood           flooder served {flood['flooder_served_per_s']}/s, {flood['flooder_rate_limited']} rate limited; "
+              f"{args.clients} polling clients p50 {flood['polite_latency']['p50_ms']} ms, p99 {flood['polite_latency']['p99_ms']} ms")
+        print(f"  llm             {llm['concurrent_calls']} concurrent calls answered in {llm['all_answered_s']} s, peak {llm['peak_active_calls']} active, "
+              f"{llm['busy_replies']} busy; {llm['burst_rate_limited']} of a {llm['burst']}-command burst rate limited")
+        print(f"  slow consumers  healthy subscriber {slow['healthy_frames_per_s']} frames/s, gap p99 {slow['healthy_frame_gap']['p99_ms']} ms; "
+              f"server RSS +{slow['server_rss_growth_mib']} MiB with {slow['stalled']} stalled subscribers")
+        for counters in (connections["counters"], flood["counters"], llm["counters"], slow["counters"]):
+            for metric, value in counters.items():
+                if value: print(f"    {metric} {value:g}")
+    return results
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+async def _wait_for_server(url, timeout=30.0):
+    import websockets
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            async with websockets.connect(url): return
+        except OSError:
+            if time.perf_counter() > deadline: raise
+            await asyncio.sleep(0.05)
+
+
+BENCHMARKS = {
+    "dispatch": bench_dispatch,
+    "matcher": bench_matcher,
+    "classifier": bench_classifier,
+    "prompt": bench_prompt,
+    "loadtest": bench_loadtest,
+    "stub-server": bench_stub_server,
+    "telemetry": bench_telemetry,
+    "fleet": bench_fleet,
+    "batch": bench_batch,
+    "setters": bench_setters,
+    "coldstart": bench_coldstart,
+    "history": bench_history,
+    "workers": bench_workers,
+    "admission": bench_admission,
+    "gateway": bench_gateway,
+    "streaming": bench_streaming,
+    "fake-openai": bench_fake_openai,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per measured case")
+    parser.add_argument("--shell-clients", type=int, default=4, help="Concurrent shell-command connections (dispatch)")
+    parser.add_argument("--iterations", type=int, default=2000, help="Timing repetitions (matcher, classifier, prompt, gateway, batch, streaming)")
+    parser.add_argument("--live", type=int, default=0, metavar="N", help="Live API calls per case for time to first byte (prompt)")
+    parser.add_argument("--clients", type=int, default=10, help="Simulated dashboards (loadtest); connections per client process (workers); polling clients and stalled subscribers (admission)")
+    parser.add_argument("--workers", default="1,2,4", help="Comma-separated worker counts to compare (workers)")
+    parser.add_argument("--client-procs", type=int, default=0, help="Load-generating processes (workers; default: one per CPU, at least 2)")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds between polling rounds (loadtest)")
+    parser.add_argument("--snapshot", action="store_true", help="Poll with one get_system_snapshot per round (loadtest)")
+    parser.add_argument("--nl-probability", type=float, default=0.05, help="Chance per round of a natural-language command (loadtest)")
+    parser.add_argument("--shell-probability", type=float, default=0.02, help="Chance per round of a shell command (loadtest)")
+    parser.add_argument("--interval-ms", type=int, default=50, help="Telemetry refresh interval (telemetry)")
+    parser.add_argument("--agents", type=int, default=200, help="Simulated agents (fleet)")
+    parser.add_argument("--real-agents", type=int, default=2, help="Agents running main.py with stubbed devices (fleet)")
+    parser.add_argument("--slow-agents", type=float, default=0.02, help="Fraction of simulated agents that miss the timeout (fleet)")
+    parser.add_argument("--fleet-timeout", type=float, default=2.0, help="Per-device fan-out timeout in seconds (fleet)")
+    parser.add_argument("--agent-interval-ms", type=int, default=1000, help="Agent telemetry interval (fleet)")
+    parser.add_argument("--restarts", type=int, default=5, help="Server restarts per startup mode (coldstart)")
+    parser.add_argument("--history-days", type=int, default=3, help="Days of 1 s samples to synthesize (history)")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="Seconds the fake OpenAI client takes per call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests the fake OpenAI server fails (fake-openai)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0, help="Server port (default: a free port)")
+    parser.add_argument("--stats-file", help=argparse.SUPPRESS)
+    parser.add_argument("--json", metavar="PATH", help="Write results as JSON to PATH")
+    args = parser.parse_args()
+    results = asyncio.run(BENCHMARKS[args.benchmark](args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": args.benchmark, "timestamp": time.time(), "results": results}, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,26 +3,36 @@ import websockets
 import json
 import logging
 import platform
+import random
 import subprocess
 import inspect
 import os # To read environment variables
 import collections # For deque (history)
 import shlex # For safely splitting command for Popen when shell=False
 import sys # To check platform
-
-import subprocess
-import screen_brightness_control as sbc
-
-# Attempt to import distro, optional dependency
-try:
-    import distro
-    distro_info = f"{distro.name()} {distro.version()}"
-except ImportError:
-    distro_info = None
-    logging.warning("'distro' library not found (pip install distro). OS detection might be less accurate.")
+import time
+import codecs
+import functools
+import hashlib
+import importlib
+import itertools
+import math
+import mmap
+import hmac
+import http
+import bisect
+import re
+import signal
+import socket
+import sqlite3
+import struct
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
 
 # --- Potentially Required Libraries (Install if needed) ---
-# pip install websockets psutil screen-brightness-control openai pycaw pulsectl-asyncio python-dotenv distro
+# pip install websockets psutil screen-brightness-control openai pycaw pulsectl-asyncio python-dotenv distro numpy
 # Load environment variables (e.g., for OPENAI_API_KEY)
 from dotenv import load_dotenv
 load_dotenv()
@@ -36,21 +46,8 @@ MAX_ERROR_FEEDBACK_ATTEMPTS = 1 # Number of times to feed back error for correct
 os_name = platform.system()
 is_linux = (os_name == "Linux")
 
-# --- Distro Info (Linux Only) ---
-if is_linux and not distro_info:
-    # Fallback using platform module if distro package failed
-    try:
-        # platform.uname() gives basic info
-        plat_uname = platform.uname()
-        distro_info = f"{plat_uname.system} {plat_uname.release}" # Less specific than 'distro'
-    except Exception:
-        distro_info = "Linux (Unknown Distribution)" # Generic fallback
-elif not is_linux:
-    distro_info = f"{os_name} {platform.release()}" # Use platform info for non-Linux
-
 # --- Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logging.info(f"Detected OS / Distro: {distro_info}")
 if ALLOW_SHELL_EXECUTION:
     logging.warning("="*60)
     logging.warning("🛑 SECURITY WARNING: Arbitrary shell command execution is ENABLED.")
@@ -61,58 +58,380 @@ else:
     logging.info("Shell command execution is disabled (ALLOW_SHELL_EXECUTION is not 'true').")
 
 
-# --- Library Imports & Checks ---
-try: import psutil
-except ImportError: logging.warning("psutil library not found."); psutil = None
-try: import screen_brightness_control as sbc
-except ImportError: logging.warning("screen-brightness-control library not found."); sbc = None
+# --- Optional Backends ---
+# Optional libraries are loaded through LazyBackend on first use, or by the warm-up task main() starts once the
+# port is bound: openai alone (with pydantic and httpx) takes most of a second to import. Only psutil, which the
+# CPU sampler and the memory/battery intents need from the first request, is loaded at import time.
+BACKENDS = {} # name -> LazyBackend
+
+
+class LazyBackend:
+    """An optional dependency imported (and probed) once, on first use or by the startup warm-up."""
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self.state = "pending" # "ready" or "unavailable" once loaded
+        self.detail = None # Why the backend is unavailable
+        self.load_ms = None
+        self._value = None
+        self._lock = threading.Lock()
+        BACKENDS[name] = self
+
+    def get(self):
+        """The loaded backend, or None if unavailable. Blocks while loading, so call aget() on the event loop."""
+        if self.state == "pending":
+            with self._lock:
+                if self.state == "pending": self._load()
+        return self._value
+
+    async def aget(self):
+        """get() for the event loop: a backend that is not loaded yet is loaded on the I/O pool."""
+        if self.state != "pending": return self._value
+        return await run_blocking(self.get)
+
+    def _load(self):
+        started = time.perf_counter()
+        try: self._value = self.loader()
+        except (ImportError, OSError, RuntimeError) as e:
+            self.detail = str(e) or type(e).__name__
+            logging.warning(f"{self.name} unavailable: {self.detail}")
+        self.load_ms = round((time.perf_counter() - started) * 1000, 1)
+        self.state = "ready" if self._value is not None else "unavailable"
+
+    def status(self):
+        return {"state": self.state, "detail": self.detail, "load_ms": self.load_ms}
+
+
+def _detect_distro():
+    try:
+        import distro
+        return f"{distro.name()} {distro.version()}"
+    except ImportError:
+        logging.warning("'distro' library not found (pip install distro). OS detection might be less accurate.")
+    if not is_linux: return f"{os_name} {platform.release()}"
+    try: return f"{platform.uname().system} {platform.uname().release}" # Less specific than 'distro'
+    except Exception: return "Linux (Unknown Distribution)"
+
+
+def _load_openai_client():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key: raise RuntimeError("OPENAI_API_KEY environment variable not set.")
+    try: import httpx; from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    except ImportError: raise ImportError("openai library not found.")
+    # One pool shared by every call (see LLM Gateway); OPENAI_BASE_URL is honoured by the SDK
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=LLM_POOL_CONNECTIONS, max_keepalive_connections=LLM_POOL_CONNECTIONS, keepalive_expiry=LLM_POOL_KEEPALIVE_SECONDS),
+        timeout=httpx.Timeout(LLM_DEADLINE_SECONDS, connect=LLM_CONNECT_TIMEOUT))
+    return AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+
+def _load_pulse():
+    if not is_linux: raise RuntimeError("PulseAudio events are only followed on Linux.")
+    try: return importlib.import_module("pulsectl_asyncio")
+    except (ImportError, OSError): raise ImportError("pulsectl-asyncio library (or libpulse) not found.")
+
+
+psutil_backend = LazyBackend("psutil", lambda: importlib.import_module("psutil"))
+psutil = psutil_backend.get()
+brightness_backend = LazyBackend("screen_brightness_control", lambda: importlib.import_module("screen_brightness_control"))
+distro_backend = LazyBackend("distro", _detect_distro)
+pulse_backend = LazyBackend("pulsectl_asyncio", _load_pulse)
+openai_backend = LazyBackend("openai", _load_openai_client)
 
 # --- Platform Specific Volume Control Libraries ---
-pycaw = None; pulsectl = None
-# ... (volume library loading as before) ...
+AudioUtilities = None
 if os_name == "Windows":
-    try: from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume; from comtypes import CLSCTX_ALL; pycaw = True
-    except ImportError: logging.warning("pycaw library not found.")
-elif is_linux:
-     try: import pulsectl_asyncio; pulsectl = True
-     except ImportError: logging.warning("pulsectl-asyncio library not found.")
+    try: from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume; from comtypes import CLSCTX_ALL
+    except ImportError: logging.warning("pycaw library not found. Windows volume control will not work.")
 
 # --- OpenAI Client Setup ---
-try:
-    from openai import AsyncOpenAI
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key: logging.error("OPENAI_API_KEY environment variable not set."); openai_available = False; client = None
-    else: client = AsyncOpenAI(api_key=api_key); openai_available = True
-except ImportError: logging.warning("openai library not found."); openai_available = False; client = None
+# openai_available means an API key is configured; the client itself is built by get_openai_client().
+openai_available = bool(os.getenv("OPENAI_API_KEY")); client = None
+if not openai_available: logging.error("OPENAI_API_KEY environment variable not set.")
+
+
+async def get_openai_client():
+    """The AsyncOpenAI client, built off the event loop on first use (None when unavailable)."""
+    global client, openai_available
+    if client is None and openai_available:
+        client = await openai_backend.aget()
+        openai_available = client is not None
+    return client
+
 
 
 # --- Server Configuration ---
-HOST = 'localhost'
-PORT = 8765
+HOST = os.getenv('DEVICE_ASSISTANT_HOST', 'localhost')
+PORT = int(os.getenv('DEVICE_ASSISTANT_PORT', '8765'))
 HISTORY_MAX_LEN = 8 # Increased slightly for potential error messages
+MAX_INFLIGHT_PER_CONNECTION = int(os.getenv("MAX_INFLIGHT_PER_CONNECTION", "16")) # Concurrent v2 requests per client
+# permessage-deflate costs a compressor per connection and CPU per frame; small high-rate frames on a
+# LAN are often cheaper uncompressed. The defaults match websockets' own deflate settings.
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "deflate").lower() # "deflate" or "none"
+WS_DEFLATE_WINDOW_BITS = int(os.getenv("WS_DEFLATE_WINDOW_BITS", "12")) # 9-15, memory per connection grows 2x per bit
+WS_DEFLATE_MEM_LEVEL = int(os.getenv("WS_DEFLATE_MEM_LEVEL", "5")) # 1-9
+
+# --- Metrics ---
+# Counters and latency histograms kept in plain dicts and rendered in the Prometheus text format on
+# GET /metrics (same host and port as the WebSocket server). Recording is a dict lookup, a bisect and
+# two additions, so instrumentation stays on in production.
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics") # Empty disables the endpoint
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EVENT_LOOP_LAG_INTERVAL = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.25")) # Seconds between lag probes
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterMetric:
+    """Monotonic counter, optionally labelled. `func` makes it a view over counters kept elsewhere."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        self.name, self.help_text, self.labels, self.func = name, help_text, tuple(labels), func
+        self.values = collections.defaultdict(float) # label values -> value
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def samples(self):
+        """Yields (label values, value); a callback may return a number or {label values: number}."""
+        if self.func is None: yield from self.values.items(); return
+        value = self.func()
+        if isinstance(value, dict): yield from value.items()
+        else: yield (), value
+
+    def render(self):
+        for label_values, value in self.samples():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value:g}"
+
+
+class GaugeMetric(CounterMetric):
+    """Value that can go up and down."""
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+
+class HistogramMetric:
+    """Fixed-bucket histogram per label set; observe() costs one bisect."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, tuple(labels), tuple(buckets)
+        self._series = {} # label values -> [per-bucket counts (last = +Inf), sum]
+
+    def observe(self, value, *label_values):
+        series = self._series.get(label_values)
+        if series is None: series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        for label_values, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {total:.6f}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics: raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, labels=(), func=None): return self._register(CounterMetric(name, help_text, labels, func))
+    def gauge(self, name, help_text, labels=(), func=None): return self._register(GaugeMetric(name, help_text, labels, func))
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS): return self._register(HistogramMetric(name, help_text, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+INTERPRET_SECONDS = metrics.histogram("device_assistant_interpret_seconds", "Time to interpret a command.", ("source",))
+INTERPRETATIONS = metrics.counter("device_assistant_interpretations_total", "Interpreted commands by source (rule, classifier, cache, llm, blocked, error).", ("source",))
+OPENAI_SECONDS = metrics.histogram("device_assistant_openai_request_seconds", "OpenAI chat completion latency.")
+OPENAI_TOKENS = metrics.counter("device_assistant_openai_tokens_total", "OpenAI tokens used.", ("kind",))
+INTENT_SECONDS = metrics.histogram("device_assistant_intent_seconds", "Intent handler execution time, including queueing for its pool.", ("intent",))
+INTENT_ERRORS = metrics.counter("device_assistant_intent_errors_total", "Intent handler calls that raised.", ("intent",))
+SEND_SECONDS = metrics.histogram("device_assistant_send_seconds", "Time to hand a frame to websocket.send.")
+ACTIVE_CONNECTIONS = metrics.gauge("device_assistant_active_connections", "Open WebSocket connections.")
+EVENT_LOOP_LAG = metrics.histogram("device_assistant_event_loop_lag_seconds", "How late the event loop wakes up a sleeping task.")
+
+
+async def _monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - EVENT_LOOP_LAG_INTERVAL))
+
+
+def _serve_http(connection, request):
+    """websockets process_request hook: answers GET /metrics and /ready, lets every other request upgrade to a WebSocket."""
+    path = request.path.partition("?")[0]
+    if READY_PATH and path == READY_PATH:
+        report = readiness()
+        response = connection.respond(http.HTTPStatus.OK if report["ready"] else http.HTTPStatus.SERVICE_UNAVAILABLE, json.dumps(report) + "\n")
+        content_type = "application/json"
+    elif METRICS_PATH and path == METRICS_PATH:
+        response = connection.respond(http.HTTPStatus.OK, metrics.render())
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+    else: return None
+    del response.headers["Content-Type"]
+    response.headers["Content-Type"] = content_type
+    return response
+
+
+# --- Interpretation Cache ---
+# LLM interpretations of repeated commands ("open firefox", "what's my battery") are persisted in a local
+# SQLite file and served from memory. Commands that depend on conversation context are never cached,
+# nor are shell commands unless INTERPRETATION_CACHE_ALLOW_SHELL=true.
+INTERPRETATION_CACHE_PATH = os.getenv("INTERPRETATION_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "interpretation_cache.db"))
+INTERPRETATION_CACHE_MAX_ENTRIES = int(os.getenv("INTERPRETATION_CACHE_MAX_ENTRIES", "2000"))
+INTERPRETATION_CACHE_ALLOW_SHELL = os.getenv("INTERPRETATION_CACHE_ALLOW_SHELL", "false").lower() == "true"
+_CONTEXT_DEPENDENT = re.compile(r"\b(?:it|its|that|this|these|those|them|they|again|same|previous|before|last one|instead|undo)\b")
+
+
+class InterpretationCache:
+    """Persistent LRU cache of LLM interpretations keyed on normalized command + context hash."""
+
+    def __init__(self, path, max_entries, allow_shell=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.allow_shell = allow_shell
+        self._entries = None # OrderedDict key -> interpretation JSON, least recently used first; see load()
+        self._db = None
+        self._lock = threading.Lock() # The SQLite connection is shared by the I/O pool threads
+        self._touches = set() # Tasks recording hits in the file; a hit does not wait for them
+        self.hits = self.misses = self.skipped = 0
+
+    @staticmethod
+    def normalize(command):
+        return " ".join(command.lower().split()).strip(" .!?")
+
+    async def key(self, command, history=None):
+        """Cache key for a command in its context, or None if the command must not be cached."""
+        normalized = self.normalize(command)
+        if not normalized or _CONTEXT_DEPENDENT.search(normalized): return None
+        # Only error feedback notes change how a self-contained command is interpreted
+        notes = [str(content) for _, content in (history or ()) if str(content).startswith("SYSTEM_NOTE")]
+        context = json.dumps([await distro_backend.aget(), ALLOW_SHELL_EXECUTION, notes])
+        return f"{normalized}\x1f{hashlib.sha256(context.encode()).hexdigest()[:16]}"
+
+    def cacheable(self, interpretation):
+        intent = interpretation.get("intent")
+        if intent in (None, "unknown"): return False
+        if intent == "batch": return all(isinstance(action, dict) and self.cacheable(action) for action in batch_actions(interpretation) or [None])
+        return intent != "run_shell_command" or self.allow_shell
+
+    async def load(self):
+        """Opens the SQLite file and reads the entries on the I/O pool, once (the startup warm-up does it early)."""
+        if self._entries is None: await run_blocking(self._load)
+
+    def _load(self):
+        with self._lock:
+            if self._entries is not None: return # Loaded by a concurrent call
+            entries = collections.OrderedDict()
+            try:
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("PRAGMA synchronous=NORMAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS interpretations (key TEXT PRIMARY KEY, interpretation TEXT NOT NULL, last_used REAL NOT NULL)")
+                rows = self._db.execute("SELECT key, interpretation FROM interpretations ORDER BY last_used DESC LIMIT ?", (self.max_entries,)).fetchall()
+                for key, interpretation in reversed(rows): entries[key] = interpretation
+            except sqlite3.Error as e:
+                logging.warning(f"Interpretation cache at {self.path} unavailable ({e}); caching in memory only.")
+                self._db = None
+            self._entries = entries
+
+    async def get(self, key):
+        await self.load()
+        stored = self._entries.get(key)
+        if stored is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        if self._db is not None:
+            task = asyncio.ensure_future(run_blocking(self._touch, key, time.time()))
+            self._touches.add(task); task.add_done_callback(self._touches.discard)
+        return json.loads(stored)
+
+    async def put(self, key, interpretation):
+        await self.load()
+        stored = json.dumps(interpretation)
+        self._entries[key] = stored
+        self._entries.move_to_end(key)
+        evicted = []
+        while len(self._entries) > self.max_entries: evicted.append(self._entries.popitem(last=False)[0])
+        if self._db is not None: await run_blocking(self._write, key, stored, evicted)
+
+    def _touch(self, key, last_used):
+        with self._lock:
+            try: self._db.execute("UPDATE interpretations SET last_used = ? WHERE key = ?", (last_used, key)); self._db.commit()
+            except sqlite3.Error as e: logging.warning(f"Interpretation cache update failed: {e}")
+
+    def _write(self, key, stored, evicted):
+        with self._lock:
+            try:
+                self._db.execute("INSERT OR REPLACE INTO interpretations (key, interpretation, last_used) VALUES (?, ?, ?)", (key, stored, time.time()))
+                self._db.executemany("DELETE FROM interpretations WHERE key = ?", [(k,) for k in evicted])
+                self._db.commit()
+            except sqlite3.Error as e: logging.warning(f"Interpretation cache write failed: {e}")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped,
+                "entries": len(self._entries or ()), "max_entries": self.max_entries}
 
-# --- OpenAI API Call Function (Unchanged) ---
-async def call_openai_api(command, history=None):
-    """
-    Calls the OpenAI API to interpret the command, considering conversation history and OS info.
-    """
-    if not openai_available or not client:
-        return {"intent": "unknown", "parameters": {"error": "OpenAI interpretation is unavailable."}}
 
-    logging.info(f"Querying LLM for: '{command}' with history and OS info.")
+interpretation_cache = InterpretationCache(INTERPRETATION_CACHE_PATH, INTERPRETATION_CACHE_MAX_ENTRIES, INTERPRETATION_CACHE_ALLOW_SHELL)
+metrics.counter("device_assistant_interpretation_cache_lookups_total", "Interpretation cache lookups by result.", ("result",),
+                func=lambda: {("hit",): interpretation_cache.hits, ("miss",): interpretation_cache.misses, ("skipped",): interpretation_cache.skipped})
 
-    # --- Updated System Prompt ---
+
+# --- Prompt Assembly ---
+# The system prompt only depends on server configuration, so it is built once and sent byte-for-byte
+# identical on every call (a stable prefix is what provider-side prompt caching matches on).
+# History is compacted to a token budget: shell results become short digests of their output and the
+# oldest entries are dropped first, so a long `cat` or `journalctl` does not ride along with every request.
+LLM_HISTORY_TOKEN_BUDGET = int(os.getenv("LLM_HISTORY_TOKEN_BUDGET", "600")) # 0 sends history verbatim
+LLM_HISTORY_ENTRY_MAX_CHARS = int(os.getenv("LLM_HISTORY_ENTRY_MAX_CHARS", "600"))
+SHELL_DIGEST_LINES = 3 # Lines kept from the start and the end of a shell command's output
+
+
+@functools.lru_cache(maxsize=8)
+def build_system_prompt(distro, allow_shell, linux):
+    """The system prompt for a server configuration."""
     run_shell_command_prompt = f"""
 - "run_shell_command": requires "command" (string, the exact shell command to execute).
     - Example (listing files): {{"intent": "run_shell_command", "parameters": {{"command": "ls -l /tmp"}}}}
     - Example (opening app): {{"intent": "run_shell_command", "parameters": {{"command": "firefox &"}}}}
     - Example (opening file): {{"intent": "run_shell_command", "parameters": {{"command": "xdg-open mydocument.pdf &"}}}}
-    - IMPORTANT: For opening GUI applications or files on Linux, ALWAYS append ' &' to the command string to run it in the background.""" if ALLOW_SHELL_EXECUTION and is_linux else ""
-    security_note = f"\n\nIMPORTANT SECURITY NOTE: The 'run_shell_command' intent is ENABLED via server configuration and allows executing arbitrary commands. Be extremely careful what you ask it to run." if ALLOW_SHELL_EXECUTION else "\n\nNOTE: The 'run_shell_command' intent is currently disabled by server configuration for security."
+    - IMPORTANT: For opening GUI applications or files on Linux, ALWAYS append ' &' to the command string to run it in the background.""" if allow_shell and linux else ""
+    security_note = f"\n\nIMPORTANT SECURITY NOTE: The 'run_shell_command' intent is ENABLED via server configuration and allows executing arbitrary commands. Be extremely careful what you ask it to run." if allow_shell else "\n\nNOTE: The 'run_shell_command' intent is currently disabled by server configuration for security."
 
     system_prompt = f"""
 You are a helpful assistant interpreting user commands for controlling a device or executing tasks on the target system.
-The target system is running: {distro_info}. Use this information to generate appropriate commands (e.g., package managers like apt/dnf/pacman if applicable).
+The target system is running: {distro}. Use this information to generate appropriate commands (e.g., package managers like apt/dnf/pacman if applicable).
 Identify the user's intent and extract relevant parameters based ONLY on the provided command AND PREVIOUS CONTEXT if relevant (e.g., pronouns like "it", or sequential commands based on previous output).
 If the previous command execution resulted in an error (indicated by a SYSTEM_NOTE in the history), analyze the error and try to generate a corrected command if the user's request implies fixing it.
 Respond ONLY with a valid JSON object containing 'intent' and 'parameters' keys. Do not add any explanation or surrounding text.
@@ -124,206 +443,1572 @@ Available intents and their parameters:
 - "set_volume": requires "level" (integer 0-100).
 - "get_volume": no parameters required.
 - "get_battery_status": no parameters required.
-- "get_cpu_usage": no parameters required.
+- "get_cpu_usage": optional "window" (number of seconds to average over, 1-15).
+- "get_cpu_per_core": no parameters required.
+- "get_cpu_averages": no parameters required (1, 5 and 15 second averages).
 - "get_memory_usage": no parameters required.
+- "get_system_snapshot": optional "include" (list of extra sections: "disk", "network", "temperatures", "processes"). Use when the user asks for an overview of the whole system.
+- "get_metric_history": optional "window" (seconds of history, default 3600), "points" (maximum points, default 120), "metrics" (subset of "cpu", "memory", "battery", "volume"). Use for past usage, trends or graphs.
 {run_shell_command_prompt}
 
+If the command asks for several actions at once, respond with a single "batch" intent listing them in order:
+{{"intent": "batch", "parameters": {{"actions": [{{"intent": "set_brightness", "parameters": {{"level": 30}}}}, {{"intent": "toggle_bluetooth", "parameters": {{"state": "off"}}}}]}}}}
+
 If the command is unclear, doesn't match an available intent, or lacks required parameters even considering context and error history,
 respond with: {{"intent": "unknown", "parameters": {{"error": "Command not understood or parameters missing."}}}}
 {security_note}
 """
-    messages = [{"role": "system", "content": system_prompt}]
-    if history:
-        for role, content in history:
-            messages.append({"role": role, "content": str(content)})
+    return system_prompt
+
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token for English and shell output)."""
+    return (len(text) + 3) // 4
+
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:limit - 20] + f"... [{len(text) - limit + 20} chars cut]"
+
+
+def _output_digest(text):
+    """First and last lines of a command's output plus its size."""
+    text = (text or "").strip()
+    if not text: return "(none)"
+    if len(text) <= LLM_HISTORY_ENTRY_MAX_CHARS // 3: return text
+    lines = [_truncate(line, 160) for line in text.splitlines()]
+    if len(lines) > 2 * SHELL_DIGEST_LINES:
+        lines = lines[:SHELL_DIGEST_LINES] + [f"... {len(lines) - 2 * SHELL_DIGEST_LINES} lines omitted ..."] + lines[-SHELL_DIGEST_LINES:]
+    return f"{len(text)} chars, {text.count(chr(10)) + 1} lines:\n" + "\n".join(lines)
+
+
+@functools.lru_cache(maxsize=256) # History entries are immutable strings re-sent on every call
+def _compact_history_entry(content):
+    """Replaces a JSON-dumped shell result with a digest and truncates everything else."""
+    if content.startswith("{"):
+        try: result = json.loads(content)
+        except json.JSONDecodeError: result = None
+        if isinstance(result, dict) and "command" in result and ("stdout" in result or "stderr" in result):
+            status = "was cancelled" if result.get("cancelled") else ("succeeded" if result.get("success") else "failed")
+            digest = f"Shell command `{result['command']}` {status} (exit code {result.get('exit_code')})."
+            if result.get("stdout"): digest += f"\nStdout: {_output_digest(result['stdout'])}"
+            if result.get("stderr") or result.get("error_message"): digest += f"\nStderr: {_output_digest(result.get('stderr') or result.get('error_message'))}"
+            return _truncate(digest, LLM_HISTORY_ENTRY_MAX_CHARS)
+    return _truncate(content, LLM_HISTORY_ENTRY_MAX_CHARS)
+
+
+def compact_history(history, budget=None):
+    """Compacted (role, content) history within `budget` estimated tokens, keeping the newest entries."""
+    budget = LLM_HISTORY_TOKEN_BUDGET if budget is None else budget
+    if not budget: return [(role, str(content)) for role, content in history]
+    kept, used, full = [], 0, False
+    for role, content in reversed(history):
+        content = _compact_history_entry(str(content))
+        cost = estimate_tokens(content) + 4 # Per-message overhead
+        # Error feedback notes are always kept: they are what lets the LLM correct a failed command
+        if not content.startswith("SYSTEM_NOTE"):
+            full = full or used + cost > budget
+            if full: continue
+        kept.append((role, content)); used += cost
+    kept.reverse()
+    return kept
+
+
+def build_llm_messages(command, distro, history=None):
+    """Chat messages for interpreting `command`: cached system prompt, compacted history, then the command.
+
+    `distro` is the resolved distro_backend value; callers on the event loop get it with `await distro_backend.aget()`.
+    """
+    messages = [{"role": "system", "content": build_system_prompt(distro, ALLOW_SHELL_EXECUTION, is_linux)}]
+    for role, content in compact_history(history or ()):
+        messages.append({"role": role, "content": content})
     messages.append({"role": "user", "content": command})
+    return messages
+
+
+# --- LLM Gateway ---
+# Every OpenAI call goes through llm_gateway, which bounds how long it takes and how many run at once:
+# - The client shares one httpx pool of LLM_POOL_CONNECTIONS kept-alive connections (see _load_openai_client), so
+#   calls reuse warm TLS connections; the SDK's own retries are off in favour of the ones below.
+# - Each call has LLM_DEADLINE_SECONDS in total. Transient failures (connection errors, 408/409/429, 5xx) are
+#   retried up to LLM_RETRIES times with jittered backoff while the deadline allows.
+# - With LLM_HEDGE on, a request still unanswered after the p95 of recent latencies (at least LLM_HEDGE_MIN_SECONDS)
+#   is sent a second time and the first answer wins. Hedges only use free LLM_MAX_CONCURRENCY slots.
+# - A circuit breaker opens after LLM_BREAKER_FAILURES failed calls in a row. While it is open calls fail at once and
+#   interpretation falls back to the rule matcher; after LLM_BREAKER_COOLDOWN seconds one trial call decides
+#   whether it closes again.
+# - LLM_MAX_CONCURRENCY requests are in flight across all connections; the rest wait up to LLM_QUEUE_TIMEOUT.
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "20"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "1"))
+LLM_RETRY_BACKOFF = float(os.getenv("LLM_RETRY_BACKOFF", "0.25")) # Seconds before the first retry; doubles per retry
+LLM_HEDGE = os.getenv("LLM_HEDGE", "false").lower() == "true" # Off by default: a hedge is a second billed request
+LLM_HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", "1.0"))
+LLM_HEDGE_MIN_SAMPLES = 20 # Latencies needed before the p95 is trusted
+LLM_LATENCY_WINDOW = 200 # Recent successful request latencies the p95 is taken over
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+LLM_POOL_CONNECTIONS = int(os.getenv("LLM_POOL_CONNECTIONS", "20"))
+LLM_POOL_KEEPALIVE_SECONDS = float(os.getenv("LLM_POOL_KEEPALIVE_SECONDS", "60"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4")) # 0 = unlimited
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+
+LLM_CALLS = metrics.counter("device_assistant_llm_gateway_calls_total", "LLM gateway calls by outcome (ok, error, timeout, busy, circuit_open).", ("outcome",))
+LLM_ATTEMPTS = metrics.counter("device_assistant_llm_attempts_total", "Requests sent to OpenAI by kind (first, retry, hedge) and result (ok, error, cancelled).", ("kind", "result"))
+LLM_HEDGES_WON = metrics.counter("device_assistant_llm_hedges_won_total", "Calls answered by their hedge request rather than the original.")
+LLM_BREAKER_TRIPS = metrics.counter("device_assistant_llm_breaker_trips_total", "Times the LLM circuit breaker opened.")
+
+
+class LLMUnavailable(RuntimeError):
+    """The gateway refused a call without sending it: the breaker is open or no concurrency slot freed up."""
+
+
+class ConcurrencyLimit:
+    """A global cap on concurrent calls; callers wait up to `timeout` for a free slot."""
+
+    def __init__(self, limit, timeout):
+        self.limit, self.timeout = limit, timeout
+        self._semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self.active = self.waiting = self.rejected = 0
+
+    async def acquire(self):
+        """Takes a slot; returns False (counted as rejected) if none frees up within the timeout."""
+        if self._semaphore is not None:
+            self.waiting += 1
+            try: await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError: self.rejected += 1; return False
+            finally: self.waiting -= 1
+        self.active += 1
+        return True
+
+    async def try_acquire(self):
+        """Takes a slot only if one is free right now."""
+        if self._semaphore is not None:
+            if self._semaphore.locked(): return False
+            await self._semaphore.acquire() # Returns at once: a slot is free
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        if self._semaphore is not None: self._semaphore.release()
+
+
+def _retryable(error):
+    """Whether an OpenAI error is transient, by the SDK's own rule: connection errors, timeouts, 408/409/429 and 5xx."""
+    status = getattr(error, "status_code", None)
+    if status is not None: return status in (408, 409, 429) or status >= 500
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError") or isinstance(error, OSError)
+
+
+class LLMGateway:
+    """Deadlines, retries, hedging, a circuit breaker and a concurrency limit around chat completions."""
+
+    def __init__(self):
+        self.limit = ConcurrencyLimit(LLM_MAX_CONCURRENCY, LLM_QUEUE_TIMEOUT)
+        self.latencies = collections.deque(maxlen=LLM_LATENCY_WINDOW) # Seconds, successful requests only
+        self.failures = 0 # Failed calls in a row
+        self.open_until = 0.0 # Monotonic time the breaker may half-open; 0 while closed
+        self.trial = False # A half-open trial call is in flight
+
+    @property
+    def state(self):
+        if not self.open_until: return "closed"
+        return "open" if time.monotonic() < self.open_until or self.trial else "half_open"
+
+    def available(self):
+        """False while the breaker is open, so callers can use a local fallback instead."""
+        return self.state != "open"
+
+    def hedge_after(self):
+        """Seconds after which a pending request is hedged, or None when hedging is off or not calibrated yet."""
+        if not LLM_HEDGE or len(self.latencies) < LLM_HEDGE_MIN_SAMPLES: return None
+        ordered = sorted(self.latencies)
+        return max(LLM_HEDGE_MIN_SECONDS, ordered[int(0.95 * (len(ordered) - 1))])
+
+    async def complete(self, llm, **request):
+        """Returns `llm.chat.completions.create(**request)`.
+
+        Raises LLMUnavailable when refused, asyncio.TimeoutError past the deadline, or the last API error.
+        """
+        return await self._call(lambda: self._with_retries(lambda kind: self._hedged(llm, request, kind)))
+
+    async def stream(self, llm, on_delta, **request):
+        """Streams the completion, passing each piece of content to `on_delta`; returns (content, usage).
+
+        Streams are not hedged (two would interleave) and are retried only until the first piece arrives.
+        Raises like complete().
+        """
+        received = False
+        def forward(text):
+            nonlocal received
+            received = True; on_delta(text)
+        return await self._call(lambda: self._with_retries(lambda kind: self._streamed(llm, request, kind, forward), lambda: not received))
+
+    async def _call(self, send):
+        """Runs `send()` under the breaker and the deadline, counting the outcome."""
+        state = self.state
+        if state == "open": LLM_CALLS.inc("circuit_open"); raise LLMUnavailable("The AI service is failing; try again later.")
+        if state == "half_open": self.trial = True
+        try: response = await asyncio.wait_for(send(), LLM_DEADLINE_SECONDS)
+        except LLMUnavailable: LLM_CALLS.inc("busy"); raise
+        except asyncio.TimeoutError: LLM_CALLS.inc("timeout"); self._record(False); raise
+        except Exception: LLM_CALLS.inc("error"); self._record(False); raise
+        finally: self.trial = False
+        LLM_CALLS.inc("ok"); self._record(True)
+        return response
+
+    def _record(self, ok):
+        if ok:
+            if self.open_until: logging.info("LLM circuit breaker closed.")
+            self.failures = 0; self.open_until = 0.0
+            return
+        self.failures += 1
+        if self.failures >= LLM_BREAKER_FAILURES or self.open_until: # A failed trial reopens it
+            self.open_until = time.monotonic() + LLM_BREAKER_COOLDOWN
+            LLM_BREAKER_TRIPS.inc()
+            logging.warning(f"LLM circuit breaker open for {LLM_BREAKER_COOLDOWN:g}s after {self.failures} failed calls in a row.")
+
+    async def _with_retries(self, send, may_retry=lambda: True):
+        deadline = time.monotonic() + LLM_DEADLINE_SECONDS
+        for attempt in range(LLM_RETRIES + 1):
+            try: return await send("retry" if attempt else "first")
+            except LLMUnavailable: raise
+            except Exception as e:
+                delay = LLM_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+                if attempt == LLM_RETRIES or not _retryable(e) or not may_retry() or time.monotonic() + delay >= deadline: raise
+                logging.warning(f"OpenAI request failed ({e!r}); retrying in {delay:.2f}s.")
+                await asyncio.sleep(delay)
+
+    async def _hedged(self, llm, request, kind):
+        """Sends the request, and a copy once it is slower than hedge_after(); the first success wins."""
+        if not await self.limit.acquire(): raise LLMUnavailable("The AI service is busy; try again shortly.")
+        send = lambda: llm.chat.completions.create(**request)
+        first = self._start(kind, send)
+        pending, error = {first}, None
+        hedge_after = self.hedge_after()
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+                if not done: # Still unanswered at the hedge threshold
+                    hedge_after = None
+                    if await self.limit.try_acquire(): pending.add(self._start("hedge", send))
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first: LLM_HEDGES_WON.inc()
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending: task.cancel()
+
+    async def _streamed(self, llm, request, kind, on_delta):
+        if not await self.limit.acquire(): raise LLMUnavailable("The AI service is busy; try again shortly.")
+        return await self._start(kind, lambda: self._consume(llm, request, on_delta))
+
+    @staticmethod
+    async def _consume(llm, request, on_delta):
+        parts, usage = [], None
+        stream = await llm.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None) or usage
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text: parts.append(text); on_delta(text)
+        return "".join(parts), usage
+
+    def _start(self, kind, send):
+        """Runs _attempt as a task holding a concurrency slot (taken by the caller) until the task ends.
+
+        The slot is released by a done callback, so a task cancelled before its first step releases it too.
+        """
+        task = asyncio.ensure_future(self._attempt(kind, send))
+        task.add_done_callback(lambda _: self.limit.release())
+        return task
+
+    async def _attempt(self, kind, send):
+        """One request made by `send()`."""
+        started = time.perf_counter(); result = "error"
+        try:
+            response = await send()
+            result = "ok"; self.latencies.append(time.perf_counter() - started)
+            return response
+        except asyncio.CancelledError: result = "cancelled"; raise
+        finally: LLM_ATTEMPTS.inc(kind, result); OPENAI_SECONDS.observe(time.perf_counter() - started)
+
+
+llm_gateway = LLMGateway()
+metrics.gauge("device_assistant_llm_calls", "OpenAI requests in progress (active) and waiting for a slot (waiting).", ("state",),
+              func=lambda: {("active",): llm_gateway.limit.active, ("waiting",): llm_gateway.limit.waiting})
+metrics.counter("device_assistant_llm_rejected_total", "OpenAI calls refused after waiting LLM_QUEUE_TIMEOUT for a slot.", func=lambda: llm_gateway.limit.rejected)
+metrics.gauge("device_assistant_llm_breaker_state", "1 for the LLM circuit breaker's current state (closed, open, half_open).", ("state",),
+              func=lambda: {(state,): int(llm_gateway.state == state) for state in ("closed", "open", "half_open")})
+
+
+# --- OpenAI API Call Function ---
+async def call_openai_api(command, history=None, session=None, on_partial=None):
+    """
+    Calls the OpenAI API to interpret the command, considering conversation history and OS info.
+    Repeated self-contained commands are answered from the interpretation cache. Calls that miss it are
+    charged to the session's "llm" rate limit and go through llm_gateway. With LLM_STREAMING, partial
+    interpretations are passed to `on_partial` as they stream in (see InterpretationStream).
+    """
+    llm = await get_openai_client()
+    if llm is None:
+        INTERPRETATIONS.inc("error")
+        return {"intent": "unknown", "parameters": {"error": "OpenAI interpretation is unavailable."}}
+
+    distro = await distro_backend.aget() # Part of the cache key and the system prompt
+    cache_key = await interpretation_cache.key(command, history)
+    if cache_key is None: interpretation_cache.skipped += 1
+    else:
+        cached = await interpretation_cache.get(cache_key)
+        if cached is not None:
+            logging.debug(f"Interpretation cache hit for: '{command}'")
+            INTERPRETATIONS.inc("cache")
+            return cached
+
+    limited = session.rate_limited("llm") if session is not None else None
+    if limited: return {"intent": "unknown", "parameters": {"error": limited}}
+    logging.debug(f"Querying LLM for: '{command}' with history and OS info.")
+    messages = build_llm_messages(command, distro, history)
 
     try:
-        response = await client.chat.completions.create(
+        request = dict(
             model="o4-mini",
             # model="gpt-4o",
             messages=messages,
             response_format={ "type": "json_object" }
         )
-        content = response.choices[0].message.content
+        if LLM_STREAMING:
+            content, usage = await llm_gateway.stream(llm, InterpretationStream(on_partial or (lambda partial, settled: None)).feed, **request)
+        else:
+            response = await llm_gateway.complete(llm, **request)
+            content, usage = response.choices[0].message.content, getattr(response, "usage", None)
+        if usage is not None:
+            OPENAI_TOKENS.inc("prompt", amount=usage.prompt_tokens or 0); OPENAI_TOKENS.inc("completion", amount=usage.completion_tokens or 0)
+            details = getattr(usage, "prompt_tokens_details", None)
+            if details is not None: OPENAI_TOKENS.inc("cached_prompt", amount=getattr(details, "cached_tokens", 0) or 0)
         interpretation = json.loads(content)
 
-        if not ALLOW_SHELL_EXECUTION and interpretation.get("intent") == "run_shell_command":
+        if not ALLOW_SHELL_EXECUTION and (interpretation.get("intent") == "run_shell_command" or any(
+                isinstance(action, dict) and action.get("intent") == "run_shell_command" for action in batch_actions(interpretation) or ())):
              logging.warning("LLM attempted to run shell command while disabled. Blocking.")
+             INTERPRETATIONS.inc("blocked")
              return {"intent": "unknown", "parameters": {"error": "Shell command execution is disabled by server configuration."}}
 
         if isinstance(interpretation, dict) and "intent" in interpretation and "parameters" in interpretation:
-             logging.info(f"OpenAI interpretation successful: {interpretation}")
+             logging.debug(f"OpenAI interpretation successful: {interpretation}")
+             INTERPRETATIONS.inc("llm")
+             if cache_key is not None and interpretation_cache.cacheable(interpretation):
+                 await interpretation_cache.put(cache_key, interpretation)
              return interpretation
         else:
              logging.error(f"OpenAI response is not valid JSON or lacks required keys: {content}")
+             INTERPRETATIONS.inc("error")
              return {"intent": "unknown", "parameters": {"error": "Failed to interpret command via AI (invalid format)."}}
+    except LLMUnavailable as e:
+        INTERPRETATIONS.inc("error")
+        return {"intent": "unknown", "parameters": {"error": str(e)}}
+    except asyncio.TimeoutError:
+        logging.warning(f"OpenAI did not answer '{command}' within {LLM_DEADLINE_SECONDS:g}s.")
+        INTERPRETATIONS.inc("error")
+        return {"intent": "unknown", "parameters": {"error": f"The AI service did not answer within {LLM_DEADLINE_SECONDS:g}s."}}
     except Exception as e:
         logging.exception(f"An unexpected error occurred during OpenAI API call: {e}")
+        INTERPRETATIONS.inc("error")
         return {"intent": "unknown", "parameters": {"error": f"Unexpected AI error: {e}"}}
 
 
-# --- Combined Command Interpretation (Unchanged) ---
-async def interpret_command_with_llm(command, history=None):
+# --- Streamed Interpretation ---
+# With LLM_STREAMING on, the completion is streamed and parsed as it arrives, so work can start before the
+# model finishes: a single intent is dispatched as soon as "intent" and "parameters" are both complete and its
+# parameters bind to the handler, and each action of a batch is dispatched as soon as its object closes (in
+# the batch's lane order). Shell commands are never started early; they wait for the full interpretation.
+# The complete interpretation always wins: early work it does not confirm is cancelled (EarlyDispatch.settle).
+# v2 requests that need the LLM get a {"type": "progress", "id": ..., "stage": "interpreting"} frame first.
+LLM_STREAMING = os.getenv("LLM_STREAMING", "false").lower() == "true"
+EARLY_DISPATCHES = metrics.counter("device_assistant_llm_early_dispatches_total", "Intents and batch actions started while the interpretation was still streaming, and those cancelled because the final interpretation differed.", ("kind",))
+
+
+class InterpretationStream:
+    """Incremental parser for a streamed {"intent": ..., "parameters": ...} object.
+
+    Tracks strings and nesting over the new text only. Whenever a top-level member may have completed, the text
+    so far is closed and parsed, and `on_partial(partial, settled)` gets the object if that parsed: `settled`
+    means every member in it is complete. Each closed element of a batch's "actions" list is reported too, with
+    `settled` False, as only that list inside "parameters" is known complete then.
     """
-    Interprets the command using hardcoded rules first, then falls back to OpenAI API (passing history).
+
+    def __init__(self, on_partial):
+        self.on_partial = on_partial
+        self.text = ""
+        self.start = None # Index of the opening brace
+        self.stack = [] # Open containers, "{" or "["
+        self.in_string = self.escaped = False
+        self.members = 0 # Members in the last settled partial, to report each change once
+
+    def feed(self, text):
+        offset = len(self.text)
+        self.text += text
+        for i, char in enumerate(text, offset):
+            if self.in_string:
+                if self.escaped: self.escaped = False
+                elif char == "\\": self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if len(self.stack) == 1: self._emit(i + 1, "}") # A string value may have ended
+            elif char == '"': self.in_string = True
+            elif char in "{[":
+                if self.start is None and char == "{": self.start = i
+                if self.start is not None: self.stack.append(char)
+            elif char in "}]" and self.stack:
+                self.stack.pop()
+                if len(self.stack) <= 1: self._emit(i + 1, "}" * len(self.stack))
+                elif self.stack == ["{", "{", "["]: self._emit(i + 1, "]}}", settled=False) # An action closed
+            elif char == "," and len(self.stack) == 1: self._emit(i, "}")
+
+    def _emit(self, end, closers, settled=True):
+        try: partial = json.loads(self.text[self.start:end] + closers)
+        except json.JSONDecodeError: return # Ended on a key, or the text is not the expected shape
+        if not isinstance(partial, dict): return
+        if settled:
+            if len(partial) == self.members: return
+            self.members = len(partial)
+        self.on_partial(partial, settled)
+
+
+def _bind_parameters(intent, parameters):
+    """Whether the parameters are a complete, valid argument set for the intent's handler."""
+    try: inspect.signature(INTENT_HANDLERS[intent]).bind(**parameters); return True
+    except TypeError: return False
+
+
+class EarlyDispatch:
+    """Starts what a streamed interpretation asks for while it is still streaming (see above).
+
+    Single intents run as a task on run_intent, charged to the session's rate limit like process_message would;
+    batch actions are chained per lane exactly as execute_batch does, which then adopts them.
     """
-    logging.info(f"Interpreting command: '{command}'")
-    command_lower = command.lower()
-    cl = command.lower()
-    interpretation = None
-    # --- 1. Hardcoded Rules ---
-    if command_lower == "get cpu usage": interpretation = {"intent": "get_cpu_usage", "parameters": {}}
-    elif command_lower == "get memory usage": interpretation = {"intent": "get_memory_usage", "parameters": {}}
-    elif command_lower == "get_volume": interpretation = {"intent": "get_volume", "parameters": {}}
-    elif command_lower == "get_battery_status": interpretation = {"intent": "get_battery_status", "parameters": {}}
-    elif "wifi" in cl and "status" in cl:
-        interpretation = {"intent": "get_wifi_status", "parameters": {}}
-    elif "bluetooth" in cl and "status" in cl:
-        interpretation = {"intent": "get_bluetooth_status", "parameters": {}}
-    elif "brightness" in command_lower: # ... (brightness logic)
-        level = None; words = command_lower.split(); # ... find level ...
-        if level is not None: interpretation = {"intent": "set_brightness", "parameters": {"level": max(0, min(100, level))}}
-    elif "volume" in command_lower or "sound" in command_lower or "mute" in command_lower: # ... (volume logic)
-        level = None; # ... find level or mute ...
-        if level is not None: interpretation = {"intent": "set_volume", "parameters": {"level": max(0, min(100, level))}}
-    elif "wi-fi" in command_lower or "wifi" in command_lower: # ... (wifi logic)
-        if "on" in command_lower or "enable" in command_lower: interpretation = {"intent": "toggle_wifi", "parameters": {"state": "on"}}
-        elif "off" in command_lower or "disable" in command_lower: interpretation = {"intent": "toggle_wifi", "parameters": {"state": "off"}}
-    elif "bluetooth" in command_lower: # ... (bluetooth logic)
-        if "on" in command_lower or "enable" in command_lower: interpretation = {"intent": "toggle_bluetooth", "parameters": {"state": "on"}}
-        elif "off" in command_lower or "disable" in command_lower: interpretation = {"intent": "toggle_bluetooth", "parameters": {"state": "off"}}
-    elif "battery" in command_lower or "charging" in command_lower or "power level" in command_lower: interpretation = {"intent": "get_battery_status", "parameters": {}}
-    elif "cpu" in command_lower and "usage" in command_lower: interpretation = {"intent": "get_cpu_usage", "parameters": {}}
-    elif ("memory" in command_lower or "ram" in command_lower) and "usage" in command_lower: interpretation = {"intent": "get_memory_usage", "parameters": {}}
-
-    # --- 2. Fallback to OpenAI API ---
-    if interpretation:
-        logging.info(f"Command matched by hardcoded rule: {interpretation}")
+
+    def __init__(self, session):
+        self.session = session
+        self.intent = None # The dispatched intent ("batch" for actions)
+        self.parameters = None
+        self.actions = [] # Dispatched batch actions, a prefix of the batch
+        self.tasks = [] # One per dispatched intent or action
+        self._lanes = {} # intent -> task of its lane's latest action
+        self._blocked = False # A batch action that may not start early was reached
+
+    def __call__(self, partial, settled):
+        intent = partial.get("intent")
+        if intent == "batch": self._dispatch_actions(batch_actions(partial) or ())
+        elif settled and self.intent is None and isinstance(partial.get("parameters"), dict):
+            parameters = partial["parameters"]
+            if intent not in INTENT_HANDLERS or intent == "run_shell_command" or not _bind_parameters(intent, parameters): return
+            self.intent, self.parameters = intent, parameters
+            limited = self.session.rate_limited(request_class(intent))
+            if limited: task = asyncio.get_running_loop().create_future(); task.set_result(limited)
+            else: task = asyncio.ensure_future(run_intent(intent, parameters))
+            self.tasks.append(task); EARLY_DISPATCHES.inc("intent")
+            logging.debug(f"Dispatched '{intent}' while the interpretation was streaming.")
+
+    def _dispatch_actions(self, actions):
+        if self.intent not in (None, "batch"): return
+        self.intent = "batch"
+        for action in actions[len(self.actions):BATCH_MAX_ITEMS]:
+            if self._blocked: return
+            if not (isinstance(action, dict) and action.get("intent") in INTENT_HANDLERS and action["intent"] != "run_shell_command"
+                    and isinstance(action.get("parameters"), dict) and _bind_parameters(action["intent"], action["parameters"])):
+                self._blocked = True; return # This and later actions wait for the full interpretation
+            self.actions.append(action)
+            task = asyncio.ensure_future(_run_batch_action_after(self._lanes.get(action["intent"]), self.session, action))
+            self._lanes[action["intent"]] = task
+            self.tasks.append(task); EARLY_DISPATCHES.inc("batch_action")
+
+    def settle(self, interpretation):
+        """Reconciles what already started with the final interpretation, which always wins, and returns it.
+
+        Tasks it confirms stay in `tasks`: the single intent if it is unchanged, or the dispatched batch actions
+        that are a prefix of its actions. The others are cancelled (e.g. when the stream failed or the model
+        revised an action); a write that already reached the device is not undone.
+        """
+        if not self.tasks: return interpretation
+        if self.intent == "batch":
+            actions = (batch_actions(interpretation) or []) if interpretation.get("intent") == "batch" else []
+            kept = 0
+            while kept < min(len(actions), len(self.actions)) and actions[kept] == self.actions[kept]: kept += 1
+        else: kept = int(interpretation.get("intent") == self.intent and interpretation.get("parameters") == self.parameters)
+        if kept < len(self.tasks):
+            for task in self.tasks[kept:]: task.cancel()
+            EARLY_DISPATCHES.inc("cancelled", amount=len(self.tasks) - kept)
+            logging.warning(f"Final interpretation {interpretation} differs from the streamed one; cancelled {len(self.tasks) - kept} early task(s).")
+            self.tasks = self.tasks[:kept]
         return interpretation
+
+
+# --- Fast-Path Intent Matcher ---
+# Table of rules compiled once into a single regex. Rules are tried in table order (each alternative is
+# anchored at the start and scans forward), so more specific rules must come first. Named groups
+# `level`, `state` and `window` become parameters; `defaults` supplies fixed ones.
+FAST_MATCH_THRESHOLD = float(os.getenv("FAST_MATCH_THRESHOLD", "0.75")) # Below this, ask the LLM
+_WIFI = r"\bwi-?fi\b"
+_ON_OFF = r"(?P<state>on|off|enabled?|disabled?)"
+# A whole number of at most 3 digits that is not a duration ("after 5 minutes")
+_LEVEL = r"(?P<level>\d{1,3})\b(?!\s*(?:min(?:ute)?s?|sec(?:ond)?s?|s|h(?:ou)?rs?|h|ms|days?)\b)\s*(?:%|percent)?"
+_ABSOLUTE = r"(?!.*\b(?:by|up|down|increase|decrease)\b)" # Relative changes ("volume up by 10") are left to the LLM
+
+IntentRule = collections.namedtuple("IntentRule", "intent pattern confidence defaults")
+INTENT_RULES = [
+    # Exact commands sent by the quick-settings dashboard
+    IntentRule("get_cpu_usage", r"get cpu usage$", 1.0, {}),
+    IntentRule("get_memory_usage", r"get memory usage$", 1.0, {}),
+    IntentRule("get_volume", r"get_volume$", 1.0, {}),
+    IntentRule("get_battery_status", r"get_battery_status$", 1.0, {}),
+    IntentRule("get_system_snapshot", r"(?:get )?(?:system[ _])?snapshot$|get_system_snapshot$", 1.0, {}),
+    IntentRule("get_metric_history", r"get[ _]metric[ _]history$", 1.0, {}),
+    # Status queries (before toggles: "is wifi on?" asks, it does not switch)
+    IntentRule("get_wifi_status", rf"(?=.*{_WIFI})(?=.*\bstatus\b)", 0.95, {}),
+    IntentRule("get_bluetooth_status", r"(?=.*\bbluetooth\b)(?=.*\bstatus\b)", 0.95, {}),
+    IntentRule("get_wifi_status", rf"(?:is|are)\b.*{_WIFI}.*\b(?:on|off|enabled|disabled|connected)\b\s*\??$", 0.85, {}),
+    IntentRule("get_bluetooth_status", r"(?:is|are)\b.*\bbluetooth\b.*\b(?:on|off|enabled|disabled)\b\s*\??$", 0.85, {}),
+    # Setters with a level
+    IntentRule("set_brightness", rf"{_ABSOLUTE}.*?\bbrightness\b.*?\b{_LEVEL}", 0.95, {}),
+    IntentRule("set_brightness", rf"{_ABSOLUTE}.*?\b{_LEVEL}\s*(?:brightness)\b", 0.9, {}),
+    IntentRule("set_brightness", r".*?\b(?:max(?:imum)?|full)\s+brightness\b", 0.9, {"level": 100}),
+    IntentRule("set_volume", rf"{_ABSOLUTE}.*?\b(?:volume|sound)\b.*?\b{_LEVEL}", 0.95, {}),
+    IntentRule("set_volume", rf"{_ABSOLUTE}.*?\b{_LEVEL}\s*(?:volume)\b", 0.9, {}),
+    IntentRule("set_volume", r".*?\bmute\b", 0.9, {"level": 0}),
+    IntentRule("get_volume", r".*?\b(?:what(?:'s| is)|get|current|show|how loud)\b.*\b(?:volume|sound)\b", 0.85, {}),
+    # Radio toggles
+    IntentRule("toggle_wifi", rf".*?{_WIFI}.*?\b{_ON_OFF}\b", 0.9, {}),
+    IntentRule("toggle_wifi", rf".*?\b{_ON_OFF}\b.*?{_WIFI}", 0.9, {}),
+    IntentRule("toggle_bluetooth", rf".*?\bbluetooth\b.*?\b{_ON_OFF}\b", 0.9, {}),
+    IntentRule("toggle_bluetooth", rf".*?\b{_ON_OFF}\b.*?\bbluetooth\b", 0.9, {}),
+    # Read-only metrics
+    IntentRule("get_battery_status", r".*?\b(?:battery|charging|power level)\b", 0.9, {}),
+    IntentRule("get_cpu_per_core", r"(?=.*\b(?:cpu|processor)\b)(?=.*\b(?:per core|each core|cores)\b)", 0.9, {}),
+    IntentRule("get_cpu_averages", r"(?=.*\b(?:cpu|processor)\b)(?=.*\baverages?\b)(?!.*\b(?:over|last|past)\s+\d)", 0.9, {}),
+    IntentRule("get_cpu_usage", r".*?\b(?:cpu|processor)\b.*?\b(?:over|last|past)\s+(?P<window>\d{1,2})\s*s(?:ec(?:ond)?s?)?\b", 0.9, {}),
+    IntentRule("get_cpu_usage", r"(?=.*\b(?:cpu|processor)\b)(?=.*\b(?:usage|load|utili[sz]ation|busy)\b)", 0.9, {}),
+    IntentRule("get_memory_usage", r"(?=.*\b(?:memory|ram)\b)(?=.*\b(?:usage|used|use|free)\b)", 0.9, {}),
+    # Bare mentions: plausible but ambiguous, so only used when the LLM is unavailable
+    IntentRule("get_cpu_usage", r".*?\bcpu\b", 0.6, {}),
+    IntentRule("get_memory_usage", r".*?\b(?:memory|ram)\b", 0.6, {}),
+    IntentRule("get_volume", r".*?\bvolume\b", 0.5, {}),
+]
+COMPOUND_PARTIAL_CONFIDENCE = 0.5
+# A bare "and" only separates commands when an action or a device follows it: "volume 20 and wifi off" is two
+# commands, "mute and unmute" one phrase
+_COMMAND_STARTERS = (r"turn|switch|set|put|make|bring|mute|enable|disable|activate|deactivate|dim|brighten|raise|lower|increase|decrease"
+                     r"|open|close|start|stop|restart|connect|disconnect|reconnect|kill|show|check|tell|get|give|run|play|install|launch"
+                     r"|brightness|screen|display|backlight|volume|sound|audio|speakers?|wi-?fi|wlan|wireless|bluetooth|bt"
+                     r"|battery|cpu|processor|memory|ram")
+_COMMAND_SEPARATORS = re.compile(rf"\s*(?:[,;]|\band then\b|\bthen\b|\band\b(?=\s+(?:{_COMMAND_STARTERS})\b))\s*")
+_STRONG_SEPARATORS = re.compile(r"[,;]|\bthen\b")
+# Questions and status checks ("check if the wifi is enabled", "is volume 50?") never become set_/toggle_ writes
+_QUESTION = re.compile(r"\?|^(?:is|are|am|was|were|do|does|did|has|have|what(?:'s)?|which|how|check|tell me|show)\b|\b(?:whether|if|status)\b")
+_STATE_VALUES = {"on": "on", "enable": "on", "enabled": "on", "off": "off", "disable": "off", "disabled": "off"}
+_PARAM_CONVERTERS = {
+    "level": lambda v: max(0, min(100, int(v))),
+    "state": lambda v: _STATE_VALUES[v],
+    "window": float,
+}
+
+
+class IntentMatcher:
+    """Matches commands against INTENT_RULES with one compiled regex; returns (interpretation, confidence)."""
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    @functools.cached_property
+    def _regex(self):
+        # Compiled on first use (or by the startup warm-up): it is the largest pattern in the module
+        alternatives = []
+        for index, rule in enumerate(self.rules):
+            # Group names must be unique across the combined pattern, so prefix them with the rule index
+            pattern = re.sub(r"\(\?P<(\w+)>", rf"(?P<r{index}_\1>", rule.pattern)
+            alternatives.append(f"(?P<r{index}>{pattern})")
+        return re.compile("|".join(alternatives))
+
+    def match(self, command):
+        """Matches a command; compound commands ("brightness 30, volume 20") become one batch interpretation.
+
+        A compound is only used when every part matches on its own with at least FAST_MATCH_THRESHOLD. Otherwise
+        a match of the whole command would drop the unmatched parts, so it is capped at COMPOUND_PARTIAL_CONFIDENCE
+        and left to the LLM when one is available. In a phrase joined only by "and", a part that does not match on
+        its own is retried with the words the last part ends in ("cpu and memory usage": "cpu usage", "memory usage").
+        """
+        normalized = " ".join(command.lower().split())
+        parts = [part for part in _COMMAND_SEPARATORS.split(normalized) if part]
+        if 1 < len(parts) <= BATCH_MAX_ITEMS:
+            shared = "" if _STRONG_SEPARATORS.search(normalized) else " ".join(parts[-1].split()[1:])
+            actions, confidence = [], 1.0
+            for part in parts:
+                interpretation, part_confidence = self._match(part)
+                if (interpretation is None or part_confidence < FAST_MATCH_THRESHOLD) and shared:
+                    interpretation, part_confidence = self._match(f"{part} {shared}")
+                if interpretation is None or part_confidence < FAST_MATCH_THRESHOLD: break
+                actions.append(interpretation); confidence = min(confidence, part_confidence)
+            else: return {"intent": "batch", "parameters": {"actions": actions}}, confidence
+            interpretation, confidence = self._match(normalized)
+            return interpretation, min(confidence, COMPOUND_PARTIAL_CONFIDENCE)
+        return self._match(normalized)
+
+    def _match(self, normalized):
+        m = self._regex.match(normalized)
+        if m is None: return None, 0.0
+        index = int(m.lastgroup[1:])
+        rule = self.rules[index]
+        if rule.intent.startswith(("set_", "toggle_")) and _QUESTION.search(normalized): return None, 0.0
+        parameters = dict(rule.defaults)
+        prefix = f"r{index}_"
+        for name, value in m.groupdict().items():
+            if value is not None and name.startswith(prefix):
+                parameters[name[len(prefix):]] = _PARAM_CONVERTERS[name[len(prefix):]](value)
+        return {"intent": rule.intent, "parameters": parameters}, rule.confidence
+
+
+intent_matcher = IntentMatcher(INTENT_RULES)
+
+
+# --- Local Intent Classifier ---
+# Second interpretation tier, between the fast-path matcher and the LLM: a nearest-centroid model over TF-IDF
+# weighted words and character n-grams (within words, so "wifi"/"wi-fi"/"wlan" and typos still overlap), trained
+# when it is loaded from the phrasings in INTENT_CLASSIFIER_CORPUS. Training takes milliseconds and classifying a
+# command tens of microseconds. The model only picks the intent; parameters are extracted by rules below. Commands
+# it is unsure about, that it files under "unknown", that lack a required parameter, refer back to the conversation
+# or are compounds are left to the LLM. Needs numpy; without it (or with the corpus path empty) the tier is skipped.
+INTENT_CLASSIFIER_CORPUS = os.getenv("INTENT_CLASSIFIER_CORPUS", os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_corpus.json")) # Empty disables
+CLASSIFIER_MIN_SCORE = float(os.getenv("CLASSIFIER_MIN_SCORE", "0.25")) # Cosine similarity to the best intent's centroid
+CLASSIFIER_MIN_MARGIN = float(os.getenv("CLASSIFIER_MIN_MARGIN", "0.08")) # How far ahead of the runner-up the best intent must be
+CLASSIFIER_NGRAMS = (3, 5) # Character n-gram lengths, of words padded with spaces
+_CLASSIFIER_WORDS = re.compile(r"[a-z]+|\d+")
+_CLASSIFIER_LEVEL_WORDS = {"mute": 0, "silence": 0, "zero": 0, "min": 0, "minimum": 0, "half": 50, "max": 100, "maximum": 100, "full": 100}
+_CLASSIFIER_LEVEL = re.compile(rf"\b{_LEVEL}|\b(?P<word>{'|'.join(_CLASSIFIER_LEVEL_WORDS)})\b|(?P<all>all the way up)")
+_CLASSIFIER_RELATIVE_LEVEL = re.compile(r"\b(?:by|up|down)\s+\d") # "down by 20", "volume up 10"; "down to 20" is absolute
+_CLASSIFIER_ON = re.compile(r"\b(?:on|enable|activate|start)\b")
+_CLASSIFIER_ON_IMPERATIVE = re.compile(r"\b(?:enabled|up)\b") # "bring wifi up"; only ON in a sentence that gives an order
+_CLASSIFIER_IMPERATIVE = re.compile(r"^(?:please\s+)?(?:(?:can|could|would) you\s+)?(?:turn|switch|bring|put|set|get|make|keep|power|flip|start)\b")
+_CLASSIFIER_OFF = re.compile(r"\b(?:off|disabled?|deactivate|stop|kill|disconnect|down)\b")
+_CLASSIFIER_CPU_WINDOW = re.compile(r"\b(?:over|last|past)\s+(?P<window>\d{1,2})\s*s(?:ec(?:ond)?s?)?\b")
+_CLASSIFIER_HISTORY_WINDOW = re.compile(r"\b(?P<count>\d{1,4})?\s*(?P<unit>second|minute|hour|day|week)s?\b|\b(?P<today>today)\b")
+_CLASSIFIER_HISTORY_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 604800}
+_CLASSIFIER_HISTORY_METRICS = {"cpu": "cpu", "processor": "cpu", "memory": "memory", "ram": "memory", "battery": "battery",
+                               "volume": "volume", "sound": "volume"}
+
+
+def _classifier_features(text):
+    """Counts of words (as "<word>") and of padded character n-grams; numbers collapse to "#"."""
+    features = collections.Counter()
+    for word in _CLASSIFIER_WORDS.findall(text.lower()):
+        if word.isdigit(): word = "#"
+        features[f"<{word}>"] += 1
+        padded = f" {word} "
+        for n in range(CLASSIFIER_NGRAMS[0], CLASSIFIER_NGRAMS[1] + 1):
+            for i in range(len(padded) - n + 1): features[padded[i:i + n]] += 1
+    return features
+
+
+def _classifier_parameters(intent, normalized):
+    """Parameters for a classified command, or None when a required one is missing or ambiguous."""
+    if intent in ("set_brightness", "set_volume"):
+        m = _CLASSIFIER_LEVEL.search(normalized)
+        if m is None or _CLASSIFIER_RELATIVE_LEVEL.search(normalized): return None
+        if m["level"] is not None: return {"level": _PARAM_CONVERTERS["level"](m["level"])}
+        return {"level": 100 if m["all"] else _CLASSIFIER_LEVEL_WORDS[m["word"]]}
+    if intent in ("toggle_wifi", "toggle_bluetooth"):
+        on = _CLASSIFIER_ON.search(normalized) or (_CLASSIFIER_IMPERATIVE.match(normalized) and _CLASSIFIER_ON_IMPERATIVE.search(normalized))
+        off = _CLASSIFIER_OFF.search(normalized)
+        return None if bool(on) == bool(off) else {"state": "on" if on else "off"}
+    if intent == "get_cpu_usage":
+        m = _CLASSIFIER_CPU_WINDOW.search(normalized)
+        return {"window": float(m["window"])} if m else {}
+    if intent == "get_metric_history":
+        parameters = {}
+        m = _CLASSIFIER_HISTORY_WINDOW.search(normalized)
+        if m: parameters["window"] = 86400 if m["today"] else int(m["count"] or 1) * _CLASSIFIER_HISTORY_UNITS[m["unit"]]
+        metrics = {metric for word, metric in _CLASSIFIER_HISTORY_METRICS.items() if re.search(rf"\b{word}\b", normalized)}
+        if metrics: parameters["metrics"] = [metric for metric in HISTORY_METRICS if metric in metrics]
+        return parameters
+    return {}
+
+
+class IntentClassifier:
+    """Nearest-centroid intent classifier over TF-IDF features; see the section comment above."""
+
+    def __init__(self, np, corpus):
+        self.np = np
+        self.intents = list(corpus)
+        docs = [(label, _classifier_features(text)) for label, phrasings in enumerate(corpus.values()) for text in phrasings]
+        self.vocabulary = {}
+        for _, features in docs:
+            for feature in features: self.vocabulary.setdefault(feature, len(self.vocabulary))
+        doc_index = np.repeat(np.arange(len(docs)), [len(features) for _, features in docs])
+        feature_index = np.fromiter((self.vocabulary[f] for _, features in docs for f in features), np.intp, len(doc_index))
+        counts = np.fromiter((c for _, features in docs for c in features.values()), np.float64, len(doc_index))
+        document_frequency = np.bincount(feature_index, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + len(docs)) / (1 + document_frequency)) + 1
+        self.unseen_idf = math.log(1 + len(docs)) + 1 # Features not in the corpus still lower the similarity
+        weights = (1 + np.log(counts)) * self.idf[feature_index]
+        weights /= np.sqrt(np.bincount(doc_index, weights * weights))[doc_index]
+        labels = np.array([label for label, _ in docs])
+        # One column per intent: the sum of its phrasings' unit vectors, normalized. Rows are features, so
+        # classifying gathers just the rows of the command's features.
+        centroids = np.zeros((len(self.vocabulary), len(self.intents)))
+        np.add.at(centroids, (feature_index, labels[doc_index]), weights)
+        self.centroids = (centroids / np.linalg.norm(centroids, axis=0)).astype(np.float32)
+        self.examples = len(docs)
+
+    def classify(self, text):
+        """(intent, score, margin): the closest intent, its cosine similarity and its lead over the runner-up."""
+        np = self.np
+        known, unseen = [], 0.0
+        for feature, count in _classifier_features(text).items():
+            index = self.vocabulary.get(feature)
+            if index is None: unseen += ((1 + math.log(count)) * self.unseen_idf) ** 2
+            else: known.append((index, count))
+        if not known: return "unknown", 0.0, 0.0
+        indices = np.fromiter((index for index, _ in known), np.intp, len(known))
+        weights = (1 + np.log(np.fromiter((count for _, count in known), np.float64, len(known)))) * self.idf[indices]
+        scores = (weights @ self.centroids[indices]) / math.sqrt(float(weights @ weights) + unseen)
+        second, best = np.argsort(scores)[-2:]
+        return self.intents[best], float(scores[best]), float(scores[best] - scores[second])
+
+    def interpret(self, command):
+        """(interpretation, confidence) for a command, with interpretation None when the LLM should decide."""
+        normalized = " ".join(command.lower().split())
+        if len(_COMMAND_SEPARATORS.split(normalized)) > 1: return None, 0.0 # Compounds: a single intent would drop actions
+        intent, score, margin = self.classify(normalized)
+        if intent not in INTENT_HANDLERS or score < CLASSIFIER_MIN_SCORE or margin < CLASSIFIER_MIN_MARGIN: return None, score
+        # "turn it off", "same again": what "it" is lives in the conversation history, which only the LLM sees
+        if intent.startswith(("set_", "toggle_")) and _CONTEXT_DEPENDENT.search(normalized): return None, score
+        if intent.startswith(("set_", "toggle_")) and _QUESTION.search(normalized): return None, score # Asks, does not switch
+        parameters = _classifier_parameters(intent, normalized)
+        if parameters is None: return None, score
+        return {"intent": intent, "parameters": parameters}, score
+
+
+def _load_intent_classifier():
+    if not INTENT_CLASSIFIER_CORPUS: raise RuntimeError("INTENT_CLASSIFIER_CORPUS is empty.")
+    try: np = importlib.import_module("numpy")
+    except ImportError: raise ImportError("numpy not found (pip install numpy).")
+    with open(INTENT_CLASSIFIER_CORPUS, encoding="utf-8") as f:
+        try: corpus = json.load(f)["intents"]
+        except (ValueError, KeyError, TypeError) as e: raise RuntimeError(f"Invalid intent corpus {INTENT_CLASSIFIER_CORPUS}: {e!r}")
+    return IntentClassifier(np, corpus)
+
+
+intent_classifier_backend = LazyBackend("intent_classifier", _load_intent_classifier)
+
+
+async def interpret_locally(command):
+    """Interprets a command without the LLM: the fast-path matcher, then the local classifier.
+
+    Returns None when neither is confident; interpretations are counted under source "rule" or "classifier".
+    """
+    started = time.perf_counter()
+    interpretation, confidence = intent_matcher.match(command)
+    if interpretation and confidence >= FAST_MATCH_THRESHOLD:
+        logging.debug(f"Command matched by hardcoded rule (confidence {confidence}): {interpretation}")
+        INTERPRETATIONS.inc("rule"); INTERPRET_SECONDS.observe(time.perf_counter() - started, "rule")
+        return interpretation
+    classifier = await intent_classifier_backend.aget()
+    if classifier is None: return None
+    interpretation, confidence = classifier.interpret(command)
+    if interpretation:
+        logging.debug(f"Command classified locally (confidence {confidence:.2f}): {interpretation}")
+        INTERPRETATIONS.inc("classifier"); INTERPRET_SECONDS.observe(time.perf_counter() - started, "classifier")
+    return interpretation
+
+
+# --- Combined Command Interpretation ---
+async def interpret_command_with_llm(command, history=None, session=None, on_partial=None):
+    """
+    Interprets the command locally (fast-path matcher, then the local classifier) first, then falls back to
+    OpenAI API (passing history) when neither is confident. Without the LLM, or while its circuit breaker is
+    open, a low-confidence rule match is used.
+    """
+    logging.debug(f"Interpreting command: '{command}'")
+    started = time.perf_counter()
+    interpretation = await interpret_locally(command)
+    if interpretation: return interpretation
+    if not openai_available or not llm_gateway.available():
+        interpretation, confidence = intent_matcher.match(command)
+        if interpretation:
+            logging.debug(f"Command matched by hardcoded rule (confidence {confidence}): {interpretation}")
+            INTERPRETATIONS.inc("rule"); INTERPRET_SECONDS.observe(time.perf_counter() - started, "rule")
+            return interpretation
+    cache_hits = interpretation_cache.hits
+    interpretation = await call_openai_api(command, history=history, session=session, on_partial=on_partial)
+    INTERPRET_SECONDS.observe(time.perf_counter() - started, "cache" if interpretation_cache.hits != cache_hits else "llm")
+    return interpretation
+
+# --- Admission Control ---
+# Limits that keep one client from degrading the server for everyone else:
+# - MAX_CONNECTIONS: further connections are closed right after the handshake with 1013 (try again later).
+#   Registered fleet agents do not count; on a hub the cap is checked at a connection's first frame instead,
+#   so agents (whose first frame is "register") are never refused.
+# - RATE_LIMITS: per-connection token buckets per request class. "telemetry" covers read-only intents and
+#   subscriptions, "control" the setters and toggles, "llm" each command sent to OpenAI (cache hits are free)
+#   and "shell" each shell command run. A request over its class's rate is answered with an error at once.
+#   Coalesced setters (slider drags) are exempt: their setter queue already paces the writes, and refusing
+#   part of a drag could refuse its final value.
+# - OUTBOUND_BUFFER_BYTES: telemetry frames are skipped for a connection with more unsent data than this (and
+#   replies wait for it to drain); a connection that cannot take a reply, or stays backlogged, for
+#   SLOW_CONSUMER_SECONDS is dropped. The kernel's send buffer is capped at the same size, as Linux otherwise
+#   grows it to several MiB for a client that stopped reading before any backlog reaches the server.
+# The cap on concurrent OpenAI calls (LLM_MAX_CONCURRENCY) is part of the LLM Gateway.
+MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "256")) # 0 = unlimited
+RATE_LIMITS = {
+    # request class: (sustained requests per second, burst); a rate of 0 disables the limit
+    "telemetry": (20.0, 40),
+    "control": (10.0, 20),
+    "llm": (0.5, 5),
+    "shell": (0.5, 5),
+}
+# Overrides as "class=rate/burst,..." (e.g. "llm=1/10,shell=0")
+for _override in filter(None, os.getenv("RATE_LIMITS", "").split(",")):
+    _class, _, _limit = _override.partition("=")
+    _rate, _, _burst = _limit.partition("/")
+    RATE_LIMITS[_class.strip()] = (float(_rate), int(_burst or max(1, float(_rate))))
+OUTBOUND_BUFFER_BYTES = int(os.getenv("OUTBOUND_BUFFER_BYTES", str(64 * 1024))) # Also websockets' write limit; 0 disables skipping
+SLOW_CONSUMER_SECONDS = float(os.getenv("SLOW_CONSUMER_SECONDS", "30"))
+
+CONNECTIONS_REJECTED = metrics.counter("device_assistant_connections_rejected_total", "Connections closed on arrival because MAX_CONNECTIONS were open.")
+RATE_LIMITED = metrics.counter("device_assistant_rate_limited_total", "Requests refused by a per-connection rate limit, by request class.", ("class",))
+OUTBOUND_DROPPED = metrics.counter("device_assistant_outbound_dropped_total", "Telemetry frames skipped for backlogged connections (telemetry) and slow consumers disconnected (disconnect).", ("kind",))
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Takes a token. Returns 0 on success, else the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1: self.tokens -= 1; return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+def request_class(intent):
+    """The RATE_LIMITS class an intent is charged to (None: not charged)."""
+    if intent in COALESCED_SETTERS: return None # Paced by their setter queue (see above)
+    if intent == "run_shell_command": return "shell"
+    if intent in INTENT_CACHE_TTLS or intent == "get_metric_history": return "telemetry"
+    return "control"
+
+
+def connection_cap_reached(counted=0):
+    """Whether MAX_CONNECTIONS client connections are open, besides registered fleet agents and `counted` (this one)."""
+    if not MAX_CONNECTIONS: return False
+    agents = len(fleet_hub.agents) if FLEET_HUB else 0
+    return ACTIVE_CONNECTIONS.values[()] - agents - counted >= MAX_CONNECTIONS
+
+
+async def reject_connection(websocket):
+    """Closes a connection over MAX_CONNECTIONS with 1013 (try again later)."""
+    CONNECTIONS_REJECTED.inc()
+    logging.warning(f"Rejecting {websocket.remote_address}: {MAX_CONNECTIONS} connections are open (MAX_CONNECTIONS).")
+    await websocket.close(1013, "Connection limit reached; try again later.")
+
+
+def outbound_backlog(websocket):
+    """Bytes written to a connection that the client has not taken yet."""
+    transport = websocket.transport
+    return transport.get_write_buffer_size() if transport is not None else 0
+
+
+def bound_send_buffer(websocket):
+    """Caps the kernel's send buffer of a connection at OUTBOUND_BUFFER_BYTES (see above)."""
+    sock = websocket.transport.get_extra_info("socket") if OUTBOUND_BUFFER_BYTES else None
+    if sock is None: return
+    try: sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, OUTBOUND_BUFFER_BYTES)
+    except OSError as e: logging.debug(f"Could not set SO_SNDBUF: {e}")
+
+
+def drop_slow_consumer(websocket, reason):
+    """Disconnects a client that stopped reading. Aborting frees its buffers at once; a close handshake would queue behind them."""
+    OUTBOUND_DROPPED.inc("disconnect")
+    logging.warning(f"Dropping slow consumer {websocket.remote_address}: {reason}")
+    if websocket.transport is not None: websocket.transport.abort()
+
+
+# --- Client Session ---
+class ClientSession:
+    """Per-connection state: conversation history, shell error feedback and running shell jobs."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.history = collections.deque(maxlen=HISTORY_MAX_LEN)
+        self.last_shell_error_info = None
+        self.error_feedback_count = 0
+        self.shell_jobs = {} # command_id -> ShellJob still running
+        self.shell_tasks = set() # Tasks running shell jobs through to their shell_exit frame
+        self.inflight = asyncio.Semaphore(MAX_INFLIGHT_PER_CONNECTION) # v2 requests being processed concurrently
+        self.ordered = asyncio.Lock() # Serializes requests that read or depend on conversation history (FIFO)
+        self.requests = set() # Tasks of in-flight v2 requests
+        self.rate_limits = {name: TokenBucket(rate, burst) for name, (rate, burst) in RATE_LIMITS.items() if rate > 0}
+
+    def rate_limited(self, request_class):
+        """None if a request of this class (None: uncharged) may proceed now, else the error to answer it with."""
+        bucket = self.rate_limits.get(request_class)
+        wait = bucket.take() if bucket is not None else 0.0
+        if not wait: return None
+        RATE_LIMITED.inc(request_class)
+        return f"Error: Rate limit for {request_class} requests exceeded; retry in {wait:.1f}s."
+
+    def reset_error_feedback(self):
+        self.last_shell_error_info = None; self.error_feedback_count = 0
+
+    def record_shell_result(self, result):
+        """Updates error feedback from a structured shell result and returns the user-facing summary."""
+        if not result.get("success"):
+            # Store error info for potential feedback on the *next* message
+            self.last_shell_error_info = { "command": result.get("command"), "exit_code": result.get("exit_code"), "stderr": result.get("stderr") or result.get("error_message") }
+            return (f"Error executing command: {result.get('command', '')}\nExit Code: {result.get('exit_code', 'N/A')}\nStderr: {result.get('stderr') or result.get('error_message') or '(None)'}")
+        # Command succeeded according to new criteria, clear error state
+        self.reset_error_feedback()
+        return (f"Command executed successfully: {result.get('command', '')}\nExit Code: {result.get('exit_code', 0)}\nStdout: {result.get('stdout') or '(None)'}")
+
+    async def send(self, frame):
+        """Sends a frame, waiting while the connection is over its write limit; drops the client if that takes too long."""
+        started = time.perf_counter()
+        try: await asyncio.wait_for(self.websocket.send(json.dumps(frame)), SLOW_CONSUMER_SECONDS)
+        except asyncio.TimeoutError: drop_slow_consumer(self.websocket, f"a reply waited {SLOW_CONSUMER_SECONDS:g}s to be sent")
+        finally: SEND_SECONDS.observe(time.perf_counter() - started)
+
+
+# --- Batch Execution ---
+# A batch runs several actions from one message, e.g. a scene like "brightness 30, volume 20, bluetooth off".
+# Actions on different intents run in parallel; actions on the same intent run one after another in the
+# order given (so "volume 20 then volume 50" ends at 50 and dependent shell commands keep their order).
+# A batch takes as long as its slowest lane and replies once with every action's outcome in request order.
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "16"))
+
+
+def batch_actions(interpretation):
+    """The action list of a batch interpretation, or None if it is not a well-formed batch."""
+    parameters = interpretation.get("parameters")
+    actions = parameters.get("actions") if isinstance(parameters, dict) else None
+    return actions if isinstance(actions, list) and actions else None
+
+
+def _action_failed(response):
+    if isinstance(response, dict): return response.get("success") is False or "error" in response
+    return isinstance(response, str) and response.startswith(("Error", "An unexpected error", "Command not understood"))
+
+
+async def _run_batch_action(session, action):
+    """Executes one batch action through INTENT_HANDLERS and returns its result entry."""
+    started = time.perf_counter()
+    intent = action.get("intent") if isinstance(action, dict) else None
+    parameters = action.get("parameters", {}) if isinstance(action, dict) else None
+    if not isinstance(parameters, dict): response = "Error: Action must be an object with 'intent' and 'parameters'."
+    elif intent == "unknown": response = f"Command not understood. {parameters.get('error', '')}".strip()
+    elif intent == "run_shell_command" and not ALLOW_SHELL_EXECUTION: response = "Error: Shell command execution is disabled by server configuration."
+    elif intent not in INTENT_HANDLERS: response = f"Error: Unknown intent '{intent}'."
+    elif (limited := session.rate_limited(request_class(intent))): response = limited
+    else:
+        try:
+            response = await run_intent(intent, parameters)
+            if intent == "run_shell_command" and isinstance(response, dict): session.record_shell_result(response)
+        except TypeError as e: logging.error(f"Parameter mismatch for intent '{intent}': {e}. Params: {parameters}"); response = f"Error: Incorrect parameters provided for action '{intent}'."
+        except Exception as e: logging.exception(f"Error executing handler for intent '{intent}': {e}"); response = f"Error executing action for '{intent}': {e}"
+    if isinstance(response, str) and response.startswith("{"):
+        try: response = json.loads(response)
+        except json.JSONDecodeError: pass
+    return {"intent": intent, "parameters": parameters, "status": "error" if _action_failed(response) else "ok",
+            "response": response, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+async def _run_batch_action_after(previous, session, action):
+    """Runs a batch action once the previous action of its lane (a task, or None) has finished."""
+    if previous is not None: await asyncio.wait([previous])
+    return await _run_batch_action(session, action)
+
+
+async def execute_batch(session, actions, running=()):
+    """Runs batch actions (parallel across intents, in order within one) and returns the aggregated result.
+
+    `running` are tasks already running the first actions (started by EarlyDispatch); the rest queue behind them.
+    """
+    started = time.perf_counter()
+    tasks, lanes = list(running), {}
+    for index, action in enumerate(actions):
+        lane = str(action.get("intent")) if isinstance(action, dict) else None
+        if index >= len(running): tasks.append(asyncio.ensure_future(_run_batch_action_after(lanes.get(lane), session, action)))
+        lanes[lane] = tasks[index]
+    results = await asyncio.gather(*tasks)
+    failed = sum(1 for result in results if result["status"] != "ok")
+    return {"batch": results, "ok": len(results) - failed, "failed": failed, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+async def _batch_item_actions(session, item):
+    """The actions for one item of a batch frame; a natural-language command may expand to several."""
+    if isinstance(item, str): item = {"command": item}
+    if not isinstance(item, dict): return [{"intent": "unknown", "parameters": {"error": "Batch items must be objects or command strings."}}]
+    if item.get("intent") is not None: return [{"intent": item["intent"], "parameters": item.get("parameters", {})}]
+    command = item.get("command")
+    if not isinstance(command, str) or not command.strip(): return [{"intent": "unknown", "parameters": {"error": "Batch item is missing an 'intent' or a 'command'."}}]
+    # Items are independent of each other and of the conversation, so they are interpreted without history
+    interpretation = await interpret_command_with_llm(command, session=session)
+    if interpretation.get("intent") == "batch": return batch_actions(interpretation) or [{"intent": "unknown", "parameters": {"error": "Malformed batch interpretation."}}]
+    return [interpretation]
+
+
+async def process_batch(session, request_id, items):
+    """Executes a batch frame and sends one aggregated reply tagged with its id.
+
+    Items are {"intent": ..., "parameters": {...}} or {"command": "..."}; commands are interpreted concurrently
+    (fast path first, then the LLM) before anything runs.
+    """
+    try:
+        if not isinstance(items, list) or not items: frame = {"response": "Error: Batch 'items' must be a non-empty list."}
+        elif len(items) > BATCH_MAX_ITEMS: frame = {"response": f"Error: A batch holds at most {BATCH_MAX_ITEMS} items."}
+        else:
+            actions = [action for item_actions in await asyncio.gather(*(_batch_item_actions(session, item) for item in items)) for action in item_actions]
+            if len(actions) > BATCH_MAX_ITEMS: frame = {"response": f"Error: A batch holds at most {BATCH_MAX_ITEMS} actions."}
+            else: frame = {"response": await execute_batch(session, actions)}
+    except Exception as e:
+        logging.exception(f"Error processing batch {request_id!r}: {e}")
+        frame = {"error": "Server error occurred."}
+    finally:
+        session.inflight.release()
+    try: await session.send({"id": request_id, **frame})
+    except websockets.exceptions.ConnectionClosed: pass
+
+
+# --- WebSocket Handler ---
+async def process_message(session, message, interpretation=None, stream=False):
+    """Interprets and executes one command for a session. Returns the response frame.
+
+    A precomputed `interpretation` (from the fast-path matcher or an explicit intent) skips the LLM and the
+    error-feedback state. Shell commands reply with their final result, or with `stream=True` (v2 requests)
+    stream their output (see the Streaming Shell Executor).
+    With LLM_STREAMING, what the interpretation asks for may already be running when it completes (EarlyDispatch).
+    """
+    running = ()
+    if interpretation is None:
+        current_history = list(session.history)
+        if session.last_shell_error_info and session.error_feedback_count < MAX_ERROR_FEEDBACK_ATTEMPTS:
+             error_info = session.last_shell_error_info
+             error_context = (f"SYSTEM_NOTE: The previous command '{error_info['command']}' failed (Exit Code: {error_info['exit_code']}, Stderr: {error_info['stderr'] or '(none)'}). Please analyze this error and try to correct the command based on the user's *current* request: '{message}'")
+             current_history.append(("assistant", error_context))
+             logging.info(f"Providing error context to LLM (Attempt {session.error_feedback_count + 1})")
+             session.error_feedback_count += 1
+        else: session.reset_error_feedback()
+
+        early = EarlyDispatch(session) if LLM_STREAMING else None
+        interpretation = await interpret_command_with_llm(message, history=current_history, session=session, on_partial=early)
+        if early is not None: interpretation = early.settle(interpretation); running = early.tasks
+    intent = interpretation.get("intent")
+    parameters = interpretation.get("parameters", {})
+    response_message = ""; structured_response = None
+    if intent in INTENT_HANDLERS and not running: # Batch actions are charged one by one; started ones already were
+        limited = session.rate_limited(request_class(intent))
+        if limited: response_message = limited; intent = "rate_limited"
+
+    if intent == "run_shell_command" and not ALLOW_SHELL_EXECUTION:
+         response_message = "Error: Shell command execution is disabled by server configuration."; intent = "error_blocked"
+
+    if intent == "run_shell_command" and SHELL_STREAMING and stream and isinstance(parameters.get("command"), str):
+        # Output is streamed as it arrives; the final result follows in a shell_exit frame
+        structured_response = start_shell_job(session, parameters["command"])
+    elif intent == "batch":
+        actions = batch_actions(interpretation)
+        if actions is None: response_message = "Error: Batch interpretation has no actions."
+        elif len(actions) > BATCH_MAX_ITEMS: response_message = f"Error: A batch holds at most {BATCH_MAX_ITEMS} actions."
+        else: structured_response = await execute_batch(session, actions, running)
+    elif intent in INTENT_HANDLERS:
+        try:
+            response_message = await (running[0] if running else run_intent(intent, parameters))
+            if intent == "run_shell_command" and isinstance(response_message, dict):
+                structured_response = response_message # Keep the structured response
+                response_message = session.record_shell_result(structured_response)
+        except TypeError as e: logging.error(f"Parameter mismatch for intent '{intent}': {e}. Params: {parameters}"); response_message = f"Error: Incorrect parameters provided for action '{intent}'."; session.reset_error_feedback()
+        except Exception as e: logging.exception(f"Error executing handler for intent '{intent}': {e}"); response_message = f"Error executing action for '{intent}': {e}"; session.reset_error_feedback()
+    elif intent == "unknown": response_message = f"Command not understood. {parameters.get('error', '')}"; session.reset_error_feedback()
+    elif intent in ("error_blocked", "rate_limited"): session.reset_error_feedback()
+    else: response_message = f"No handler defined for intent: {intent}"; session.reset_error_feedback()
+
+    final_response_data_to_send = None; history_entry_assistant = None
+    if structured_response: final_response_data_to_send = {"response": structured_response}; history_entry_assistant = json.dumps(structured_response)
     else:
-        return await call_openai_api(command, history=history)
+        try: json_data = json.loads(response_message); final_response_data_to_send = {"response": json_data}; history_entry_assistant = json.dumps(json_data)
+        except (json.JSONDecodeError, TypeError): final_response_data_to_send = {"response": str(response_message)}; history_entry_assistant = str(response_message)
+    session.history.append(("user", message)); session.history.append(("assistant", history_entry_assistant))
+    return final_response_data_to_send
+
+
+async def process_request(session, request_id, command, intent=None, parameters=None, stream=True):
+    """Processes a v2 request concurrently with others on the connection and sends the tagged reply.
+
+    Commands resolved locally (fast-path matcher or local classifier) do not touch conversation history, so they
+    run immediately.
+    Everything else goes through the session's ordered lock and is handled in arrival order.
+    Requests naming an `intent` (with `parameters`) are dispatched directly, without interpretation.
+    """
+    try:
+        if intent is not None:
+            if intent not in INTENT_HANDLERS: frame = {"response": f"Error: Unknown intent '{intent}'."}
+            elif parameters is not None and not isinstance(parameters, dict): frame = {"response": "Error: Request 'parameters' must be an object."}
+            else:
+                interpretation = {"intent": intent, "parameters": parameters or {}}
+                frame = await process_message(session, command or f"{intent} {json.dumps(parameters or {})}", interpretation=interpretation, stream=stream)
+        elif not isinstance(command, str) or not command.strip():
+            frame = {"response": "Error: Request is missing a 'command' string."}
+        else:
+            interpretation = await interpret_locally(command)
+            if interpretation:
+                frame = await process_message(session, command, interpretation=interpretation, stream=stream)
+            else:
+                if LLM_STREAMING: await session.send({"type": "progress", "id": request_id, "stage": "interpreting", "message": "Interpreting…"})
+                async with session.ordered:
+                    frame = await process_message(session, command, stream=stream)
+    except Exception as e:
+        logging.exception(f"Error processing request {request_id!r}: {e}")
+        frame = {"error": "Server error occurred."}
+    finally:
+        session.inflight.release()
+    try: await session.send({"id": request_id, **frame})
+    except websockets.exceptions.ConnectionClosed: pass
+
 
-# --- WebSocket Handler (Unchanged) ---
 async def handler(websocket):
+    if not FLEET_HUB and connection_cap_reached(): await reject_connection(websocket); return
+    bound_send_buffer(websocket)
     logging.info(f"Client connected from {websocket.remote_address}")
-    history = collections.deque(maxlen=HISTORY_MAX_LEN)
-    last_shell_error_info = None
-    error_feedback_count = 0
+    session = ClientSession(websocket)
+    ACTIVE_CONNECTIONS.inc()
+    admitted = not FLEET_HUB # A hub checks the cap at the first frame, so agents registering are exempt
     try:
         async for message in websocket:
-            current_history = list(history)
-            if last_shell_error_info and error_feedback_count < MAX_ERROR_FEEDBACK_ATTEMPTS:
-                 error_context = (f"SYSTEM_NOTE: The previous command '{last_shell_error_info['command']}' failed (Exit Code: {last_shell_error_info['exit_code']}, Stderr: {last_shell_error_info['stderr'] or '(none)'}). Please analyze this error and try to correct the command based on the user's *current* request: '{message}'")
-                 current_history.append(("assistant", error_context))
-                 logging.info(f"Providing error context to LLM (Attempt {error_feedback_count + 1})")
-                 error_feedback_count += 1
-            else: last_shell_error_info = None; error_feedback_count = 0
-
-            interpretation = await interpret_command_with_llm(message, history=current_history)
-            intent = interpretation.get("intent")
-            parameters = interpretation.get("parameters", {})
-            response_message = ""; structured_response = None
-
-            if intent == "run_shell_command" and not ALLOW_SHELL_EXECUTION:
-                 response_message = "Error: Shell command execution is disabled by server configuration."; intent = "error_blocked"
-
-            if intent in INTENT_HANDLERS:
-                handler_func = INTENT_HANDLERS[intent]
-                try:
-                    if inspect.iscoroutinefunction(handler_func): response_message = await handler_func(**parameters)
-                    else: response_message = handler_func(**parameters)
-                    if intent == "run_shell_command" and isinstance(response_message, dict):
-                        structured_response = response_message # Keep the structured response
-                        # Check the success flag determined by execute_shell_command
-                        if not response_message.get("success"):
-                            # Store error info for potential feedback on the *next* message
-                            last_shell_error_info = { "command": response_message.get("command"), "exit_code": response_message.get("exit_code"), "stderr": response_message.get("stderr") or response_message.get("error_message") }
-                            # Format a user-friendly error message from the structured data
-                            response_message = (f"Error executing command: {response_message.get('command', '')}\nExit Code: {response_message.get('exit_code', 'N/A')}\nStderr: {response_message.get('stderr') or response_message.get('error_message') or '(None)'}")
-                        else:
-                             # Command succeeded according to new criteria, clear error state
-                             last_shell_error_info = None; error_feedback_count = 0
-                             # Format success message
-                             response_message = (f"Command executed successfully: {response_message.get('command', '')}\nExit Code: {response_message.get('exit_code', 0)}\nStdout: {response_message.get('stdout') or '(None)'}")
-                except TypeError as e: logging.error(f"Parameter mismatch for intent '{intent}': {e}. Params: {parameters}"); response_message = f"Error: Incorrect parameters provided for action '{intent}'."; last_shell_error_info = None; error_feedback_count = 0
-                except Exception as e: logging.exception(f"Error executing handler for intent '{intent}': {e}"); response_message = f"Error executing action for '{intent}': {e}"; last_shell_error_info = None; error_feedback_count = 0
-            elif intent == "unknown": response_message = f"Command not understood. {parameters.get('error', '')}"; last_shell_error_info = None; error_feedback_count = 0
-            elif intent == "error_blocked": pass; last_shell_error_info = None; error_feedback_count = 0
-            else: response_message = f"No handler defined for intent: {intent}"; last_shell_error_info = None; error_feedback_count = 0
-
-            final_response_data_to_send = None; history_entry_assistant = None
-            if structured_response: final_response_data_to_send = {"response": structured_response}; history_entry_assistant = json.dumps(structured_response)
+            # Control frames (e.g. telemetry subscriptions) bypass interpretation entirely
+            control = _parse_control_message(message)
+            if not admitted:
+                if (control or {}).get("type") != "register" and connection_cap_reached(counted=1): await reject_connection(websocket); return
+                admitted = True
+            if control is None:
+                # Plain-text protocol: one command at a time, replies in order
+                async with session.ordered: frame = await process_message(session, message)
+                await session.send(frame)
+            elif control["type"] == "request":
+                # v2 protocol: requests are pipelined; waiting for a slot throttles reading further frames
+                await session.inflight.acquire()
+                task = asyncio.create_task(process_request(session, control.get("id"), control.get("command"), control.get("intent"),
+                                                           control.get("parameters"), control.get("stream", True) is not False))
+                session.requests.add(task); task.add_done_callback(session.requests.discard)
+            elif control["type"] == "batch":
+                # Like a v2 request: one slot for the whole batch, one reply with the same id
+                await session.inflight.acquire()
+                task = asyncio.create_task(process_batch(session, control.get("id"), control.get("items")))
+                session.requests.add(task); task.add_done_callback(session.requests.discard)
+            elif control["type"] == "register" and FLEET_HUB:
+                # An agent dialling in: the hub owns this connection from here on
+                await fleet_hub.serve_agent(websocket, control)
+                return
+            elif control["type"] == "fleet_request" and FLEET_HUB and fleet_access_error(control) is None:
+                # Fan-out waits on many devices, so it runs alongside further frames like a v2 request
+                await session.inflight.acquire()
+                task = asyncio.create_task(fleet_hub.process_fleet_request(session, control))
+                session.requests.add(task); task.add_done_callback(session.requests.discard)
             else:
-                try: json_data = json.loads(response_message); final_response_data_to_send = {"response": json_data}; history_entry_assistant = json.dumps(json_data)
-                except (json.JSONDecodeError, TypeError): final_response_data_to_send = {"response": str(response_message)}; history_entry_assistant = str(response_message)
-            await websocket.send(json.dumps(final_response_data_to_send))
-            history.append(("user", message)); history.append(("assistant", history_entry_assistant))
+                reply = await _handle_control_message(session, control)
+                if reply is None: continue
+                if "id" in control: reply["id"] = control["id"]
+                await session.send(reply)
     except websockets.exceptions.ConnectionClosedOK: logging.info(f"Client {websocket.remote_address} disconnected normally.")
     except websockets.exceptions.ConnectionClosedError as e: logging.error(f"Client {websocket.remote_address} disconnected with error: {e}")
     except Exception as e: logging.exception(f"An unexpected error occurred with client {websocket.remote_address}: {e}"); 
     try: await websocket.send(json.dumps({"error": f"Server error occurred."})) 
     except: pass
-    finally: logging.info(f"Connection closed for {websocket.remote_address}")
+    finally:
+        telemetry_publisher.unsubscribe(websocket)
+        if FLEET_HUB: fleet_hub.unsubscribe(websocket)
+        for job in list(session.shell_jobs.values()): job.cancel()
+        for task in list(session.requests): task.cancel()
+        ACTIVE_CONNECTIONS.inc(amount=-1)
+        logging.info(f"Connection closed for {websocket.remote_address}")
+
+
+# --- Startup & Readiness ---
+# In the default "lazy" startup mode the port is bound first and backends are loaded by a background warm-up,
+# so requests that need none of them (memory, CPU, fast-path setters) are served within milliseconds of a
+# restart. "eager" finishes the warm-up before binding, for deployments that prefer to accept no early traffic.
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy").lower() # "lazy" or "eager"
+READY_PATH = os.getenv("READY_PATH", "/ready") # HTTP readiness probe (200 once warmed up, else 503); empty disables
+INTENT_BACKENDS = {
+    # intent: backends it cannot work without
+    "set_brightness": () if sys.platform == "darwin" else ("screen_brightness_control",),
+    "get_cpu_usage": ("psutil",), "get_cpu_per_core": ("psutil",), "get_cpu_averages": ("psutil",),
+    "get_memory_usage": ("psutil",), "get_battery_status": ("psutil",), "get_system_snapshot": ("psutil",),
+}
+warm_up_task = None
+
+
+async def warm_up():
+    """Loads every backend off the event loop, starts the device event sources, compiles the matcher and opens the interpretation cache."""
+    started = time.perf_counter()
+    if WORKER_INDEX is None: device_state.start() # The PulseAudio follower waits for its own backend; workers read the supervisor's
+    await asyncio.gather(*(backend.aget() for backend in BACKENDS.values()), run_blocking(lambda: intent_matcher._regex), interpretation_cache.load())
+    await get_openai_client()
+    logging.info(f"Detected OS / Distro: {distro_backend.get()}")
+    logging.info(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms: "
+                 + ", ".join(f"{name} {backend.state}" for name, backend in BACKENDS.items()))
+
+
+def readiness():
+    """Warm-up state, each backend's load status and whether each intent can be served yet."""
+    intents = {}
+    for intent in INTENT_HANDLERS:
+        states = {BACKENDS[name].state for name in INTENT_BACKENDS.get(intent, ())}
+        intents[intent] = "unavailable" if "unavailable" in states else ("pending" if "pending" in states else "ready")
+    if not ALLOW_SHELL_EXECUTION: intents["run_shell_command"] = "disabled"
+    llm = "ready" if client is not None else (openai_backend.state if openai_available else "unavailable")
+    return {"ready": warm_up_task is not None and warm_up_task.done(), "mode": STARTUP_MODE, "llm": llm, "llm_circuit": llm_gateway.state,
+            "backends": {name: backend.status() for name, backend in BACKENDS.items()}, "intents": intents}
 
 
 # --- Start Server ---
 async def main():
-    logging.info(f"Starting WebSocket server on ws://{HOST}:{PORT}")
-    async with websockets.serve(handler, HOST, PORT, ping_interval=20, ping_timeout=20):
-        await asyncio.Future()
-
-import sys
-import subprocess
-import json
-import asyncio
-import platform  # Use platform module for better OS detection
-
-# --- Attempt to import libraries ---
-try:
-    import psutil
-except ImportError:
-    psutil = None
-    print("Warning: psutil library not found. CPU, Memory, and Battery functions will not work.")
-
-try:
-    import screen_brightness_control as sbc
-except ImportError:
-    sbc = None
-    print("Warning: screen-brightness-control library not found. Brightness function will not work.")
-
-# Windows-specific import for volume
-if sys.platform == 'win32':
+    global warm_up_task, shared_snapshot
+    if WORKERS > 1 and WORKER_INDEX is None:
+        if not hasattr(socket, "SO_REUSEPORT"): logging.warning("WORKERS > 1 needs SO_REUSEPORT, which this platform lacks; running one process.")
+        elif FLEET_HUB: logging.warning("Fleet hub state lives in one process; ignoring WORKERS in hub mode.")
+        else: return await run_supervisor(WORKERS)
+    if WORKER_INDEX is not None: shared_snapshot = SharedSnapshot(SHARED_SNAPSHOT_NAME)
+    if STARTUP_MODE == "eager":
+        warm_up_task = asyncio.create_task(warm_up())
+        await warm_up_task
+    lag_monitor = asyncio.create_task(_monitor_event_loop_lag())
+    extensions = None
+    if WS_COMPRESSION == "deflate":
+        extensions = [ServerPerMessageDeflateFactory(server_max_window_bits=WS_DEFLATE_WINDOW_BITS, client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+                                                     compress_settings={"memLevel": WS_DEFLATE_MEM_LEVEL})]
+    uplink = None
     try:
-        from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
-        from comtypes import CLSCTX_ALL
-    except ImportError:
-        AudioUtilities = None
-        print("Warning: pycaw library not found. Windows volume control will not work.")
-else:
-     AudioUtilities = None # Define as None for other platforms
+        async with websockets.serve(handler, HOST, PORT, ping_interval=20, ping_timeout=20, process_request=_serve_http,
+                                    compression=None, extensions=extensions, reuse_port=WORKER_INDEX is not None,
+                                    write_limit=OUTBOUND_BUFFER_BYTES or 32 * 1024):
+            worker = "" if WORKER_INDEX is None else f", worker {WORKER_INDEX}"
+            logging.info(f"WebSocket server listening on ws://{HOST}:{PORT} ({STARTUP_MODE} startup{worker})")
+            if METRICS_PATH: logging.info(f"Serving metrics on http://{HOST}:{PORT}{METRICS_PATH}")
+            if WORKER_INDEX is None:
+                cpu_sampler.start()
+                metric_history.start()
+            else: metric_history.follow()
+            if warm_up_task is None: warm_up_task = asyncio.create_task(warm_up())
+            if FLEET_HUB: logging.info(f"Fleet hub mode: accepting agent registrations{'' if FLEET_TOKEN else ' (no FLEET_TOKEN set, any agent may register)'}")
+            if FLEET_HUB and not FLEET_DASHBOARD_TOKEN and HOST not in LOOPBACK_HOSTS:
+                logging.warning(f"Fleet requests are disabled: set FLEET_DASHBOARD_TOKEN or FLEET_TOKEN to allow them on {HOST}.")
+            if HUB_URL and not WORKER_INDEX: uplink = asyncio.create_task(run_hub_uplink(HUB_URL)) # One registration per device
+            await (asyncio.Future() if WORKER_INDEX is None else _supervisor_exit())
+    finally:
+        lag_monitor.cancel()
+        if warm_up_task: warm_up_task.cancel()
+        if uplink: uplink.cancel()
+        metric_history.close()
+        await device_state.close()
+        await command_runner.close()
+        if shared_snapshot: shared_snapshot.close()
 
 # --- Helper function for running subprocess commands ---
 async def _run_command(command):
-    """Asynchronously runs a shell command."""
-    process = await asyncio.create_subprocess_shell(
-        command,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    stdout, stderr = await process.communicate()
-    if process.returncode != 0:
-        print(f"Error running command '{command}': {stderr.decode().strip()}")
+    """Asynchronously runs a command through the shared CommandRunner. Returns stdout, or None on failure."""
+    return await command_runner.run(command)
+
+
+# --- Command Runner ---
+# Commands are exec'd from an argument vector; only pipelines, redirections and expansions still go
+# through a shell. Concurrent identical invocations share one process, and status queries whose tool
+# offers an event stream are answered from cache until a long-lived monitor coprocess reports a change.
+COMMAND_MONITORS = {
+    # status query: monitor command whose output lines signal that the query result may have changed
+    "nmcli radio wifi": ("nmcli", "monitor"),
+    "amixer sget Master": ("amixer", "events"),
+    "rfkill list bluetooth": ("rfkill", "event"),
+    "rfkill list bluetooth -n -o SOFT": ("rfkill", "event"),
+}
+MONITOR_RETRY_SECONDS = 30 # Back-off before restarting a monitor that failed or exited
+_SHELL_OPERATOR_CHARS = set("();<>|&")
+_SHELL_EXPANSION_CHARS = set("$`*?~")
+
+
+def _command_argv(command):
+    """Splits a command into an argument vector, or returns None if it needs a shell."""
+    if _SHELL_EXPANSION_CHARS & set(command): return None
+    try:
+        lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+        lexer.whitespace_split = True
+        argv = list(lexer)
+    except ValueError:
         return None
-    return stdout.decode().strip()
+    if not argv or any(token and set(token) <= _SHELL_OPERATOR_CHARS for token in argv): return None
+    return argv
+
+
+class CommandRunner:
+    """Runs device commands with single-flight de-duplication and monitor-invalidated caching."""
+
+    def __init__(self):
+        self._inflight = {} # command -> task shared by concurrent callers
+        self._cache = {} # watched command -> last successful stdout
+        self._monitors = {} # monitor argv -> {"task", "process", "generation", "retry_at"}
+        self._listeners = collections.defaultdict(list) # monitor argv -> callbacks run on every event line
+        self.spawn_count = 0 # Processes started for queries (monitors excluded)
+        self._closing = False
+
+    def watch(self, monitor_argv, callback):
+        """Calls `callback(line)` for every line a monitor coprocess prints, starting it if needed.
+
+        `callback(None)` signals that the monitor stopped and cached state must no longer be trusted.
+        """
+        self._listeners[monitor_argv].append(callback)
+        self._ensure_monitor(monitor_argv)
+
+    async def run(self, command):
+        monitor_argv = COMMAND_MONITORS.get(command) if is_linux else None
+        if monitor_argv and command in self._cache and self.monitor_alive(monitor_argv):
+            return self._cache[command]
+        task = self._inflight.get(command)
+        if task is None:
+            task = asyncio.ensure_future(self._run_and_cache(command, monitor_argv))
+            self._inflight[command] = task
+            task.add_done_callback(lambda _: self._inflight.pop(command, None))
+        return await asyncio.shield(task)
+
+    async def _run_and_cache(self, command, monitor_argv):
+        if monitor_argv is None:
+            self._invalidate_tool(command)
+            return await self._execute(command)
+        monitor = self._ensure_monitor(monitor_argv)
+        generation = monitor["generation"] if monitor else None
+        result = await self._execute(command)
+        # Only cache if no change event arrived while the query was running
+        if result is not None and monitor and self.monitor_alive(monitor_argv) and monitor["generation"] == generation:
+            self._cache[command] = result
+        return result
+
+    async def _execute(self, command):
+        argv = _command_argv(command)
+        self.spawn_count += 1
+        try:
+            if argv: process = await asyncio.create_subprocess_exec(*argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            else: process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        except FileNotFoundError:
+            logging.warning(f"Error running command '{command}': {argv[0]} not found")
+            return None
+        stdout, stderr = await process.communicate()
+        if process.returncode != 0:
+            logging.error(f"Error running command '{command}': {stderr.decode().strip()}")
+            return None
+        return stdout.decode().strip()
+
+    def _invalidate_tool(self, command):
+        # A write through the same tool (e.g. "nmcli radio wifi off") makes its cached queries stale immediately
+        tool = command.split(maxsplit=1)[0] if command.strip() else None
+        for watched, monitor_argv in COMMAND_MONITORS.items():
+            if monitor_argv[0] == tool or watched.split(maxsplit=1)[0] == tool:
+                self._cache.pop(watched, None)
+
+    def monitor_alive(self, monitor_argv):
+        monitor = self._monitors.get(monitor_argv)
+        return bool(monitor and monitor["task"] and not monitor["task"].done())
+
+    def _ensure_monitor(self, monitor_argv):
+        monitor = self._monitors.setdefault(monitor_argv, {"task": None, "process": None, "generation": 0, "retry_at": 0.0})
+        if self.monitor_alive(monitor_argv): return monitor
+        if time.monotonic() < monitor["retry_at"]: return None
+        monitor["task"] = asyncio.ensure_future(self._watch(monitor_argv, monitor))
+        return monitor
+
+    async def _watch(self, monitor_argv, monitor):
+        try:
+            process = await asyncio.create_subprocess_exec(*monitor_argv, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            monitor["process"] = process
+            logging.info(f"Started monitor coprocess: {' '.join(monitor_argv)}")
+            while line := await process.stdout.readline():
+                monitor["generation"] += 1
+                for watched, argv in COMMAND_MONITORS.items():
+                    if argv == monitor_argv: self._cache.pop(watched, None)
+                for callback in self._listeners[monitor_argv]:
+                    try: callback(line.decode(errors="replace").strip())
+                    except Exception as e: logging.error(f"Monitor listener for {' '.join(monitor_argv)} failed: {e}")
+            await process.wait()
+            logging.warning(f"Monitor coprocess exited: {' '.join(monitor_argv)} (code {process.returncode})")
+        except (FileNotFoundError, PermissionError) as e:
+            logging.warning(f"Monitor coprocess unavailable: {' '.join(monitor_argv)} ({e}); queries will exec each time.")
+        finally:
+            monitor["generation"] += 1
+            monitor["retry_at"] = time.monotonic() + MONITOR_RETRY_SECONDS
+            for watched, argv in COMMAND_MONITORS.items():
+                if argv == monitor_argv: self._cache.pop(watched, None)
+            for callback in self._listeners[monitor_argv]:
+                try: callback(None)
+                except Exception as e: logging.error(f"Monitor listener for {' '.join(monitor_argv)} failed: {e}")
+            if self._listeners[monitor_argv] and not self._closing:
+                asyncio.get_running_loop().call_later(MONITOR_RETRY_SECONDS + 1, self._ensure_monitor, monitor_argv)
+
+    async def close(self):
+        """Stops all monitor coprocesses."""
+        self._closing = True
+        for monitor in self._monitors.values():
+            process = monitor["process"]
+            if process and process.returncode is None:
+                process.terminate()
+                try: await asyncio.wait_for(process.wait(), timeout=2)
+                except asyncio.TimeoutError: process.kill()
+            if monitor["task"]: monitor["task"].cancel()
+
+
+command_runner = CommandRunner()
+metrics.counter("device_assistant_command_spawns_total", "Processes spawned for device queries (monitors excluded).", func=lambda: command_runner.spawn_count)
+
+
+# --- Device State Cache ---
+# Linux only: volume/mute come from PulseAudio sink events, radio state from /dev/rfkill events and
+# NetworkManager (via `nmcli monitor`). Status intents read these fields instead of running a command.
+RFKILL_DEVICE = "/dev/rfkill"
+RFKILL_EVENT_SIZE = 8 # struct rfkill_event: u32 idx, u8 type, u8 op, u8 soft, u8 hard
+RFKILL_TYPE_WLAN = 1; RFKILL_TYPE_BLUETOOTH = 2
+RFKILL_OP_DEL = 1
+PULSE_RECONNECT_SECONDS = 5
+NM_MONITOR = ("nmcli", "monitor")
+
+
+class DeviceStateCache:
+    """Current volume, mute, Wi-Fi and Bluetooth state, updated from change notifications.
+
+    A field is None until its event source has reported it; callers then fall back to querying
+    the device directly. Listeners are called with a dict of the fields that changed.
+    """
+
+    def __init__(self):
+        self.state = {"volume": None, "muted": None, "wifi": None, "bluetooth": None}
+        self.pulse = None # Connected PulseAsync instance, reused for volume writes
+        self._rfkill_devices = {} # rfkill idx -> (type, soft, hard)
+        self._rfkill_fd = None
+        self._nm_live = False
+        self._nm_refresh = None
+        self._listeners = []
+        self._tasks = []
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def get(self, field):
+        return self.state[field]
+
+    def update(self, **fields):
+        changed = {k: v for k, v in fields.items() if self.state[k] != v}
+        if not changed: return
+        self.state.update(changed)
+        for callback in self._listeners:
+            try: callback(changed)
+            except Exception as e: logging.error(f"Device state listener failed: {e}")
+
+    def start(self):
+        """Starts all event sources available on this system. Missing sources are simply skipped."""
+        if not is_linux: return
+        self._tasks.append(asyncio.create_task(self._follow_pulse()))
+        self._open_rfkill()
+        command_runner.watch(NM_MONITOR, self._on_nm_event)
+        self._schedule_nm_refresh()
+
+    async def close(self):
+        for task in self._tasks: task.cancel()
+        if self._rfkill_fd is not None:
+            asyncio.get_running_loop().remove_reader(self._rfkill_fd)
+            os.close(self._rfkill_fd); self._rfkill_fd = None
+
+    # PulseAudio: default sink volume and mute
+    async def _follow_pulse(self):
+        pulsectl_asyncio = await pulse_backend.aget()
+        if pulsectl_asyncio is None: return
+        while True:
+            try:
+                async with pulsectl_asyncio.PulseAsync("device-assistant") as pulse:
+                    self.pulse = pulse
+                    await self._refresh_pulse()
+                    logging.info("Following PulseAudio sink events for volume state.")
+                    async for _event in pulse.subscribe_events("sink", "server"):
+                        await self._refresh_pulse()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"PulseAudio event source unavailable ({e}); retrying in {PULSE_RECONNECT_SECONDS}s.")
+            self.pulse = None
+            self.update(volume=None, muted=None)
+            await asyncio.sleep(PULSE_RECONNECT_SECONDS)
+
+    async def _refresh_pulse(self):
+        sink = await self.pulse.sink_default_get()
+        self.update(volume=int(round(sink.volume.value_flat * 100)), muted=bool(sink.mute))
+
+    # rfkill: kernel radio block state, delivered as fixed-size events on /dev/rfkill
+    def _open_rfkill(self):
+        try: self._rfkill_fd = os.open(RFKILL_DEVICE, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            logging.warning(f"Cannot watch {RFKILL_DEVICE} ({e}); radio status will be queried on demand.")
+            return
+        # On open the kernel replays an ADD event for every existing device, so this also loads the initial state
+        asyncio.get_running_loop().add_reader(self._rfkill_fd, self._read_rfkill)
+
+    def _read_rfkill(self):
+        while True:
+            try: data = os.read(self._rfkill_fd, RFKILL_EVENT_SIZE)
+            except BlockingIOError: break
+            if len(data) < RFKILL_EVENT_SIZE: break
+            idx, rf_type, op, soft, hard = struct.unpack("<IBBBB", data)
+            if op == RFKILL_OP_DEL: self._rfkill_devices.pop(idx, None)
+            else: self._rfkill_devices[idx] = (rf_type, soft, hard)
+        fields = {"bluetooth": self._rfkill_state(RFKILL_TYPE_BLUETOOTH)}
+        if not self._nm_live: fields["wifi"] = self._rfkill_state(RFKILL_TYPE_WLAN)
+        self.update(**fields)
+
+    def _rfkill_state(self, rf_type):
+        blocks = [(soft, hard) for t, soft, hard in self._rfkill_devices.values() if t == rf_type]
+        if not blocks: return None
+        # Report in the same vocabulary as the command-based status queries
+        on = any(not soft and not hard for soft, hard in blocks)
+        if rf_type == RFKILL_TYPE_WLAN: return "enabled" if on else "disabled"
+        return "on" if on else "off"
+
+    # NetworkManager: Wi-Fi radio switch, re-read whenever `nmcli monitor` reports a change
+    def _on_nm_event(self, line):
+        if line is not None: self._schedule_nm_refresh(); return
+        # Monitor stopped: fall back to rfkill, or to on-demand queries if that is unavailable too
+        self._nm_live = False
+        self.update(wifi=self._rfkill_state(RFKILL_TYPE_WLAN) if self._rfkill_fd is not None else None)
+
+    def _schedule_nm_refresh(self):
+        if self._nm_refresh is None or self._nm_refresh.done():
+            self._nm_refresh = asyncio.ensure_future(self._refresh_nm())
+
+    async def _refresh_nm(self):
+        result = await command_runner.run("nmcli radio wifi")
+        self._nm_live = result is not None and command_runner.monitor_alive(NM_MONITOR)
+        if self._nm_live: self.update(wifi=result.lower().strip())
+
+
+device_state = DeviceStateCache()
 
 
 # ——— New: status queries —————————————————————————————————————
 async def get_wifi_status() -> str:
     # Run the command; _run_command returns a single string (or None)
     if sys.platform.startswith("linux"):
-        result = await _run_command("nmcli radio wifi")
-        state = result.lower().strip() if result else "unknown"
+        state = device_state.get("wifi")
+        if state is None:
+            result = await _run_command("nmcli radio wifi")
+            state = result.lower().strip() if result else "unknown"
 
     elif sys.platform == "darwin":
         # get device identifier
@@ -347,8 +2032,10 @@ async def get_wifi_status() -> str:
 
 async def get_bluetooth_status() -> str:
     if sys.platform.startswith("linux"):
-        out = await _run_command("rfkill list bluetooth")
-        state = "off" if out and "Soft blocked: yes" in out else "on"
+        state = device_state.get("bluetooth")
+        if state is None:
+            out = await _run_command("rfkill list bluetooth")
+            state = "off" if out and "Soft blocked: yes" in out else "on"
 
     elif sys.platform == "darwin":
         out = await _run_command("blueutil --power")
@@ -401,6 +2088,7 @@ def set_brightness(level: int) -> str:
                 return f"Brightness set to {level}% on macOS via brightness command."
         
         # Existing cross-platform logic for non-macOS
+        sbc = brightness_backend.get()
         if sbc:
             sbc.set_brightness(level)
             return f"Brightness set to {level}%"
@@ -482,7 +2170,7 @@ async def toggle_bluetooth(state: str) -> str:
     if sys.platform == 'darwin':
         # Requires 'blueutil' (brew install blueutil)
         try:
-            status_code = subprocess.call(['blueutil', '--power', '1' if state == 'on' else '0'])
+            status_code = await run_blocking(subprocess.call, ['blueutil', '--power', '1' if state == 'on' else '0'])
             if status_code == 0:
                 return f"Bluetooth toggled {state} on macOS (using blueutil)."
             else:
@@ -527,17 +2215,144 @@ async def toggle_bluetooth(state: str) -> str:
     # return f"Bluetooth toggle {state} - Platform specific implementation needed."
 
 
-def get_cpu_usage() -> str:
-    """Gets the current CPU usage percentage."""
+# --- CPU Sampler ---
+CPU_SAMPLE_INTERVAL = 0.25 # Seconds between psutil.cpu_times snapshots
+CPU_HISTORY_SECONDS = 15 # Longest averaging window kept in the ring buffer
+CPU_AVERAGE_WINDOWS = (1, 5, 15)
+
+
+def _cpu_busy_total(times):
+    """Busy and total CPU seconds of a cpu_times entry, using the same accounting as psutil.cpu_percent."""
+    total = sum(times)
+    if is_linux: total -= getattr(times, "guest", 0) + getattr(times, "guest_nice", 0) # Already counted in user/nice
+    busy = total - times.idle - getattr(times, "iowait", 0)
+    return busy, total
+
+
+class CpuSampler:
+    """Samples psutil.cpu_times on a fixed cadence and keeps a ring buffer of utilisation.
+
+    Each entry holds the cumulative busy/total CPU seconds alongside the per-interval percentages,
+    so the average over any window inside the buffer is a single subtraction instead of a new sample.
+    """
+
+    def __init__(self, interval=CPU_SAMPLE_INTERVAL, history_seconds=CPU_HISTORY_SECONDS):
+        self.interval = interval
+        # (monotonic timestamp, cumulative busy, cumulative total, total %, per-core % tuple)
+        self._samples = collections.deque(maxlen=int(history_seconds / interval) + 2)
+        self._last_per_core = None
+        self._task = None
+
+    def sample(self):
+        """Takes one cpu_times snapshot and appends the utilisation since the previous one."""
+        per_core = [_cpu_busy_total(t) for t in psutil.cpu_times(percpu=True)]
+        now = time.monotonic()
+        busy = sum(b for b, _ in per_core); total = sum(t for _, t in per_core)
+        if self._last_per_core is not None and len(self._last_per_core) == len(per_core):
+            core_percents = tuple(_percent(b - lb, t - lt) for (b, t), (lb, lt) in zip(per_core, self._last_per_core))
+            _, last_busy, last_total, _, _ = self._samples[-1]
+            self._samples.append((now, busy, total, _percent(busy - last_busy, total - last_total), core_percents))
+        else:
+            self._samples.clear() # First sample (or a CPU hot-plug): only a baseline, no utilisation yet
+            self._samples.append((now, busy, total, None, None))
+        self._last_per_core = per_core
+
+    def start(self):
+        """Starts the background sampling task on the running loop (no-op if already running)."""
+        if psutil and (self._task is None or self._task.done()):
+            self.sample()
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try: self.sample()
+            except Exception as e: logging.error(f"CPU sampling failed: {e}")
+
+    @property
+    def ready(self):
+        return len(self._samples) > 1
+
+    def latest(self):
+        """Total utilisation over the most recent sampling interval, or None before two samples exist."""
+        return self._samples[-1][3] if self.ready else None
+
+    def latest_per_core(self):
+        return list(self._samples[-1][4]) if self.ready else None
+
+    def _window_start(self, window):
+        """The entry an average over the last `window` seconds is taken from (clamped to the buffered history)."""
+        now = self._samples[-1][0]
+        oldest = self._samples[0]
+        for entry in reversed(self._samples):
+            if now - entry[0] > window: break
+            oldest = entry
+        return self._samples[-2] if oldest is self._samples[-1] else oldest # Window shorter than one interval: the latest
+
+    def average(self, window):
+        """Average total utilisation over the last `window` seconds (clamped to the buffered history)."""
+        if not self.ready: return None
+        _, busy, total, _, _ = self._samples[-1]
+        oldest = self._window_start(window)
+        return _percent(busy - oldest[1], total - oldest[2])
+
+    def span(self, window):
+        """Seconds average(window) actually covers: at most the buffered history, at least one interval."""
+        return self._samples[-1][0] - self._window_start(window)[0] if self.ready else None
+
+
+def _percent(busy_delta, total_delta):
+    if total_delta <= 0: return 0.0
+    return round(max(0.0, min(100.0, 100.0 * busy_delta / total_delta)), 1)
+
+
+cpu_sampler = CpuSampler()
+
+
+def get_cpu_usage(window: float = None) -> str:
+    """Gets the current CPU usage percentage, optionally averaged over the last `window` seconds.
+
+    Served from the background sampler, so the call costs microseconds instead of a blocking sample. The reply
+    names the span the average really covers, which is shorter than `window` when the history does not reach back.
+    """
+    if window is not None:
+        try: window = float(window)
+        except (TypeError, ValueError): window = math.nan
+        if not window > 0: return "Error: CPU usage window must be a positive number of seconds."
     if psutil:
         try:
-            # interval=0.1 gives a short sample time for a more instant reading
-            usage = psutil.cpu_percent(interval=0.1)
-            return f"CPU Usage: {usage}%"
+            if not cpu_sampler.ready:
+                # Sampler not running (or just started): non-blocking reading since the previous call
+                return f"CPU Usage: {psutil.cpu_percent(interval=None)}%"
+            if window is not None:
+                return f"CPU Usage: {cpu_sampler.average(window)}% ({round(cpu_sampler.span(window), 1):g}s average)"
+            return f"CPU Usage: {cpu_sampler.latest()}%"
         except Exception as e:
             return f"Error getting CPU usage: {e}"
     return "Error: psutil library missing or failed to initialize."
 
+
+def get_cpu_per_core() -> str:
+    """Gets the latest per-core CPU usage percentages as a JSON string."""
+    if not psutil: return json.dumps({"error": "psutil library missing or failed to initialize."})
+    per_core = cpu_sampler.latest_per_core()
+    if per_core is None: per_core = psutil.cpu_percent(interval=None, percpu=True)
+    return json.dumps({
+        "per_core": per_core,
+        "status_text": "CPU Per Core: " + ", ".join(f"{p}%" for p in per_core),
+    })
+
+
+def get_cpu_averages() -> str:
+    """Gets the 1/5/15 second CPU usage averages as a JSON string."""
+    if not psutil: return json.dumps({"error": "psutil library missing or failed to initialize."})
+    if not cpu_sampler.ready: return json.dumps({"error": "CPU sampler has not collected enough data yet."})
+    averages = {f"{w}s": cpu_sampler.average(w) for w in CPU_AVERAGE_WINDOWS}
+    return json.dumps({
+        "averages": averages,
+        "status_text": "CPU Average: " + ", ".join(f"{v}% ({k})" for k, v in averages.items()),
+    })
+
 def get_memory_usage() -> str:
     """Gets the current virtual memory usage percentage."""
     if psutil:
@@ -586,6 +2401,10 @@ async def set_volume(level: int) -> str:
                 return f"Error setting volume on macOS. Command: '{command}'"
 
         elif sys.platform.startswith('linux'):
+            if device_state.pulse is not None:
+                sink = await device_state.pulse.sink_default_get()
+                await device_state.pulse.volume_set_all_chans(sink, level / 100.0)
+                return f"Volume set to {level}% on Linux (using PulseAudio)."
             # Assumes 'amixer' is installed (usually part of alsa-utils)
             # Finds the default 'Master' control. Might need adjustment based on system config.
             command = f"amixer sset Master {level}%"
@@ -634,6 +2453,10 @@ async def get_volume() -> str:
 
 
         elif sys.platform.startswith('linux'):
+            level = device_state.get("volume")
+            if level is not None: # Kept current by PulseAudio sink events
+                if device_state.get("muted"): return f"Current Volume: Muted ({level}%) (Linux)"
+                return f"Current Volume: {level}% (Linux)"
             # Assumes 'amixer' is installed. Parses output like: "[80%] [-10.00dB] [on]"
             command = "amixer sget Master"
             result = await _run_command(command)
@@ -743,17 +2566,1363 @@ def execute_shell_command(command):
         return result_data
 
 
+# --- Streaming Shell Executor ---
+# Streams stdout/stderr chunks to the client as they arrive. Memory per command is bounded: chunks are
+# forwarded and dropped, and only a tail of each stream is kept for the final result and history.
+# Only v2 requests stream, unless they send "stream": false; plain-text commands keep the single result reply.
+SHELL_STREAMING = os.getenv("SHELL_STREAMING", "true").lower() == "true"
+SHELL_STREAM_TIMEOUT = int(os.getenv("SHELL_STREAM_TIMEOUT", "600")) # Streamed commands may run for minutes (e.g. installs)
+SHELL_STREAM_CHUNK_BYTES = 4096
+SHELL_OUTPUT_MAX_BYTES = int(os.getenv("SHELL_OUTPUT_MAX_BYTES", str(1024 * 1024))) # Per stream; the rest is counted, not sent
+SHELL_TAIL_BYTES = int(os.getenv("SHELL_TAIL_BYTES", "8192")) # Per stream, kept for the final frame
+SHELL_KILL_GRACE_SECONDS = float(os.getenv("SHELL_KILL_GRACE_SECONDS", "5")) # From SIGTERM to SIGKILL for a timed out or cancelled command
+
+
+class TailBuffer:
+    """Keeps the last `max_bytes` bytes written to it."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._chunks = collections.deque()
+        self._size = 0
+        self.total = 0
+
+    def append(self, chunk):
+        self.total += len(chunk)
+        self._chunks.append(chunk); self._size += len(chunk)
+        while self._size > self.max_bytes:
+            excess = self._size - self.max_bytes
+            if len(self._chunks[0]) <= excess: self._size -= len(self._chunks.popleft())
+            else: self._chunks[0] = self._chunks[0][excess:]; self._size -= excess
+
+    def text(self):
+        return b"".join(self._chunks).decode(errors="replace")
+
+
+class ShellJob:
+    """One streamed shell command. `run()` returns the same structured dict as execute_shell_command."""
+
+    def __init__(self, command_id, command, send):
+        self.command_id = command_id
+        self.command = command
+        self._send = send # Coroutine function taking a frame dict
+        self._process = None
+        self.cancelled = False
+
+    async def run(self):
+        result_data = {"command": self.command, "command_id": self.command_id, "success": False, "exit_code": -1,
+                       "stdout": "", "stderr": "", "error_message": None, "truncated_bytes": 0, "cancelled": False}
+        logging.warning(f"🛑 EXECUTING SHELL COMMAND (streamed): {self.command}")
+        tails = {"stdout": TailBuffer(SHELL_TAIL_BYTES), "stderr": TailBuffer(SHELL_TAIL_BYTES)}
+        try:
+            self._process = await asyncio.create_subprocess_shell(
+                self.command, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                start_new_session=(os.name == "posix")) # Own process group, so cancel also stops its children
+            if self.cancelled: self.cancel() # Cancelled while the process was being spawned
+            await asyncio.wait_for(asyncio.gather(
+                self._pump("stdout", self._process.stdout, tails["stdout"]),
+                self._pump("stderr", self._process.stderr, tails["stderr"]),
+                self._process.wait()), timeout=SHELL_STREAM_TIMEOUT)
+            result_data["exit_code"] = self._process.returncode
+        except asyncio.TimeoutError:
+            result_data["exit_code"] = await self._stop()
+            result_data["error_message"] = f"Command timed out after {SHELL_STREAM_TIMEOUT} seconds."
+        except Exception as e:
+            logging.exception(f"Error executing shell command '{self.command}': {e}")
+            result_data["exit_code"] = await self._stop()
+            result_data["error_message"] = f"Error executing shell command: {e}"
+        if self.cancelled: result_data["cancelled"] = True; result_data["error_message"] = "Command cancelled by client."
+        result_data["stdout"] = tails["stdout"].text().strip()
+        result_data["stderr"] = tails["stderr"].text().strip()
+        result_data["truncated_bytes"] = sum(max(0, t.total - SHELL_OUTPUT_MAX_BYTES) for t in tails.values())
+        # Same criterion as execute_shell_command: exit code 0 AND empty stderr
+        result_data["success"] = (result_data["exit_code"] == 0 and tails["stderr"].total == 0 and not self.cancelled)
+        return result_data
+
+    async def _pump(self, stream_name, stream, tail):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace") # Never split a multi-byte character
+        while chunk := await stream.read(SHELL_STREAM_CHUNK_BYTES):
+            forwarded = tail.total
+            tail.append(chunk)
+            if forwarded >= SHELL_OUTPUT_MAX_BYTES: continue
+            text = decoder.decode(chunk[:SHELL_OUTPUT_MAX_BYTES - forwarded])
+            if text:
+                try: await self._send({"type": "shell_output", "command_id": self.command_id, "stream": stream_name, "data": text})
+                except websockets.exceptions.ConnectionClosed: self.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        self._kill()
+        # run() is still waiting for the process; one that ignores SIGTERM is killed after the grace period
+        if self._process is not None: asyncio.get_running_loop().call_later(SHELL_KILL_GRACE_SECONDS, self._kill, True)
+
+    async def _stop(self):
+        """Terminates the process, kills it if it outlives SHELL_KILL_GRACE_SECONDS, and reaps it. Returns its exit code."""
+        if self._process is None: return -1
+        self._kill()
+        try: await asyncio.wait_for(self._process.wait(), SHELL_KILL_GRACE_SECONDS)
+        except asyncio.TimeoutError:
+            self._kill(force=True)
+            await self._process.wait()
+        return self._process.returncode
+
+    def _kill(self, force=False):
+        """SIGTERM (SIGKILL with `force`) to the command's process group."""
+        if self._process is None or self._process.returncode is not None: return
+        try:
+            if os.name == "posix": os.killpg(self._process.pid, signal.SIGKILL if force else signal.SIGTERM)
+            elif force: self._process.kill()
+            else: self._process.terminate()
+        except ProcessLookupError:
+            pass
+
+
+def start_shell_job(session, command):
+    """Starts a streamed shell command for a session and returns the 'running' acknowledgement."""
+    command_id = uuid.uuid4().hex[:12]
+    job = ShellJob(command_id, command, session.send)
+    session.shell_jobs[command_id] = job
+
+    async def run_job():
+        intent_cache.invalidate_for("run_shell_command")
+        try:
+            async with intent_semaphore("run_shell_command"):
+                if job.cancelled: result = {"command": command, "command_id": command_id, "success": False, "exit_code": -1, "stdout": "", "stderr": "", "error_message": "Command cancelled by client.", "truncated_bytes": 0, "cancelled": True}
+                else: result = await job.run()
+        except Exception as e:
+            logging.exception(f"Error running shell job {command_id} ('{command}'): {e}")
+            result = {"command": command, "command_id": command_id, "success": False, "exit_code": -1, "stdout": "", "stderr": "", "error_message": "Server error occurred.", "truncated_bytes": 0, "cancelled": False}
+        finally:
+            session.shell_jobs.pop(command_id, None)
+            intent_cache.invalidate_for("run_shell_command")
+        session.record_shell_result(result)
+        session.history.append(("assistant", json.dumps(result)))
+        try: await session.send({"type": "shell_exit", "command_id": command_id, "exit_code": result["exit_code"], "response": result})
+        except websockets.exceptions.ConnectionClosed: pass
+
+    task = asyncio.create_task(run_job())
+    session.shell_tasks.add(task); task.add_done_callback(session.shell_tasks.discard)
+    return {"command": command, "command_id": command_id, "status": "running"}
+
+
+# --- System Snapshot ---
+# Every dashboard metric as one typed JSON object, gathered concurrently. The base metrics go through
+# run_intent (sharing the result cache and concurrency limits with the individual intents) and their
+# display strings are converted to plain values here, once, instead of by regexes in every client.
+# A section that fails is reported as {"error": ...} without failing the rest of the snapshot.
+SNAPSHOT_METRICS = {
+    "cpu": "get_cpu_usage",
+    "memory": "get_memory_usage",
+    "volume": "get_volume",
+    "battery": "get_battery_status",
+    "wifi": "get_wifi_status",
+    "bluetooth": "get_bluetooth_status",
+}
+SNAPSHOT_DISK_PATH = os.getenv("SNAPSHOT_DISK_PATH", os.path.abspath(os.sep))
+SNAPSHOT_TOP_PROCESSES = int(os.getenv("SNAPSHOT_TOP_PROCESSES", "5"))
+_PERCENT_RE = re.compile(r"(\d+(?:\.\d+)?)%")
+
+
+def _typed_percent(text):
+    m = _PERCENT_RE.search(text)
+    return {"percent": float(m.group(1)) if m else None}
+
+
+def _typed_volume(text):
+    m = _PERCENT_RE.search(text)
+    return {"level": int(float(m.group(1))) if m else None, "muted": "Muted" in text}
+
+
+def _typed_radio(text):
+    state = text.rpartition(":")[2].strip().lower()
+    return {"enabled": {"on": True, "enabled": True, "off": False, "disabled": False}.get(state), "state": state}
+
+
+_SNAPSHOT_CONVERTERS = {
+    "cpu": _typed_percent,
+    "memory": _typed_percent,
+    "volume": _typed_volume,
+    "battery": json.loads, # Already a JSON string
+    "wifi": _typed_radio,
+    "bluetooth": _typed_radio,
+}
+
+
+def typed_metric(metric, result):
+    """Converts a base metric handler's result to a typed value ({"error": ...} for error strings)."""
+    if isinstance(result, str) and (result.startswith("Error") or result.startswith("An unexpected error")): return {"error": result}
+    return _SNAPSHOT_CONVERTERS[metric](result)
+
+
+def _read_disk():
+    usage = psutil.disk_usage(SNAPSHOT_DISK_PATH)
+    return {"path": SNAPSHOT_DISK_PATH, "percent": usage.percent, "used": usage.used, "total": usage.total}
+
+
+_last_net_io = None # (monotonic time, bytes_sent, bytes_recv) of the previous network sample
+
+def _read_network():
+    """Bytes per second sent/received since the previous sample (None on the first one)."""
+    global _last_net_io
+    counters = psutil.net_io_counters()
+    now = time.monotonic()
+    previous, _last_net_io = _last_net_io, (now, counters.bytes_sent, counters.bytes_recv)
+    if previous is None or now <= previous[0]: return {"sent_bps": None, "recv_bps": None}
+    elapsed = now - previous[0]
+    return {"sent_bps": round((counters.bytes_sent - previous[1]) / elapsed), "recv_bps": round((counters.bytes_recv - previous[2]) / elapsed)}
+
+
+def _read_temperatures():
+    """Hottest current reading per sensor chip, in degrees Celsius."""
+    if not hasattr(psutil, "sensors_temperatures"): return {"error": "Temperature sensors are not supported on this platform."}
+    return {chip: max(entry.current for entry in entries) for chip, entries in psutil.sensors_temperatures().items() if entries}
+
+
+def _read_top_processes():
+    """Processes using the most CPU since the previous sample (psutil keeps the Process objects between calls)."""
+    processes = [p.info for p in psutil.process_iter(["pid", "name", "cpu_percent", "memory_percent"])]
+    processes.sort(key=lambda info: info["cpu_percent"] or 0.0, reverse=True)
+    return [{"pid": info["pid"], "name": info["name"], "cpu_percent": info["cpu_percent"],
+             "memory_percent": round(info["memory_percent"] or 0.0, 1)} for info in processes[:SNAPSHOT_TOP_PROCESSES]]
+
+
+SNAPSHOT_EXTRAS = {
+    # Optional sections read straight from psutil on the I/O pool
+    "disk": _read_disk,
+    "network": _read_network,
+    "temperatures": _read_temperatures,
+    "processes": _read_top_processes,
+}
+
+
+async def _snapshot_section(section):
+    if section in SNAPSHOT_METRICS: return typed_metric(section, await run_intent(SNAPSHOT_METRICS[section], {}))
+    if not psutil: return {"error": "psutil library missing or failed to initialize."}
+    return await run_blocking(SNAPSHOT_EXTRAS[section])
+
+
+async def collect_snapshot(sections):
+    """Samples the given sections concurrently. Failures are reported per section, not raised."""
+    sections = list(sections)
+    results = await asyncio.gather(*(_snapshot_section(s) for s in sections), return_exceptions=True)
+    return {section: {"error": f"Error sampling {section}: {result}"} if isinstance(result, Exception) else result
+            for section, result in zip(sections, results)}
+
+
+async def get_system_snapshot(include=None) -> str:
+    """Gets all dashboard metrics as one JSON object; `include` adds optional sections from SNAPSHOT_EXTRAS."""
+    include = [include] if isinstance(include, str) else list(include or ())
+    unknown = [section for section in include if section not in SNAPSHOT_EXTRAS]
+    if unknown: return json.dumps({"error": f"Unknown snapshot sections: {', '.join(unknown)}. Available: {', '.join(SNAPSHOT_EXTRAS)}"})
+    return json.dumps({"ts": time.time(), "metrics": await collect_snapshot([*SNAPSHOT_METRICS, *include])})
+
+
+# --- Metric History ---
+# CPU, memory, battery and volume are sampled every HISTORY_SAMPLE_INTERVAL seconds into fixed-width records in
+# memory-mapped ring files, one per tier: raw samples, then 1 min and 1 h means rolled up from the tier below.
+# Every tier keeps a fixed number of records, so the files never grow (about 2.8 MB with the defaults) and the
+# oldest records are overwritten first. A range query reads the coarsest tier that is still fine enough for the
+# requested number of points and averages it down, so a dashboard can backfill a graph with one request.
+HISTORY_DIR = os.getenv("HISTORY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "history")) # Empty disables recording
+HISTORY_SAMPLE_INTERVAL = 1 # Seconds; the finest tier holds one record per sample
+HISTORY_METRICS = ("cpu", "memory", "battery", "volume")
+HISTORY_TIERS = (
+    # (name, seconds per record, records kept)
+    ("1s", HISTORY_SAMPLE_INTERVAL, int(os.getenv("HISTORY_1S_RECORDS", str(24 * 3600)))), # One day
+    ("1m", 60, int(os.getenv("HISTORY_1M_RECORDS", str(30 * 24 * 60)))), # 30 days
+    ("1h", 3600, int(os.getenv("HISTORY_1H_RECORDS", str(2 * 365 * 24)))), # Two years
+)
+HISTORY_MAX_POINTS = 2000
+_HISTORY_MAGIC = b"DAHIST01"
+_HISTORY_HEADER = struct.Struct("<8sIIQ") # magic, record size, capacity, records ever written
+_HISTORY_RECORD = struct.Struct("<I" + "f" * len(HISTORY_METRICS)) # Unix time, then one float32 per metric (NaN = no value)
+_HISTORY_VALUE_FIELDS = {"cpu": "percent", "memory": "percent", "battery": "percent", "volume": "level"}
+
+
+class HistoryRing:
+    """Fixed-capacity ring of history records in a memory-mapped file, oldest record at logical index 0.
+
+    Indexing returns record timestamps, so the ring can be binary-searched with bisect.
+    """
+
+    def __init__(self, path, capacity):
+        self.capacity = capacity
+        size = _HISTORY_HEADER.size + capacity * _HISTORY_RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.pread(fd, _HISTORY_HEADER.size, 0)
+            valid = (os.fstat(fd).st_size == size and len(header) == _HISTORY_HEADER.size
+                     and _HISTORY_HEADER.unpack(header)[:3] == (_HISTORY_MAGIC, _HISTORY_RECORD.size, capacity))
+            if not valid:
+                if len(header): logging.warning(f"History file {path} has another format or capacity; starting it afresh.")
+                os.ftruncate(fd, 0); os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally: os.close(fd) # The mapping keeps its own reference
+        if not valid: _HISTORY_HEADER.pack_into(self._map, 0, _HISTORY_MAGIC, _HISTORY_RECORD.size, capacity, 0)
+        self.written = _HISTORY_HEADER.unpack_from(self._map)[3]
+        self.last_ts = self[len(self) - 1] if len(self) else 0
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def _offset(self, index):
+        return _HISTORY_HEADER.size + ((self.written - len(self) + index) % self.capacity) * _HISTORY_RECORD.size
+
+    def __getitem__(self, index):
+        return struct.unpack_from("<I", self._map, self._offset(index))[0]
+
+    def append(self, ts, values):
+        _HISTORY_RECORD.pack_into(self._map, _HISTORY_HEADER.size + (self.written % self.capacity) * _HISTORY_RECORD.size, ts, *values)
+        self.written += 1
+        struct.pack_into("<Q", self._map, _HISTORY_HEADER.size - 8, self.written)
+        self.last_ts = ts
+
+    def read(self, start, end):
+        """The raw records with start <= ts < end, oldest first."""
+        lo, hi = bisect.bisect_left(self, start), bisect.bisect_left(self, end)
+        if lo >= hi: return b""
+        first, last = self._offset(lo), self._offset(hi - 1) + _HISTORY_RECORD.size
+        if first < last: return self._map[first:last]
+        return self._map[first:] + self._map[_HISTORY_HEADER.size:last] # The range wraps around the end of the file
+
+    def refresh(self):
+        """Re-reads the record count, for a ring another process appends to."""
+        self.written = _HISTORY_HEADER.unpack_from(self._map)[3]
+
+    def close(self):
+        self._map.flush(); self._map.close()
+
+
+class MetricHistory:
+    """Samples HISTORY_METRICS into the tier rings, rolls each tier up into the next and answers range queries."""
+
+    def __init__(self, directory, tiers):
+        self.directory = directory
+        self.tiers = tiers
+        self.rings = {} # tier name -> HistoryRing, opened by start()
+        self._buckets = {} # tier name -> [bucket start, sums, counts] being averaged into that tier
+        self._lock = threading.Lock() # Queries run on the CPU pool while the loop appends
+        self._task = None
+        self.following = False # Reading rings another process records (workers)
+
+    def start(self):
+        """Opens the tier files and starts sampling on the running loop (no-op if disabled or already running)."""
+        if not self.directory or (self._task is not None and not self._task.done()): return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for name, _, capacity in self.tiers: self.rings[name] = HistoryRing(os.path.join(self.directory, f"{name}.ring"), capacity)
+        except OSError as e:
+            logging.warning(f"Metric history unavailable ({e}); not recording."); self.rings = {}
+            return
+        self._seed_buckets()
+        self._task = asyncio.create_task(self._run())
+
+    def follow(self):
+        """Opens the tier files for queries only; the supervisor process records them."""
+        try: self.rings = {name: HistoryRing(os.path.join(self.directory, f"{name}.ring"), capacity) for name, _, capacity in self.tiers} if self.directory else {}
+        except OSError as e: logging.warning(f"Metric history unavailable ({e})."); self.rings = {}
+        self.following = True
+
+    def close(self):
+        if self._task: self._task.cancel()
+        with self._lock:
+            for ring in self.rings.values(): ring.close()
+            self.rings = {}
+
+    def _seed_buckets(self):
+        """Restores the partial buckets of a previous run from the finer tier, so a restart loses no samples."""
+        for (finer, _, _), (name, step, _) in zip(self.tiers, self.tiers[1:]):
+            ring = self.rings[finer]
+            bucket = ring.last_ts // step * step
+            if not len(ring) or bucket <= self.rings[name].last_ts: continue
+            for record in _HISTORY_RECORD.iter_unpack(ring.read(bucket, ring.last_ts + 1)): self._accumulate(name, step, record[0], record[1:])
+
+    async def _run(self):
+        while True:
+            # Wake on interval boundaries, so consecutive samples get consecutive timestamps
+            await asyncio.sleep(HISTORY_SAMPLE_INTERVAL - time.time() % HISTORY_SAMPLE_INTERVAL)
+            try: self.record(int(time.time()), await self.sample())
+            except Exception as e: logging.error(f"Metric history sampling failed: {e}")
+
+    async def sample(self):
+        snapshot = await collect_snapshot(HISTORY_METRICS)
+        values = []
+        for metric in HISTORY_METRICS:
+            value = snapshot[metric].get(_HISTORY_VALUE_FIELDS[metric]) if isinstance(snapshot[metric], dict) else None
+            values.append(float(value) if isinstance(value, (int, float)) else math.nan)
+        return values
+
+    def record(self, ts, values):
+        """Appends one sample at Unix time `ts` to the finest tier and rolls it up."""
+        name, step, _ = self.tiers[0]
+        with self._lock:
+            if not self.rings or ts <= self.rings[name].last_ts: return # Not recording, or the clock went back
+            self.rings[name].append(ts, values)
+            for name, step, _ in self.tiers[1:]:
+                flushed = self._accumulate(name, step, ts, values)
+                if flushed is None: break
+                ts, values = flushed
+
+    def _accumulate(self, name, step, ts, values):
+        """Adds a record to the tier's open bucket. Returns the (ts, means) appended if a finished bucket was flushed."""
+        bucket_start = ts // step * step
+        bucket = self._buckets.get(name)
+        flushed = None
+        if bucket is not None and bucket[0] != bucket_start:
+            means = [total / count if count else math.nan for total, count in zip(bucket[1], bucket[2])]
+            self.rings[name].append(bucket[0], means)
+            flushed = (bucket[0], means)
+            bucket = None
+        if bucket is None: bucket = self._buckets[name] = [bucket_start, [0.0] * len(values), [0] * len(values)]
+        for i, value in enumerate(values):
+            if not math.isnan(value): bucket[1][i] += value; bucket[2][i] += 1
+        return flushed
+
+    def _pick_tier(self, start, width):
+        """The coarsest tier that covers `start` at a resolution of `width` seconds, else the finest covering one."""
+        tiers = [(name, step) for name, step, _ in self.tiers if len(self.rings[name])]
+        covering = [(name, step) for name, step in tiers if self.rings[name][0] <= start]
+        for name, step in reversed(covering):
+            if step <= width: return name, step
+        if covering: return covering[0]
+        # Nothing reaches back that far: the tier with the oldest data (the finest of equals)
+        return min(tiers, key=lambda tier: (self.rings[tier[0]][0], tier[1])) if tiers else (None, None)
+
+    def query(self, start, end, points, metrics):
+        """At most `points` averaged points per metric for start <= ts < end, as columns."""
+        width = max((end - start) / points, HISTORY_SAMPLE_INTERVAL)
+        with self._lock:
+            if not self.rings: return {"error": "Metric history is not being recorded (HISTORY_DIR is empty or unavailable)."}
+            if self.following:
+                for ring in self.rings.values(): ring.refresh()
+            tier, step = self._pick_tier(start, width)
+            data = self.rings[tier].read(start, end) if tier else b""
+        columns = [HISTORY_METRICS.index(metric) + 1 for metric in metrics]
+        indices, values = [], {metric: [] for metric in metrics}
+        # Records are in time order, so each point is one run of consecutive records
+        for index, group in itertools.groupby(_HISTORY_RECORD.iter_unpack(data), key=lambda record: int((record[0] - start) // width)):
+            rows = list(group)
+            indices.append(index)
+            for metric, column in zip(metrics, columns):
+                present = [row[column] for row in rows if row[column] == row[column]] # NaN != NaN
+                values[metric].append(round(sum(present) / len(present), 1) if present else None)
+        return {"start": start, "end": end, "tier": tier, "step": max(width, step or 0),
+                "ts": [round(start + index * width, 3) for index in indices], "values": values}
+
+
+metric_history = MetricHistory(HISTORY_DIR, HISTORY_TIERS)
+
+
+def get_metric_history(window=3600, points=120, metrics=None, end=None) -> str:
+    """Recorded metric history for the `window` seconds before `end` (default now), averaged to at most `points` points."""
+    metrics = [metrics] if isinstance(metrics, str) else list(metrics or HISTORY_METRICS)
+    unknown = [metric for metric in metrics if metric not in HISTORY_METRICS]
+    if unknown: return json.dumps({"error": f"Unknown history metrics: {', '.join(map(str, unknown))}. Available: {', '.join(HISTORY_METRICS)}"})
+    try: window, points, end = float(window), int(points), time.time() if end is None else float(end)
+    except (TypeError, ValueError): return json.dumps({"error": "'window', 'points' and 'end' must be numbers."})
+    if window <= 0 or not 1 <= points <= HISTORY_MAX_POINTS: return json.dumps({"error": f"'window' must be positive and 'points' between 1 and {HISTORY_MAX_POINTS}."})
+    return json.dumps(metric_history.query(end - window, end, points, metrics))
+
+
 # --- Intent to Function Mapping (Unchanged) ---
 INTENT_HANDLERS = {
     "set_brightness": set_brightness, "toggle_wifi": toggle_wifi, "toggle_bluetooth": toggle_bluetooth,
     "get_cpu_usage": get_cpu_usage, "get_memory_usage": get_memory_usage,
+    "get_cpu_per_core": get_cpu_per_core, "get_cpu_averages": get_cpu_averages,
     "set_volume": set_volume, "get_volume": get_volume, "get_battery_status": get_battery_status,
     "run_shell_command": execute_shell_command,
     "get_wifi_status": get_wifi_status,
     "get_bluetooth_status": get_bluetooth_status,
+    "get_system_snapshot": get_system_snapshot,
+    "get_metric_history": get_metric_history,
 }
 
 
+# --- Intent Dispatch ---
+# Every handler runs according to its execution class so a slow call never stalls the event loop:
+#   "async" - coroutine, awaited on the loop
+#   "inline" - non-blocking sync call costing microseconds, called directly on the loop
+#   "io"    - blocking call (subprocess, sysfs, DDC/CI), run on the I/O thread pool
+#   "cpu"   - sampling/computation, run on a separate pool so it cannot be starved by I/O waits
+# The limit caps concurrent calls per intent, so e.g. long shell commands can never occupy the whole I/O pool.
+IO_POOL_WORKERS = int(os.getenv("IO_POOL_WORKERS", "16"))
+CPU_POOL_WORKERS = int(os.getenv("CPU_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+DEFAULT_INTENT_CONCURRENCY = 8
+
+INTENT_EXECUTION = {
+    # intent: (execution class, max concurrent calls)
+    "get_cpu_usage": ("inline", DEFAULT_INTENT_CONCURRENCY), # Reads the CpuSampler ring buffer
+    "get_cpu_per_core": ("inline", DEFAULT_INTENT_CONCURRENCY),
+    "get_cpu_averages": ("inline", DEFAULT_INTENT_CONCURRENCY),
+    "get_memory_usage": ("io", 8),
+    "get_battery_status": ("io", 8),
+    "set_brightness": ("io", 1), # Serialize writes to the display backend
+    "run_shell_command": ("io", 4),
+    "set_volume": ("async", 1),
+    "get_volume": ("async", 8),
+    "toggle_wifi": ("async", 1),
+    "toggle_bluetooth": ("async", 1),
+    "get_wifi_status": ("async", 8),
+    "get_bluetooth_status": ("async", 8),
+    "get_system_snapshot": ("async", 8), # Gathers the base intents, each within its own limit
+    "get_metric_history": ("cpu", 4), # Decodes and averages up to a tier's worth of records
+}
+
+_io_executor = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS, thread_name_prefix="intent-io")
+_cpu_executor = ThreadPoolExecutor(max_workers=CPU_POOL_WORKERS, thread_name_prefix="intent-cpu")
+_intent_semaphores = {}
+
+
+def _intent_execution(intent):
+    """Returns (execution class, limit) for an intent, inferring the class for untagged handlers."""
+    if intent in INTENT_EXECUTION: return INTENT_EXECUTION[intent]
+    kind = "async" if inspect.iscoroutinefunction(INTENT_HANDLERS[intent]) else "io"
+    return kind, DEFAULT_INTENT_CONCURRENCY
+
+
+def intent_semaphore(intent):
+    """The semaphore enforcing an intent's concurrency limit."""
+    semaphore = _intent_semaphores.get(intent)
+    if semaphore is None: semaphore = _intent_semaphores[intent] = asyncio.Semaphore(_intent_execution(intent)[1])
+    return semaphore
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Runs a blocking callable on the I/O pool; for blocking calls inside async handlers."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(func, *args, **kwargs))
+
+
+async def dispatch_intent(intent, parameters):
+    """Runs the handler registered for an intent on its execution class, within its concurrency limit."""
+    started = time.perf_counter()
+    try: return await _dispatch_intent(intent, parameters)
+    except Exception: INTENT_ERRORS.inc(intent); raise
+    finally: INTENT_SECONDS.observe(time.perf_counter() - started, intent)
+
+
+async def _dispatch_intent(intent, parameters):
+    handler_func = INTENT_HANDLERS[intent]
+    kind, _ = _intent_execution(intent)
+    if kind == "inline": return handler_func(**parameters)
+    async with intent_semaphore(intent):
+        if kind == "async": return await handler_func(**parameters)
+        executor = _cpu_executor if kind == "cpu" else _io_executor
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(handler_func, **parameters))
+
+
+# --- Intent Result Cache ---
+# Read-only intents are answered from a short-lived cache; concurrent misses for the same key share
+# one computation, and write intents invalidate the reads they affect.
+INTENT_CACHE_TTLS = {
+    # intent: seconds a result stays fresh
+    "get_cpu_usage": 0.25,
+    "get_cpu_per_core": 0.25,
+    "get_cpu_averages": 0.25,
+    "get_memory_usage": 0.5,
+    "get_volume": 0.5,
+    "get_battery_status": 5.0,
+    "get_wifi_status": 1.0,
+    "get_bluetooth_status": 1.0,
+    "get_system_snapshot": 0.25,
+}
+# Overrides as "intent=seconds,..." (0 disables caching for that intent)
+for _override in filter(None, os.getenv("INTENT_CACHE_TTLS", "").split(",")):
+    _intent, _, _ttl = _override.partition("=")
+    INTENT_CACHE_TTLS[_intent.strip()] = float(_ttl)
+INTENT_CACHE_INVALIDATES = {
+    # write intent: read intents whose cached results it makes stale ("*" = everything)
+    "set_volume": ("get_volume", "get_system_snapshot"),
+    "toggle_wifi": ("get_wifi_status", "get_system_snapshot"),
+    "toggle_bluetooth": ("get_bluetooth_status", "get_system_snapshot"),
+    "run_shell_command": ("*",),
+}
+INTENT_CACHE_MAX_ENTRIES = int(os.getenv("INTENT_CACHE_MAX_ENTRIES", "256"))
+
+
+class IntentResultCache:
+    """TTL + LRU cache of intent results with single-flight computation of misses."""
+
+    def __init__(self, ttls, invalidates, max_entries):
+        self.ttls = ttls
+        self.invalidates = invalidates
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict() # key -> (expires_at, result), least recently used first
+        self._inflight = {} # key -> task computing the result
+        self._generations = collections.Counter() # intent -> invalidation count, guards against storing stale results
+        self.hits = self.misses = self.coalesced = self.evictions = self.invalidations = 0
+
+    @staticmethod
+    def _key(intent, parameters):
+        return (intent, json.dumps(parameters, sort_keys=True, default=str)) if parameters else (intent, "")
+
+    async def get_or_compute(self, intent, parameters, compute):
+        """Returns a cached result for (intent, parameters) or computes it with `compute()`."""
+        ttl = self.ttls.get(intent)
+        if not ttl:
+            if intent not in self.invalidates: return await compute()
+            self.invalidate_for(intent) # Before and after: reads started during the write must not be stored
+            try: return await compute()
+            finally: self.invalidate_for(intent)
+        key = self._key(intent, parameters)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._compute_and_store(key, intent, ttl, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _compute_and_store(self, key, intent, ttl, compute):
+        generation = self._generations[intent]
+        result = await compute()
+        # Error strings are not cached, so a transient failure is retried on the next request
+        if self._generations[intent] == generation and not (isinstance(result, str) and result.startswith("Error")):
+            self._entries[key] = (time.monotonic() + ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return result
+
+    def invalidate_for(self, write_intent):
+        """Drops every cached read made stale by `write_intent`."""
+        targets = self.invalidates.get(write_intent, ())
+        if "*" in targets: targets = tuple(self.ttls)
+        for intent in targets:
+            self._generations[intent] += 1
+        for key in [k for k in self._entries if k[0] in targets]:
+            del self._entries[key]
+            self.invalidations += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "evictions": self.evictions,
+                "invalidations": self.invalidations, "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+intent_cache = IntentResultCache(INTENT_CACHE_TTLS, INTENT_CACHE_INVALIDATES, INTENT_CACHE_MAX_ENTRIES)
+metrics.counter("device_assistant_intent_cache_events_total", "Intent result cache hits, misses, coalesced misses, evictions and invalidations.",
+                ("event",), func=lambda: {(event,): value for event, value in intent_cache.stats().items() if event not in ("entries", "max_entries")})
+
+
+# --- Setter Queues ---
+# Slider-driven setters go through one queue per device property. A burst of requests collapses to the newest
+# value: at most one write per property is in flight, writes start at most SETTER_RATE_HZ times a second, and
+# a request overtaken by a newer one before its write started is answered at once as superseded. The first
+# request after a quiet period is written immediately, and the last value sent is always the one applied.
+SETTER_RATE_HZ = float(os.getenv("SETTER_RATE_HZ", "10")) # 0 disables rate limiting (writes still never overlap)
+COALESCED_SETTERS = {
+    # intent: device property it writes
+    "set_volume": "volume",
+    "set_brightness": "brightness",
+}
+
+
+class SetterQueue:
+    """Latest-value-wins write queue for one device property."""
+
+    def __init__(self, name, rate_hz):
+        self.name = name
+        self.min_interval = 1.0 / rate_hz if rate_hz > 0 else 0.0
+        self._pending = None # (parameters, apply, future) of the newest request not yet written
+        self._worker = None
+        self._last_write = float("-inf")
+        self.applied = self.superseded = 0
+
+    def submit(self, parameters, apply):
+        """Queues `apply(parameters)`; returns a future for its result, or the superseded notice if a newer request wins."""
+        future = asyncio.get_running_loop().create_future()
+        if self._pending is not None:
+            self._resolve(self._pending[2], f"Superseded: a newer {self.name} request replaced this one before it was applied.")
+            self.superseded += 1
+        self._pending = (parameters, apply, future)
+        if self._worker is None or self._worker.done(): self._worker = asyncio.ensure_future(self._drain())
+        return future
+
+    @staticmethod
+    def _resolve(future, result=None, error=None):
+        if future.done(): return # The requester went away
+        if error is None: future.set_result(result)
+        else: future.set_exception(error)
+
+    async def _drain(self):
+        while self._pending is not None:
+            delay = self._last_write + self.min_interval - time.monotonic()
+            if delay > 0: await asyncio.sleep(delay) # Requests arriving meanwhile replace the pending one
+            parameters, apply, future = self._pending
+            self._pending = None
+            if future.done(): continue # Its requester was cancelled (e.g. by EarlyDispatch.settle): never written
+            self._last_write = time.monotonic()
+            try: result = await apply(parameters)
+            except Exception as e: self._resolve(future, error=e); continue
+            self.applied += 1
+            self._resolve(future, result)
+
+
+setter_queues = {intent: SetterQueue(name, SETTER_RATE_HZ) for intent, name in COALESCED_SETTERS.items()}
+metrics.counter("device_assistant_setter_requests_total", "Coalesced setter requests by outcome (applied or superseded).",
+                ("property", "outcome"), func=lambda: {key: value for queue in setter_queues.values()
+                                                         for key, value in (((queue.name, "applied"), queue.applied), ((queue.name, "superseded"), queue.superseded))})
+
+
+async def _run_intent(intent, parameters):
+    if shared_snapshot is not None and not shared_snapshot.owner:
+        result = shared_snapshot.lookup(intent, parameters) if intent in INTENT_CACHE_TTLS else None
+        if result is not None: return result
+        if intent in INTENT_CACHE_INVALIDATES:
+            try: return await intent_cache.get_or_compute(intent, parameters, lambda: dispatch_intent(intent, parameters))
+            finally: shared_snapshot.invalidate_for(intent)
+    return await intent_cache.get_or_compute(intent, parameters, lambda: dispatch_intent(intent, parameters))
+
+
+async def run_intent(intent, parameters):
+    """Entry point for executing an intent: setter queue or result cache in front of dispatch_intent."""
+    queue = setter_queues.get(intent)
+    if queue is None: return await _run_intent(intent, parameters)
+    # Bad parameters fail here, so they can never supersede a valid pending write
+    inspect.signature(INTENT_HANDLERS[intent]).bind(**parameters)
+    return await queue.submit(parameters, functools.partial(_run_intent, intent))
+
+
+# --- Telemetry Publisher ---
+# Dashboards subscribe once and receive combined snapshot frames instead of polling each metric.
+# Subscriptions default to the base snapshot metrics; the optional snapshot sections can be requested too.
+#
+# Subscribers that ask for "delta": true only receive the metrics whose value changed since the frame they
+# last got (or last acknowledged with {"type": "ack", "seq": n} when they subscribed with "acks": true),
+# plus a keyframe with every metric each TELEMETRY_KEYFRAME_INTERVAL_MS. Ticks where nothing changed send
+# nothing. Frames are JSON text, or MessagePack binary messages for subscribers that ask for
+# "encoding": "msgpack". Subscribers in the same state share one encoded frame per tick.
+TELEMETRY_METRICS = (*SNAPSHOT_METRICS, *SNAPSHOT_EXTRAS)
+TELEMETRY_DEFAULT_INTERVAL_MS = 1000
+TELEMETRY_MIN_INTERVAL_MS = 50 # Lower bound for a subscriber's requested rate
+TELEMETRY_KEYFRAME_INTERVAL_MS = int(os.getenv("TELEMETRY_KEYFRAME_INTERVAL_MS", "5000"))
+TELEMETRY_ENCODINGS = ("json", "msgpack")
+TELEMETRY_MAX_UNACKED = 64 # Frames remembered per acknowledging subscriber; older acks are ignored
+
+try: import msgpack
+except ImportError: msgpack = None # The built-in encoder below produces the same format
+
+
+def _msgpack_pack(obj, out):
+    """Appends the MessagePack encoding of a JSON-like value to bytearray `out`."""
+    if obj is None: out.append(0xc0)
+    elif obj is True: out.append(0xc3)
+    elif obj is False: out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80: out.append(obj)
+        elif -32 <= obj < 0: out += struct.pack("b", obj)
+        elif 0 <= obj < 0x10000: out += struct.pack(">BH", 0xcd, obj)
+        elif 0 <= obj < 0x100000000: out += struct.pack(">BI", 0xce, obj)
+        elif -2**63 <= obj < 2**63: out += struct.pack(">Bq", 0xd3, obj)
+        else: out += struct.pack(">Bd", 0xcb, float(obj))
+    elif isinstance(obj, float): out += struct.pack(">Bd", 0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        if len(data) < 32: out.append(0xa0 | len(data))
+        elif len(data) < 0x100: out += struct.pack(">BB", 0xd9, len(data))
+        elif len(data) < 0x10000: out += struct.pack(">BH", 0xda, len(data))
+        else: out += struct.pack(">BI", 0xdb, len(data))
+        out += data
+    elif isinstance(obj, (list, tuple)):
+        if len(obj) < 16: out.append(0x90 | len(obj))
+        else: out += struct.pack(">BI", 0xdd, len(obj))
+        for item in obj: _msgpack_pack(item, out)
+    elif isinstance(obj, dict):
+        if len(obj) < 16: out.append(0x80 | len(obj))
+        else: out += struct.pack(">BI", 0xdf, len(obj))
+        for key, value in obj.items(): _msgpack_pack(str(key), out); _msgpack_pack(value, out)
+    else: _msgpack_pack(str(obj), out)
+
+
+def encode_telemetry_frame(frame, encoding):
+    """A telemetry frame as a JSON string (text message) or MessagePack bytes (binary message)."""
+    if encoding == "json": return json.dumps(frame)
+    if msgpack is not None: return msgpack.packb(frame)
+    out = bytearray(); _msgpack_pack(frame, out)
+    return bytes(out)
+
+
+TELEMETRY_FRAMES = metrics.counter("device_assistant_telemetry_frames_total", "Telemetry frames sent, per subscriber.", ("kind",))
+TELEMETRY_BYTES = metrics.counter("device_assistant_telemetry_bytes_total", "Telemetry payload bytes sent before compression, per subscriber.", ("encoding",))
+
+
+class TelemetryPublisher:
+    """Samples the union of subscribed metrics once per tick and pushes one frame per subscriber.
+
+    A single background task serves every subscriber, so N dashboards on the same rate cost one
+    sample per tick rather than one per dashboard. The task exits when the last subscriber leaves.
+    Each metric has a version that is bumped whenever its sampled value changes; delta subscribers
+    track the versions they hold, so deciding what to send is a dict comparison per metric.
+    Subscribers with more than OUTBOUND_BUFFER_BYTES unsent are skipped rather than queued behind: their
+    versions stay put, so the next frame they get merges every change they missed.
+    """
+
+    def __init__(self):
+        self._subscriptions = {} # websocket -> subscription dict (see subscribe)
+        self._task = None
+        self._wakeup = asyncio.Event()
+        self._values = {} # metric -> last sampled value
+        self._versions = collections.Counter() # metric -> number of value changes seen
+        self._seq = 0 # Tick counter, shared by every frame built from the same sample
+
+    def subscribe(self, websocket, metrics=None, interval_ms=None, delta=False, encoding="json", acks=False):
+        """Registers (or replaces) a subscription. Returns the normalized subscription settings."""
+        metrics = tuple(sorted(set(metrics or SNAPSHOT_METRICS)))
+        unknown = [m for m in metrics if m not in TELEMETRY_METRICS]
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(unknown)}. Available: {', '.join(TELEMETRY_METRICS)}")
+        encoding = encoding or "json"
+        if encoding not in TELEMETRY_ENCODINGS:
+            raise ValueError(f"Unknown encoding: {encoding}. Available: {', '.join(TELEMETRY_ENCODINGS)}")
+        interval_ms = max(TELEMETRY_MIN_INTERVAL_MS, int(interval_ms or TELEMETRY_DEFAULT_INTERVAL_MS))
+        loop = asyncio.get_running_loop()
+        self._subscriptions[websocket] = {
+            "metrics": metrics, "interval": interval_ms / 1000, "next_due": loop.time(),
+            "delta": bool(delta), "encoding": encoding, "acks": bool(delta and acks),
+            "next_keyframe": loop.time(), # The first frame is always a keyframe
+            "known": {}, # metric -> version the client is known to hold (acknowledged, when acks are on)
+            "sent": {}, # metric -> version the client holds once every frame sent so far arrives
+            "unacked": collections.OrderedDict(), # seq -> copy of "sent" after that frame
+            "backlogged_since": None, # loop time frames started being skipped for this connection
+        }
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        logging.info(f"Client {websocket.remote_address} subscribed to {list(metrics)} every {interval_ms} ms ({encoding}{', delta' if delta else ''})")
+        return {"metrics": list(metrics), "interval_ms": interval_ms, "delta": bool(delta), "encoding": encoding,
+                "acks": bool(delta and acks), "keyframe_interval_ms": TELEMETRY_KEYFRAME_INTERVAL_MS}
+
+    def unsubscribe(self, websocket):
+        """Drops a subscription; safe to call for connections that never subscribed."""
+        if self._subscriptions.pop(websocket, None) is not None:
+            self._wakeup.set()
+
+    def ack(self, websocket, seq):
+        """Records that a client has applied every frame up to `seq`. Returns False for unknown frames."""
+        sub = self._subscriptions.get(websocket)
+        if sub is None or not sub["acks"] or seq not in sub["unacked"]: return False
+        while sub["unacked"]:
+            frame_seq, sent = sub["unacked"].popitem(last=False)
+            if frame_seq == seq: sub["known"] = sent; return True
+        return False
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscriptions)
+
+    async def push(self, metrics):
+        """Immediately samples `metrics` and sends them to the subscribers that asked for any of them."""
+        targets = []
+        for ws, sub in self._subscriptions.items():
+            wanted = tuple(m for m in sub["metrics"] if m in metrics)
+            if wanted: targets.append((ws, sub, wanted))
+        if not targets: return
+        snapshot = await self.sample(set().union(*(wanted for _, _, wanted in targets)))
+        self._publish(targets, snapshot, keyframes=False)
+
+    async def sample(self, metrics):
+        """Samples the given metrics concurrently as typed snapshot values."""
+        return await collect_snapshot(metrics)
+
+    def _record(self, snapshot):
+        """Bumps the version of every metric whose value changed and returns the new tick number."""
+        for metric, value in snapshot.items():
+            if metric not in self._values or self._values[metric] != value:
+                self._values[metric] = value
+                self._versions[metric] += 1
+        self._seq += 1
+        return self._seq
+
+    def _publish(self, targets, snapshot, keyframes=True):
+        """Sends `snapshot` to (websocket, subscription, metrics) targets, as deltas where subscribed."""
+        seq = self._record(snapshot)
+        ts = time.time()
+        now = asyncio.get_running_loop().time()
+        groups = collections.defaultdict(list) # (encoding, kind, metrics) -> connections sharing one encoded frame
+        for ws, sub, wanted in targets:
+            if OUTBOUND_BUFFER_BYTES and outbound_backlog(ws) > OUTBOUND_BUFFER_BYTES:
+                OUTBOUND_DROPPED.inc("telemetry")
+                if sub["backlogged_since"] is None: sub["backlogged_since"] = now
+                elif now - sub["backlogged_since"] >= SLOW_CONSUMER_SECONDS:
+                    self.unsubscribe(ws); drop_slow_consumer(ws, f"telemetry backlogged for {SLOW_CONSUMER_SECONDS:g}s")
+                continue
+            sub["backlogged_since"] = None
+            if not sub["delta"]: kind, included = "full", wanted
+            elif keyframes and now >= sub["next_keyframe"]:
+                kind, included = "keyframe", wanted
+                sub["next_keyframe"] = now + TELEMETRY_KEYFRAME_INTERVAL_MS / 1000
+            else:
+                kind = "delta"
+                included = tuple(m for m in wanted if sub["known"].get(m) != self._versions[m])
+                if not included: continue
+            if sub["delta"]:
+                sub["sent"].update((m, self._versions[m]) for m in included)
+                if not sub["acks"]: sub["known"] = sub["sent"]
+                else:
+                    sub["unacked"][seq] = dict(sub["sent"])
+                    if len(sub["unacked"]) > TELEMETRY_MAX_UNACKED: sub["unacked"].popitem(last=False)
+            groups[(sub["encoding"], kind, included)].append(ws)
+        for (encoding, kind, included), connections in groups.items():
+            frame = {"type": "telemetry", "seq": seq, "ts": ts, "metrics": {m: snapshot[m] for m in included}}
+            if kind != "full": frame["keyframe"] = kind == "keyframe"
+            data = encode_telemetry_frame(frame, encoding)
+            websockets.broadcast(connections, data)
+            TELEMETRY_FRAMES.inc(kind, amount=len(connections)); TELEMETRY_BYTES.inc(encoding, amount=len(data) * len(connections))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while self._subscriptions:
+            now = loop.time()
+            due = [(ws, sub) for ws, sub in self._subscriptions.items() if sub["next_due"] <= now]
+            if due:
+                snapshot = await self.sample(set().union(*(sub["metrics"] for _, sub in due)))
+                for _, sub in due:
+                    # Skip missed ticks instead of bursting to catch up after a slow sample
+                    sub["next_due"] += sub["interval"]
+                    if sub["next_due"] <= now: sub["next_due"] = now + sub["interval"]
+                # Connections may have unsubscribed while sampling
+                self._publish([(ws, sub, sub["metrics"]) for ws, sub in due if self._subscriptions.get(ws) is sub], snapshot)
+            if not self._subscriptions: break
+            delay = min(sub["next_due"] for sub in self._subscriptions.values()) - loop.time()
+            self._wakeup.clear()
+            try: await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, delay))
+            except asyncio.TimeoutError: pass
+
+
+telemetry_publisher = TelemetryPublisher()
+metrics.gauge("device_assistant_telemetry_subscribers", "Connections subscribed to telemetry.", func=lambda: telemetry_publisher.subscriber_count)
+
+# Device state changes are pushed to subscribers as soon as they happen, not on the next tick
+DEVICE_STATE_METRICS = {"volume": "volume", "muted": "volume", "wifi": "wifi", "bluetooth": "bluetooth"}
+device_state.add_listener(lambda changed: asyncio.ensure_future(
+    telemetry_publisher.push({DEVICE_STATE_METRICS[field] for field in changed})))
+
+
+# --- Control Messages ---
+# JSON objects with a "type" key are protocol frames, everything else is a natural-language command.
+# v2 requests are {"type": "request", "id": <client id>, "command": "..."}; their replies carry the same "id".
+# With LLM_STREAMING, a request that needs the LLM first gets {"type": "progress", "id": <same id>, "stage": "interpreting"}.
+# Batches are {"type": "batch", "id": <client id>, "items": [{"intent": ..., "parameters": {...}} or {"command": "..."}, ...]}.
+CONTROL_MESSAGE_TYPES = {"request", "batch", "subscribe", "unsubscribe", "cancel", "ack", "capabilities",
+                         "register", "fleet_subscribe", "fleet_unsubscribe", "fleet_request", "fleet_devices"}
+
+def _parse_control_message(message):
+    """Returns the decoded control frame, or None if the message is a plain command."""
+    if not isinstance(message, str) or not message.lstrip().startswith("{"): return None
+    try: data = json.loads(message)
+    except json.JSONDecodeError: return None
+    if isinstance(data, dict) and data.get("type") in CONTROL_MESSAGE_TYPES: return data
+    return None
+
+
+async def _handle_control_message(session, control):
+    """Applies a control frame for this connection and returns the reply frame (None for no reply)."""
+    websocket = session.websocket
+    message_type = control["type"]
+    if message_type == "subscribe":
+        limited = session.rate_limited("telemetry")
+        if limited: return {"type": "error", "error": limited}
+        try: settings = telemetry_publisher.subscribe(websocket, control.get("metrics"), control.get("interval_ms"),
+                                                      delta=control.get("delta", False), encoding=control.get("encoding"), acks=control.get("acks", False))
+        except (ValueError, TypeError) as e: return {"type": "error", "error": str(e)}
+        return {"type": "subscribed", **settings}
+    if message_type == "ack":
+        telemetry_publisher.ack(websocket, control.get("seq"))
+        return None # Acks are not answered
+    if message_type.startswith("fleet_") or message_type == "register":
+        if not FLEET_HUB: return {"type": "error", "error": "This server is not running as a fleet hub (FLEET_HUB=true)."}
+        denied = fleet_access_error(control)
+        if denied: return {"type": "error", "error": denied}
+        return await fleet_hub.handle_dashboard_message(websocket, control)
+    if message_type == "capabilities":
+        return {"type": "capabilities", **readiness()}
+    if message_type == "unsubscribe":
+        telemetry_publisher.unsubscribe(websocket)
+        return {"type": "unsubscribed"}
+    if message_type == "cancel":
+        job = session.shell_jobs.get(control.get("command_id"))
+        if job is None: return {"type": "error", "error": f"No running command with id {control.get('command_id')!r}."}
+        job.cancel()
+        return {"type": "cancelling", "command_id": job.command_id}
+    return {"type": "error", "error": f"Unsupported message type: {message_type}"}
+
+
+# --- Fleet Mode ---
+# Many machines each run an agent (this server) that dials out to one hub with HUB_URL. After registering,
+# the agent serves the hub connection with the normal handler, so the hub subscribes to its telemetry and
+# sends it v2 requests exactly as a dashboard would. The hub (FLEET_HUB=true) merges every agent's delta
+# telemetry and gives dashboards one connection for the whole fleet:
+#   {"type": "fleet_subscribe"}   -> a full "fleet_telemetry" frame, then the devices whose metrics changed each interval
+#   {"type": "fleet_devices"}     -> the connected devices
+#   {"type": "fleet_request", "id": ..., "devices": [...] or "*", "intent": ..., "parameters": {...} (or "command": "..."),
+#    "timeout": seconds}        -> one "fleet_response" with a result per device, fanned out concurrently
+# Dashboards prove access with "token" on every fleet_* frame (FLEET_DASHBOARD_TOKEN, or FLEET_TOKEN if unset).
+# Without either, fleet_request is only served by a hub bound to a loopback address: it can run shell commands
+# and setters on every agent, and a hub reachable by agents is reachable by anyone on their network.
+FLEET_HUB = os.getenv("FLEET_HUB", "false").lower() == "true"
+HUB_URL = os.getenv("HUB_URL") # Agents: the hub to register with, e.g. ws://hub.local:8765
+FLEET_TOKEN = os.getenv("FLEET_TOKEN") # Shared secret agents present when registering (unset: any agent may register)
+FLEET_DASHBOARD_TOKEN = os.getenv("FLEET_DASHBOARD_TOKEN") or FLEET_TOKEN # Secret dashboards send with fleet_* frames
+LOOPBACK_HOSTS = {"localhost", "127.0.0.1", "::1"}
+DEVICE_ID = os.getenv("DEVICE_ID") or platform.node() or uuid.uuid4().hex[:12]
+FLEET_TELEMETRY_INTERVAL_MS = int(os.getenv("FLEET_TELEMETRY_INTERVAL_MS", "1000"))
+FLEET_REQUEST_TIMEOUT = float(os.getenv("FLEET_REQUEST_TIMEOUT", "10")) # Per device
+HUB_RECONNECT_MAX_SECONDS = 30
+
+metrics.gauge("device_assistant_fleet_agents", "Agents registered with this hub.", func=lambda: len(fleet_hub.agents))
+FLEET_REQUEST_SECONDS = metrics.histogram("device_assistant_fleet_request_seconds", "Per-device latency of fanned-out fleet requests.", ("outcome",))
+
+
+def fleet_access_error(control):
+    """None if a dashboard's fleet_* frame may be served, else the error to answer it with (see above)."""
+    if FLEET_DASHBOARD_TOKEN:
+        if hmac.compare_digest(str(control.get("token") or "").encode(), FLEET_DASHBOARD_TOKEN.encode()): return None
+        return "Invalid fleet token."
+    if control["type"] == "fleet_request" and HOST not in LOOPBACK_HOSTS:
+        return f"Fleet requests are disabled: the hub listens on {HOST} without FLEET_DASHBOARD_TOKEN or FLEET_TOKEN."
+    return None
+
+
+class AgentLink:
+    """Hub side of one registered agent: its latest telemetry and the requests waiting for its replies."""
+
+    def __init__(self, websocket, device_id, info):
+        self.websocket = websocket
+        self.device_id = device_id
+        self.info = info if isinstance(info, dict) else {}
+        self.metrics = {} # metric -> latest typed value
+        self.connected_at = self.last_seen = time.time()
+        self._pending = {} # request id -> future resolved with the agent's reply frame
+        self._next_id = 0
+
+    async def request(self, frame, timeout):
+        """Sends a v2 request to the agent and returns its reply frame (without the id)."""
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self.websocket.send(json.dumps({**frame, "type": "request", "id": request_id}))
+            reply = await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+        reply.pop("id", None)
+        return reply
+
+    def resolve(self, frame):
+        future = self._pending.get(frame.get("id"))
+        if future is not None and not future.done(): future.set_result(frame)
+
+    def fail_pending(self):
+        for future in self._pending.values():
+            if not future.done(): future.set_exception(ConnectionError("Device disconnected."))
+
+    def describe(self):
+        return {"device_id": self.device_id, "info": self.info, "connected_at": self.connected_at, "last_seen": self.last_seen}
+
+
+class FleetHub:
+    """Registry of connected agents plus the fleet telemetry stream for dashboards."""
+
+    def __init__(self):
+        self.agents = {} # device_id -> AgentLink
+        self._dashboards = set()
+        self._dirty = collections.defaultdict(set) # device_id -> metrics changed since the last fleet frame
+        self._task = None
+
+    async def serve_agent(self, websocket, register):
+        """Owns an agent's connection from its register frame until it disconnects."""
+        device_id = str(register.get("device_id") or "").strip()
+        if FLEET_TOKEN and not hmac.compare_digest(str(register.get("token") or ""), FLEET_TOKEN):
+            await websocket.send(json.dumps({"type": "error", "error": "Invalid fleet token."})); return
+        if not device_id:
+            await websocket.send(json.dumps({"type": "error", "error": "Register frames need a 'device_id'."})); return
+        previous = self.agents.get(device_id)
+        if previous is not None: await previous.websocket.close(1008, "Replaced by a newer connection.")
+        link = self.agents[device_id] = AgentLink(websocket, device_id, register.get("info"))
+        await websocket.send(json.dumps({"type": "registered", "device_id": device_id}))
+        await websocket.send(json.dumps({"type": "subscribe", "interval_ms": FLEET_TELEMETRY_INTERVAL_MS, "delta": True}))
+        logging.info(f"Agent {device_id} registered from {websocket.remote_address}")
+        self._broadcast({"type": "fleet_device", "device_id": device_id, "connected": True, **link.describe()})
+        try:
+            async for message in websocket:
+                try: frame = json.loads(message)
+                except (json.JSONDecodeError, TypeError): continue
+                link.last_seen = time.time()
+                if frame.get("type") == "telemetry":
+                    changed = frame.get("metrics") or {}
+                    link.metrics.update(changed)
+                    if self._dashboards: self._dirty[device_id].update(changed)
+                elif "id" in frame and frame.get("type") != "progress": link.resolve(frame)
+        except websockets.exceptions.ConnectionClosed: pass
+        finally:
+            link.fail_pending()
+            if self.agents.get(device_id) is link:
+                del self.agents[device_id]
+                self._dirty.pop(device_id, None)
+                self._broadcast({"type": "fleet_device", "device_id": device_id, "connected": False})
+            logging.info(f"Agent {device_id} disconnected")
+
+    async def handle_dashboard_message(self, websocket, control):
+        """Applies a fleet control frame from a dashboard and returns the reply frame."""
+        message_type = control["type"]
+        if message_type == "fleet_subscribe":
+            self._dashboards.add(websocket)
+            if self._task is None or self._task.done(): self._task = asyncio.create_task(self._run())
+            return self._frame({device_id: link.metrics for device_id, link in self.agents.items()}, full=True)
+        if message_type == "fleet_unsubscribe":
+            self.unsubscribe(websocket)
+            return {"type": "fleet_unsubscribed"}
+        if message_type == "fleet_devices":
+            return {"type": "fleet_devices", "devices": [link.describe() for link in self.agents.values()]}
+        return {"type": "error", "error": f"Unsupported message type: {message_type}"}
+
+    def unsubscribe(self, websocket):
+        self._dashboards.discard(websocket)
+
+    async def process_fleet_request(self, session, control):
+        """Fans a request out to the selected devices and sends one fleet_response with every result."""
+        try:
+            frame = await self.fan_out(control)
+        except Exception as e:
+            logging.exception(f"Error processing fleet request {control.get('id')!r}: {e}")
+            frame = {"type": "error", "error": "Server error occurred."}
+        finally:
+            session.inflight.release()
+        if "id" in control: frame["id"] = control["id"]
+        try: await session.send(frame)
+        except websockets.exceptions.ConnectionClosed: pass
+
+    async def fan_out(self, control):
+        devices = control.get("devices", "*")
+        selected = list(self.agents) if devices == "*" else [str(d) for d in devices] if isinstance(devices, list) else None
+        if selected is None: return {"type": "error", "error": "'devices' must be a list of device ids or \"*\"."}
+        if control.get("intent"): request = {"intent": control["intent"], "parameters": control.get("parameters") or {}}
+        elif isinstance(control.get("command"), str): request = {"command": control["command"]}
+        else: return {"type": "error", "error": "Fleet requests need an 'intent' or a 'command'."}
+        request["stream"] = False # One final result per device
+        try: timeout = float(control.get("timeout") or FLEET_REQUEST_TIMEOUT)
+        except (TypeError, ValueError): return {"type": "error", "error": "'timeout' must be a number of seconds."}
+
+        async def one(device_id):
+            link = self.agents.get(device_id)
+            if link is None: return {"error": "Device is not connected."}
+            started = time.perf_counter()
+            try: reply = await link.request(request, timeout); outcome = "ok"
+            except asyncio.TimeoutError: reply = {"error": f"No reply within {timeout:g}s."}; outcome = "timeout"
+            except (ConnectionError, websockets.exceptions.ConnectionClosed): reply = {"error": "Device disconnected."}; outcome = "disconnected"
+            FLEET_REQUEST_SECONDS.observe(time.perf_counter() - started, outcome)
+            return reply
+
+        results = await asyncio.gather(*(one(device_id) for device_id in selected))
+        return {"type": "fleet_response", "devices": dict(zip(selected, results))}
+
+    def _frame(self, devices, full=False):
+        return {"type": "fleet_telemetry", "ts": time.time(), "full": full, "devices": devices}
+
+    def _broadcast(self, frame):
+        if self._dashboards: websockets.broadcast(self._dashboards, json.dumps(frame))
+
+    async def _run(self):
+        # One encoded frame per interval for every dashboard, holding only the devices whose metrics changed
+        while self._dashboards:
+            await asyncio.sleep(FLEET_TELEMETRY_INTERVAL_MS / 1000)
+            if not self._dirty: continue
+            dirty, self._dirty = self._dirty, collections.defaultdict(set)
+            devices = {device_id: {m: self.agents[device_id].metrics[m] for m in changed}
+                       for device_id, changed in dirty.items() if device_id in self.agents}
+            if devices: self._broadcast(self._frame(devices))
+
+
+fleet_hub = FleetHub()
+
+
+async def run_hub_uplink(url):
+    """Agent side: keeps a registered connection to the hub open and serves it like a dashboard connection."""
+    delay = 1
+    while True:
+        try:
+            async with websockets.connect(url, ping_interval=20, ping_timeout=20) as websocket:
+                await websocket.send(json.dumps({"type": "register", "device_id": DEVICE_ID, "token": FLEET_TOKEN,
+                                                 "info": {"hostname": platform.node(), "os": await distro_backend.aget()}}))
+                reply = json.loads(await websocket.recv())
+                if reply.get("type") != "registered": raise ConnectionError(reply.get("error") or f"Unexpected reply {reply}")
+                logging.info(f"Registered with hub {url} as {DEVICE_ID}")
+                delay = 1
+                await handler(websocket)
+        except asyncio.CancelledError: raise
+        except Exception as e: logging.warning(f"Hub connection to {url} failed: {e}")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, HUB_RECONNECT_MAX_SECONDS)
+
+
+# --- Worker Processes ---
+# With WORKERS > 1 (Linux/BSD, needs SO_REUSEPORT) main() becomes a supervisor that binds nothing itself: it starts
+# WORKERS copies of this script that all listen on HOST:PORT, and the kernel spreads new connections across them.
+# A connection, with its session and conversation history, stays on the worker that accepted it.
+# Device sampling happens once, in the supervisor: it runs the CPU sampler, the device event sources and the
+# history recorder, and every SHARED_SNAPSHOT_INTERVAL (or as soon as a device event arrives) publishes the
+# results of the read-only intents in SHARED_INTENT_CALLS to a shared memory segment. Workers answer those
+# intents (and snapshots and telemetry built from them) from the segment and query history from the ring files;
+# only writes, shell commands and requests the segment cannot answer touch the devices from a worker.
+# /metrics and /ready describe the worker that happens to accept the scrape.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INDEX = int(os.environ["WORKER_INDEX"]) if os.getenv("WORKER_INDEX") else None # Set by the supervisor
+SHARED_SNAPSHOT_NAME = os.getenv("SHARED_SNAPSHOT_NAME") # Set by the supervisor
+SHARED_SNAPSHOT_INTERVAL = float(os.getenv("SHARED_SNAPSHOT_INTERVAL", "0.25")) # Seconds between publications
+SHARED_SNAPSHOT_MAX_AGE = 2.0 # Workers ignore an older snapshot (e.g. while the supervisor is stuck)
+SHARED_SNAPSHOT_BYTES = 64 * 1024
+WORKER_RESTART_SECONDS = 1
+SHARED_INTENT_CALLS = [
+    # (intent, parameters) published by the supervisor
+    *((intent, {}) for intent in SNAPSHOT_METRICS.values()),
+    ("get_cpu_per_core", {}), ("get_cpu_averages", {}),
+    *(("get_cpu_usage", {"window": float(window)}) for window in CPU_AVERAGE_WINDOWS),
+]
+
+
+def _shared_key(intent, parameters):
+    return f"{intent} {json.dumps(parameters, sort_keys=True)}" if parameters else intent
+
+
+class SharedSnapshot:
+    """Intent results in a shared memory segment, written by the supervisor and read by every worker.
+
+    The segment holds a sequence number, a length and a JSON document. The writer makes the sequence odd while
+    it writes (a seqlock), so readers never see a half-written document and need no lock shared across processes.
+    """
+
+    _HEADER = struct.Struct("<QI") # sequence (odd while a write is in progress), document length
+
+    def __init__(self, name=None, size=SHARED_SNAPSHOT_BYTES):
+        from multiprocessing import shared_memory
+        if name is None: self.memory = shared_memory.SharedMemory(create=True, size=size)
+        elif sys.version_info >= (3, 13): self.memory = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            # Before 3.13 every attaching process registers the segment and unlinks it when it exits
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.name = self.memory.name
+        self.owner = name is None
+        self._document = (None, {"ts": 0, "results": {}}) # Reader side: (sequence, decoded document) last read
+        self._stale_before = {} # read intent -> time of the last local write that affects it
+        self.hits = self.misses = 0
+
+    def publish(self, ts, results):
+        """Writes the results sampled at `ts` (Unix time) as the current document."""
+        data = json.dumps({"ts": ts, "results": results}).encode()
+        if self._HEADER.size + len(data) > self.memory.size:
+            logging.error(f"Shared snapshot of {len(data)} bytes does not fit in {self.memory.size}; not published."); return
+        buf = self.memory.buf
+        sequence = self._HEADER.unpack_from(buf)[0] + 1
+        struct.pack_into("<Q", buf, 0, sequence)
+        buf[self._HEADER.size:self._HEADER.size + len(data)] = data
+        self._HEADER.pack_into(buf, 0, sequence + 1, len(data))
+
+    def read(self):
+        """The latest consistent document, decoded once per publication."""
+        buf = self.memory.buf
+        for _ in range(3):
+            sequence, length = self._HEADER.unpack_from(buf)
+            if sequence == self._document[0]: break
+            if sequence % 2: continue # Being written; retry, else keep the previous document
+            data = bytes(buf[self._HEADER.size:self._HEADER.size + length])
+            if self._HEADER.unpack_from(buf)[0] == sequence:
+                self._document = (sequence, json.loads(data)); break
+        return self._document[1]
+
+    def lookup(self, intent, parameters):
+        """The published result for a read, or None if there is none, it is too old or a local write made it stale."""
+        document = self.read()
+        result = document["results"].get(_shared_key(intent, parameters))
+        if result is None or time.time() - document["ts"] > SHARED_SNAPSHOT_MAX_AGE or document["ts"] <= self._stale_before.get(intent, 0):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def invalidate_for(self, write_intent):
+        """Stops serving reads affected by a write this worker just made until the supervisor samples them again."""
+        targets = INTENT_CACHE_INVALIDATES.get(write_intent, ())
+        now = time.time()
+        for intent in (INTENT_CACHE_TTLS if "*" in targets else targets): self._stale_before[intent] = now
+
+    def close(self):
+        self.memory.close()
+        if self.owner: self.memory.unlink()
+
+
+shared_snapshot = None # SharedSnapshot: written in the supervisor, read in workers; None in a single process
+metrics.counter("device_assistant_shared_snapshot_lookups_total", "Worker reads answered from (hit) or missed in the supervisor's shared snapshot.",
+                ("result",), func=lambda: {("hit",): shared_snapshot.hits, ("miss",): shared_snapshot.misses} if shared_snapshot and not shared_snapshot.owner else {})
+
+
+async def publish_shared_snapshot(wakeup):
+    """Supervisor: samples SHARED_INTENT_CALLS on a fixed cadence, or early when `wakeup` is set, and publishes them."""
+    while True:
+        started = time.time()
+        results = await asyncio.gather(*(run_intent(intent, parameters) for intent, parameters in SHARED_INTENT_CALLS), return_exceptions=True)
+        # Errors are left out, so workers fall back to asking the device themselves
+        shared_snapshot.publish(started, {_shared_key(intent, parameters): result for (intent, parameters), result in zip(SHARED_INTENT_CALLS, results)
+                                          if isinstance(result, str) and not result.startswith("Error")})
+        wakeup.clear()
+        try: await asyncio.wait_for(wakeup.wait(), timeout=max(0.0, SHARED_SNAPSHOT_INTERVAL - (time.time() - started)))
+        except asyncio.TimeoutError: pass
+
+
+async def _supervise_worker(index):
+    """Runs worker `index` and restarts it whenever it exits."""
+    env = {**os.environ, "WORKER_INDEX": str(index), "SHARED_SNAPSHOT_NAME": shared_snapshot.name}
+    while True:
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        try: code = await process.wait()
+        except asyncio.CancelledError:
+            if process.returncode is None: process.terminate(); await process.wait()
+            raise
+        logging.warning(f"Worker {index} exited with code {code}; restarting in {WORKER_RESTART_SECONDS}s.")
+        await asyncio.sleep(WORKER_RESTART_SECONDS)
+
+
+async def run_supervisor(count):
+    """Samples devices into the shared snapshot and keeps `count` worker processes serving the port."""
+    global shared_snapshot
+    shared_snapshot = SharedSnapshot()
+    wakeup = asyncio.Event()
+    device_state.add_listener(lambda changed: wakeup.set())
+    device_state.start()
+    cpu_sampler.start()
+    metric_history.start()
+    publisher = asyncio.create_task(publish_shared_snapshot(wakeup))
+    workers = [asyncio.create_task(_supervise_worker(index)) for index in range(count)]
+    logging.info(f"Supervising {count} workers on ws://{HOST}:{PORT} (SO_REUSEPORT), shared snapshot {shared_snapshot.name}")
+    try: await asyncio.gather(*workers)
+    finally:
+        publisher.cancel()
+        for worker in workers: worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        metric_history.close()
+        await device_state.close()
+        await command_runner.close()
+        shared_snapshot.close()
+
+
+async def _supervisor_exit():
+    """Worker: returns once the supervisor has gone (the worker is then re-parented), so no worker outlives it."""
+    supervisor = os.getppid()
+    while os.getppid() == supervisor: await asyncio.sleep(1)
+    logging.warning(f"Worker {WORKER_INDEX}: supervisor exited; shutting down.")
+
+
 if __name__ == "__main__":
     try: asyncio.run(main())
     except KeyboardInterrupt: logging.info("Server stopped manually.")
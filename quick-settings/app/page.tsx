@@ -11,6 +11,8 @@
     const WEBSOCKET_URL = "ws://localhost:8765"; // Ensure this matches your Python server
     const HISTORY_LENGTH = 60; // Number of data points to keep for the graph
     const UPDATE_INTERVAL_MS = 1000; // Update interval in milliseconds
+    const TELEMETRY_METRICS = ["cpu", "memory", "volume", "battery", "wifi", "bluetooth"]; // Metrics pushed by the server
+    const HISTORY_BACKFILL_ID = "history-backfill"; // v2 request id of the graph backfill sent on connect
 
     // --- Helper Function for Volume Icon (Used inside slider now) ---
     const VolumeIcon = ({ level }) => {
@@ -178,21 +180,20 @@
         setUsageHistory(initializeGraphData()); 
         stopRequestInterval();
         
-        // Get initial status of all components
-        fetchInitialStatus();
-        sendCommand("get cpu usage"); 
-        sendCommand("get memory usage"); 
-        sendCommand("get_volume"); 
-        sendCommand("get_battery_status");
-        
-        requestIntervalId.current = setInterval(() => { 
-            sendCommand("get cpu usage"); 
-            sendCommand("get memory usage"); 
-            sendCommand("get_volume"); 
-            sendCommand("get_battery_status"); 
-            sendCommand("get wifi status");
-            sendCommand("get bluetooth status");
-        }, UPDATE_INTERVAL_MS);
+        // Subscribe once; the server pushes the metrics that changed every interval, with a full keyframe every few seconds
+        sendCommand(JSON.stringify({
+            type: "subscribe",
+            metrics: TELEMETRY_METRICS,
+            interval_ms: UPDATE_INTERVAL_MS,
+            delta: true,
+        }));
+        // Backfill the graph from the server's recorded history instead of starting it empty
+        sendCommand(JSON.stringify({
+            type: "request",
+            id: HISTORY_BACKFILL_ID,
+            intent: "get_metric_history",
+            parameters: { window: HISTORY_LENGTH * UPDATE_INTERVAL_MS / 1000, points: HISTORY_LENGTH, metrics: ["cpu", "memory"] },
+        }));
         };
         // ws.current.onmessage = (event) => {
         //     try {
@@ -323,26 +324,108 @@
         ws.current.onmessage = (event) => {
             try {
                 const data = JSON.parse(event.data); 
+                // Telemetry frames carry one typed value per subscribed metric
+                if (data.type === 'telemetry') {
+                    applySnapshot(data.metrics || {});
+                    return;
+                }
+                // Streamed shell command output, then the final result
+                if (data.type === 'shell_output') {
+                    console.log(`[${data.command_id} ${data.stream}]:`, data.data);
+                    return;
+                }
+                if (data.type === 'shell_exit') {
+                    handleServerResponse(data.response);
+                    return;
+                }
+                if (data.type === 'error') {
+                    console.error('[Server Error]:', data.error);
+                    return;
+                }
+                if (data.id === HISTORY_BACKFILL_ID) {
+                    applyHistory(data.response);
+                    return;
+                }
+                if (data.type) return; // Other protocol acknowledgements (subscribed, ...)
+                // get_system_snapshot replies have the same shape as telemetry frames
+                if (data.response && typeof data.response === 'object' && data.response.metrics) {
+                    applySnapshot(data.response.metrics);
+                    return;
+                }
+                handleServerResponse(data.response);
+            } catch (e) { 
+                console.error("Failed to parse message or process response:", event.data, e); 
+                console.error('[Error]: Received unprocessable data:', event.data); 
+            }
+        };
+        // Applies typed snapshot values ({cpu: {percent}, volume: {level, muted}, ...}); sections may be partial
+        const applySnapshot = (metrics) => {
+            const { cpu, memory, volume, battery, wifi, bluetooth } = metrics;
+            Object.entries(metrics).forEach(([name, value]) => {
+                if (value && value.error) console.error(`[Server Error - ${name}]:`, value.error);
+            });
+            const currentCpu = typeof cpu?.percent === 'number' ? cpu.percent : null;
+            const currentMem = typeof memory?.percent === 'number' ? memory.percent : null;
+            if (cpu) setCpuUsage(`${currentCpu?.toFixed(1) ?? '-'} %`);
+            if (memory) setMemoryUsage(`${currentMem?.toFixed(1) ?? '-'} %`);
+            if (typeof volume?.level === 'number') setVolume(volume.level);
+            if (battery) {
+                setBatteryPercent(typeof battery.percent === 'number' ? battery.percent : null);
+                setIsCharging(Boolean(battery.charging));
+            }
+            if (typeof wifi?.enabled === 'boolean') { setIsWifiOn(wifi.enabled); setWifiToggleInProgress(false); }
+            if (typeof bluetooth?.enabled === 'boolean') { setIsBluetoothOn(bluetooth.enabled); setBluetoothToggleInProgress(false); }
+            if (currentCpu !== null || currentMem !== null) {
+                setUsageHistory(prevHistory => {
+                    const lastDataPoint =
+                    Array.isArray(prevHistory) && prevHistory.length > 0
+                        ? prevHistory[prevHistory.length - 1]
+                        : { name: -1, cpu: null, mem: null };
+                    const newDataPoint = {
+                        name: (lastDataPoint.name ?? -1) + 1,
+                        cpu: currentCpu ?? lastDataPoint.cpu ?? null,
+                        mem: currentMem ?? lastDataPoint.mem ?? null,
+                    };
+                    return [...(Array.isArray(prevHistory) ? prevHistory : []), newDataPoint].slice(-HISTORY_LENGTH);
+                });
+            }
+        };
+        // Puts recorded points ({ts, values: {cpu, memory}}) in front of any live points received meanwhile
+        const applyHistory = (history) => {
+            if (!history || history.error || !Array.isArray(history.ts)) {
+                if (history?.error) console.error('[Server Error - History]:', history.error);
+                return;
+            }
+            const recorded = history.ts.map((_, i) => ({ cpu: history.values.cpu?.[i] ?? null, mem: history.values.memory?.[i] ?? null }));
+            setUsageHistory(prevHistory => {
+                const live = (Array.isArray(prevHistory) ? prevHistory : []).filter(point => point.cpu !== null || point.mem !== null);
+                const points = [...recorded, ...live].slice(-HISTORY_LENGTH);
+                const padding = Array.from({ length: HISTORY_LENGTH - points.length }, () => ({ cpu: null, mem: null }));
+                return [...padding, ...points].map((point, i) => ({ ...point, name: i }));
+            });
+        };
+        const handleServerResponse = (response) => {
+            try {
                 let messageText = ''; 
                 let currentCpu = null; 
                 let currentMem = null;
-                let responsePayload = data.response;
+                let responsePayload = response;
                 
-                if (typeof data.response === 'string') { 
+                if (typeof response === 'string') { 
                     try { 
-                        responsePayload = JSON.parse(data.response); 
+                        responsePayload = JSON.parse(response); 
                         messageText = responsePayload.status_text || JSON.stringify(responsePayload); 
                     } catch (e) { 
-                        messageText = data.response; 
+                        messageText = response; 
                         responsePayload = null; 
                     } 
                 }
-                else if (typeof data.response === 'object' && data.response !== null) { 
-                    responsePayload = data.response; 
+                else if (typeof response === 'object' && response !== null) { 
+                    responsePayload = response; 
                     messageText = responsePayload.status_text || JSON.stringify(responsePayload); 
                 }
                 else { 
-                    messageText = String(data.response); 
+                    messageText = String(response); 
                     responsePayload = null; 
                 }
                 
@@ -473,8 +556,7 @@
                     });
                 }
             } catch (e) { 
-                console.error("Failed to parse message or process response:", event.data, e); 
-                console.error('[Error]: Received unprocessable data:', event.data); 
+                console.error("Failed to process response:", response, e); 
             }
         };
         ws.current.onerror = (event) => { 
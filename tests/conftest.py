@@ -0,0 +1,224 @@
+"""Shared fixtures: main.py imported once with test settings, and fake OpenAI backends.
+
+Tests drive coroutines with asyncio.run(), one event loop per test.
+"""
+import asyncio
+import contextlib
+import http
+import json
+import os
+import time
+import types
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# A scene the fake LLMs answer "movie mode" with, as one batch
+SCENE = [
+    {"intent": "set_brightness", "parameters": {"level": 30}},
+    {"intent": "set_volume", "parameters": {"level": 20}},
+    {"intent": "toggle_bluetooth", "parameters": {"state": "off"}},
+    {"intent": "toggle_wifi", "parameters": {"state": "on"}},
+]
+
+
+def fake_interpretation(command):
+    """The interpretation the fake LLMs return for a command, chosen by keyword."""
+    command = command.lower()
+    if command.startswith("run "): return {"intent": "run_shell_command", "parameters": {"command": command[4:]}}
+    if "battery" in command or "juice" in command: return {"intent": "get_battery_status", "parameters": {}}
+    if "loud" in command: return {"intent": "set_volume", "parameters": {"level": 70}}
+    if "movie mode" in command: return {"intent": "batch", "parameters": {"actions": SCENE}}
+    return {"intent": "unknown", "parameters": {"error": "Command not understood or parameters missing."}}
+
+
+def fake_tokens(content):
+    """Splits a completion into roughly token-sized pieces for streaming."""
+    return [content[i:i + 4] for i in range(0, len(content), 4)]
+
+
+class FakeAsyncOpenAI:
+    """Answers chat.completions.create after a fixed delay with an interpretation chosen by keyword."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.chat = types.SimpleNamespace(completions=self)
+
+    async def create(self, messages, stream=False, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        content = json.dumps(fake_interpretation(messages[-1]["content"]))
+        usage = types.SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages) // 4, completion_tokens=len(content) // 4)
+        if stream: return self._stream(content, usage)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))], usage=usage)
+
+    @staticmethod
+    async def _stream(content, usage):
+        for piece in fake_tokens(content):
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=types.SimpleNamespace(content=piece))], usage=None)
+        yield types.SimpleNamespace(choices=[], usage=usage)
+
+
+class FakeOpenAIServer:
+    """An OpenAI-compatible HTTP server (POST /v1/chat/completions) for the real SDK, with latency and failures.
+
+    Each request takes `latency` seconds (`slow_latency` for the next `slow_next` requests), plus `token_latency`
+    per token of the answer; the next `fail_next` requests fail with `error_status`. "stream": true requests get
+    server-sent chunks paced by `token_latency`. The knobs can be changed while it runs.
+    """
+
+    def __init__(self, latency=0.01, slow_latency=30.0, error_status=500, token_latency=0.0):
+        self.latency, self.slow_latency, self.token_latency = latency, slow_latency, token_latency
+        self.error_status = error_status
+        self.fail_next = self.slow_next = 0
+        self.requests = 0
+        self.handlers = set() # Connection tasks, stopped by close() even while a hung request sleeps
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, "localhost", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        for task in self.handlers: task.cancel()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True: # HTTP/1.1 keep-alive: one request after another on the connection
+                request_line = await reader.readline()
+                if not request_line: return
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await self._complete(body)
+                if isinstance(payload, dict):
+                    data = json.dumps(payload).encode()
+                    writer.write(f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\nContent-Type: application/json\r\n"
+                                 f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+                    await writer.drain()
+                    continue
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+                async for event in payload:
+                    data = f"data: {event}\n\n".encode()
+                    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    await writer.drain()
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError): pass # Cancelled by close()
+        finally: writer.close(); self.handlers.discard(asyncio.current_task())
+
+    async def _complete(self, body):
+        self.requests += 1
+        fail = self.fail_next > 0
+        self.fail_next -= fail
+        slow = self.slow_next > 0
+        self.slow_next -= slow
+        await asyncio.sleep(self.slow_latency if slow else self.latency)
+        if fail: return self.error_status, {"error": {"message": "Injected failure", "type": "server_error"}}
+        request = json.loads(body)
+        messages = request["messages"]
+        content = json.dumps(fake_interpretation(messages[-1]["content"]))
+        tokens = fake_tokens(content)
+        usage = {"prompt_tokens": sum(len(m["content"]) for m in messages) // 4, "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if request.get("stream"): return 200, self._stream(tokens, usage)
+        await asyncio.sleep(self.token_latency * len(tokens))
+        return 200, {"id": f"chatcmpl-{self.requests}", "object": "chat.completion", "created": int(time.time()), "model": "fake",
+                     "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}], "usage": usage}
+
+    async def _stream(self, tokens, usage):
+        """Server-sent event payloads of a streamed completion, one token per chunk."""
+        chunk = {"id": f"chatcmpl-{self.requests}", "object": "chat.completion.chunk", "created": int(time.time()), "model": "fake"}
+        yield json.dumps({**chunk, "choices": [{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]})
+        for token in tokens:
+            await asyncio.sleep(self.token_latency)
+            yield json.dumps({**chunk, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]})
+        yield json.dumps({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        yield json.dumps({**chunk, "choices": [], "usage": usage})
+        yield "[DONE]"
+
+
+class RecordingSocket:
+    """Stands in for a client connection; records every frame the server sends."""
+    remote_address = ("test", 0)
+
+    def __init__(self): self.frames = []
+
+    async def send(self, data): self.frames.append(json.loads(data))
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    """main.py, imported with test settings; the environment is restored once it is loaded."""
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in {"OPENAI_API_KEY": "sk-test", "HISTORY_DIR": "", "RATE_LIMITS": "telemetry=0,control=0,llm=0,shell=0",
+                            "INTERPRETATION_CACHE_PATH": str(tmp_path_factory.mktemp("cache") / "interpretations.db")}.items():
+            patch.setenv(name, value)
+        patch.syspath_prepend(REPO)
+        import main
+    return main
+
+
+@pytest.fixture
+def scene():
+    """The batch actions the fake LLMs answer "movie mode" with."""
+    return [dict(action) for action in SCENE]
+
+
+@pytest.fixture
+def session(main):
+    """A client session over a RecordingSocket (its frames are in `session.websocket.frames`)."""
+    return main.ClientSession(RecordingSocket())
+
+
+@pytest.fixture
+def cache(main, monkeypatch, tmp_path):
+    """An empty interpretation cache in its own file, in place of the module's."""
+    cache = main.InterpretationCache(str(tmp_path / "interpretations.db"), max_entries=3)
+    monkeypatch.setattr(main, "interpretation_cache", cache)
+    return cache
+
+
+@pytest.fixture
+def gateway(main, monkeypatch):
+    """A fresh LLM gateway (closed breaker, no latency samples, free slots) with quick retries."""
+    monkeypatch.setattr(main, "LLM_RETRY_BACKOFF", 0.01)
+    gateway = main.LLMGateway()
+    monkeypatch.setattr(main, "llm_gateway", gateway)
+    return gateway
+
+
+@pytest.fixture
+def fake_llm(main, monkeypatch):
+    """FakeAsyncOpenAI as the module's OpenAI client."""
+    llm = FakeAsyncOpenAI()
+    monkeypatch.setattr(main, "client", llm)
+    monkeypatch.setattr(main, "openai_available", True)
+    return llm
+
+
+@pytest.fixture
+def openai_server(main, monkeypatch):
+    """Starts a FakeOpenAIServer with the given knobs (inside the test's event loop): `async with openai_server(**knobs)
+    as (fake, llm)`, where `llm` is an SDK client built like the module's (one connection pool, no SDK retries)."""
+    @contextlib.asynccontextmanager
+    async def serving(**knobs):
+        fake = await FakeOpenAIServer(**knobs).start()
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+        monkeypatch.setenv("OPENAI_BASE_URL", f"http://localhost:{fake.port}/v1")
+        llm = main._load_openai_client()
+        try: yield fake, llm
+        finally:
+            await llm.close()
+            await fake.close()
+    return serving
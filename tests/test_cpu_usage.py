@@ -0,0 +1,38 @@
+"""get_cpu_usage over a CpuSampler with a known history: window validation and the span actually averaged."""
+import pytest
+
+
+@pytest.fixture
+def sampler(main, monkeypatch):
+    """Five samples one second apart: 10% busy for the first two seconds, 50% for the last two."""
+    sampler = main.CpuSampler(interval=1.0, history_seconds=4)
+    busy = total = 0.0
+    for second, percent in enumerate([None, 10.0, 10.0, 50.0, 50.0]):
+        if percent is not None: busy += percent; total += 100.0
+        sampler._samples.append((1000.0 + second, busy, total, percent, (percent,)))
+    monkeypatch.setattr(main, "cpu_sampler", sampler)
+    monkeypatch.setattr(main, "psutil", object()) # Never sampled: the buffer is all there is
+    return sampler
+
+
+def test_latest_without_a_window(main, sampler):
+    assert main.get_cpu_usage() == "CPU Usage: 50.0%"
+
+
+def test_window_inside_the_history(main, sampler):
+    assert main.get_cpu_usage(2) == "CPU Usage: 50.0% (2s average)"
+    assert main.get_cpu_usage("3") == "CPU Usage: 36.7% (3s average)"
+
+
+def test_window_shorter_than_an_interval_reports_the_interval(main, sampler):
+    assert main.get_cpu_usage(0.1) == "CPU Usage: 50.0% (1s average)"
+
+
+@pytest.mark.parametrize("window", [60, float("inf")])
+def test_window_beyond_the_history_is_clamped(main, sampler, window):
+    assert main.get_cpu_usage(window) == "CPU Usage: 30.0% (4s average)"
+
+
+@pytest.mark.parametrize("window", [0, -5, "soon", float("nan"), [5]])
+def test_invalid_window_is_an_error(main, sampler, window):
+    assert main.get_cpu_usage(window) == "Error: CPU usage window must be a positive number of seconds."
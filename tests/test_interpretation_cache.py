@@ -0,0 +1,98 @@
+"""Interpretation cache in front of a stubbed AsyncOpenAI (the fake_llm fixture)."""
+import asyncio
+import threading
+
+
+def test_repeated_command_is_answered_from_the_cache(main, cache, fake_llm, gateway):
+    async def scenario():
+        return [await main.call_openai_api(command) for command in ("how much juice is left", "How much juice is left?")]
+
+    first, second = asyncio.run(scenario())
+    assert first == second == {"intent": "get_battery_status", "parameters": {}}
+    assert fake_llm.calls == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_different_commands_miss(main, cache, fake_llm, gateway):
+    async def scenario():
+        for command in ("how much juice is left", "battery level please"): await main.call_openai_api(command)
+
+    asyncio.run(scenario())
+    assert fake_llm.calls == 2
+    assert (cache.hits, cache.misses) == (0, 2)
+
+
+def test_context_dependent_commands_are_not_cached(main, cache, fake_llm, gateway):
+    async def scenario():
+        return [await main.call_openai_api("make it loud") for _ in range(2)]
+
+    first, second = asyncio.run(scenario())
+    assert first == second == {"intent": "set_volume", "parameters": {"level": 70}}
+    assert fake_llm.calls == 2
+    assert cache.skipped == 2 and cache.stats()["entries"] == 0
+
+
+def test_shell_commands_are_never_cached(main, cache, fake_llm, gateway, monkeypatch):
+    monkeypatch.setattr(main, "ALLOW_SHELL_EXECUTION", True)
+
+    async def scenario():
+        return [await main.call_openai_api("run uptime") for _ in range(2)]
+
+    first, second = asyncio.run(scenario())
+    assert first == second == {"intent": "run_shell_command", "parameters": {"command": "uptime"}}
+    assert fake_llm.calls == 2
+    assert cache.stats()["entries"] == 0
+
+
+def test_batches_with_a_shell_action_are_not_cached(main, cache):
+    shell = {"intent": "run_shell_command", "parameters": {"command": "uptime"}}
+    volume = {"intent": "set_volume", "parameters": {"level": 20}}
+    assert cache.cacheable({"intent": "batch", "parameters": {"actions": [volume]}})
+    assert not cache.cacheable({"intent": "batch", "parameters": {"actions": [volume, shell]}})
+
+
+def test_entries_survive_a_restart(main, cache, fake_llm, gateway):
+    async def scenario():
+        await main.call_openai_api("how much juice is left")
+        reopened = main.InterpretationCache(cache.path, cache.max_entries)
+        await reopened.load()
+        return await reopened.get(await reopened.key("how much juice is left"))
+
+    assert asyncio.run(scenario()) == {"intent": "get_battery_status", "parameters": {}}
+
+
+def test_least_recently_used_entry_is_evicted(main, cache, fake_llm, gateway):
+    async def scenario():
+        for command in ("battery one", "battery two", "battery three", "battery one", "battery four"):
+            await main.call_openai_api(command)
+        return [await cache.key(command) in cache._entries for command in ("battery one", "battery two", "battery three", "battery four")]
+
+    assert asyncio.run(scenario()) == [True, False, True, True] # max_entries=3; "battery one" was used again
+
+
+def test_hits_are_recorded_in_the_file(main, cache, fake_llm, gateway):
+    async def scenario():
+        for command in ("battery one", "battery two", "battery three"): await main.call_openai_api(command)
+        await main.call_openai_api("battery one") # A hit; recorded in the background
+        assert len(cache._touches) == 1 # Held until it finishes
+        await asyncio.gather(*cache._touches)
+        reopened = main.InterpretationCache(cache.path, max_entries=2) # Loads the 2 most recently used
+        await reopened.load()
+        return [await reopened.key(command) in reopened._entries for command in ("battery one", "battery two", "battery three")]
+
+    assert asyncio.run(scenario()) == [True, False, True]
+    assert not cache._touches
+
+
+def test_cold_distro_backend_loads_off_the_event_loop(main, cache, fake_llm, gateway, monkeypatch):
+    monkeypatch.setitem(main.BACKENDS, "distro", main.BACKENDS["distro"]) # LazyBackend() registers itself
+    loaded_on = []
+    monkeypatch.setattr(main, "distro_backend", main.LazyBackend("distro", lambda: loaded_on.append(threading.get_ident()) or "Test OS 1"))
+
+    async def scenario():
+        await main.call_openai_api("how much juice is left")
+        return threading.get_ident()
+
+    loop_thread = asyncio.run(scenario())
+    assert loaded_on and loaded_on[0] != loop_thread
+    assert main.distro_backend.state == "ready"
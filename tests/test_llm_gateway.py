@@ -0,0 +1,153 @@
+"""LLM gateway against a local fake OpenAI-compatible HTTP server (the openai_server fixture), through the real SDK."""
+import asyncio
+import time
+
+import openai
+import pytest
+
+MESSAGES = [{"role": "user", "content": "how much juice is left"}]
+
+
+async def until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached in time"
+        await asyncio.sleep(0.005)
+
+
+def complete(gateway, llm):
+    return gateway.complete(llm, model="fake", messages=MESSAGES)
+
+
+def test_completes(main, gateway, openai_server):
+    async def scenario():
+        async with openai_server() as (fake, llm):
+            response = await complete(gateway, llm)
+            return response.choices[0].message.content, fake.requests
+
+    content, requests = asyncio.run(scenario())
+    assert content == '{"intent": "get_battery_status", "parameters": {}}'
+    assert requests == 1
+    assert gateway.limit.active == 0 and gateway.state == "closed"
+
+
+def test_retries_a_5xx(main, gateway, openai_server, monkeypatch):
+    monkeypatch.setattr(main, "LLM_RETRIES", 1)
+
+    async def scenario():
+        async with openai_server(error_status=503) as (fake, llm):
+            fake.fail_next = 1
+            response = await complete(gateway, llm)
+            return response.choices[0].message.content, fake.requests
+
+    content, requests = asyncio.run(scenario())
+    assert "get_battery_status" in content
+    assert requests == 2
+    assert gateway.failures == 0
+
+
+def test_does_not_retry_a_4xx(main, gateway, openai_server, monkeypatch):
+    monkeypatch.setattr(main, "LLM_RETRIES", 1)
+
+    async def scenario():
+        async with openai_server(error_status=400) as (fake, llm):
+            fake.fail_next = 1
+            with pytest.raises(openai.BadRequestError): await complete(gateway, llm)
+            return fake.requests
+
+    assert asyncio.run(scenario()) == 1
+
+
+def test_breaker_opens_then_half_opens(main, gateway, openai_server, monkeypatch):
+    monkeypatch.setattr(main, "LLM_RETRIES", 0)
+    monkeypatch.setattr(main, "LLM_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(main, "LLM_BREAKER_COOLDOWN", 0.2)
+
+    async def scenario():
+        async with openai_server() as (fake, llm):
+            fake.fail_next = 2
+            for _ in range(2):
+                with pytest.raises(openai.InternalServerError): await complete(gateway, llm)
+            assert gateway.state == "open" and not gateway.available()
+            with pytest.raises(main.LLMUnavailable): await complete(gateway, llm)
+            assert fake.requests == 2 # Refused without a request
+            await asyncio.sleep(0.25)
+            assert gateway.state == "half_open"
+            await complete(gateway, llm) # The trial call succeeds
+            assert gateway.state == "closed"
+
+    asyncio.run(scenario())
+
+
+def test_failed_half_open_trial_reopens_the_breaker(main, gateway, openai_server, monkeypatch):
+    monkeypatch.setattr(main, "LLM_RETRIES", 0)
+    monkeypatch.setattr(main, "LLM_BREAKER_FAILURES", 1)
+    monkeypatch.setattr(main, "LLM_BREAKER_COOLDOWN", 0.1)
+
+    async def scenario():
+        async with openai_server() as (fake, llm):
+            fake.fail_next = 2
+            with pytest.raises(openai.InternalServerError): await complete(gateway, llm)
+            await asyncio.sleep(0.15)
+            assert gateway.state == "half_open"
+            with pytest.raises(openai.InternalServerError): await complete(gateway, llm)
+            assert gateway.state == "open"
+
+    asyncio.run(scenario())
+
+
+def test_hedge_wins_over_a_slow_request(main, gateway, openai_server, monkeypatch):
+    monkeypatch.setattr(main, "LLM_HEDGE", True)
+    monkeypatch.setattr(main, "LLM_HEDGE_MIN_SECONDS", 0.05)
+    gateway.latencies.extend([0.01] * main.LLM_HEDGE_MIN_SAMPLES)
+    hedges_won = main.LLM_HEDGES_WON.values[()]
+
+    async def scenario():
+        async with openai_server() as (fake, llm):
+            fake.slow_next = 1 # Only the first request hangs
+            started = time.monotonic()
+            response = await asyncio.wait_for(complete(gateway, llm), 5)
+            return response, time.monotonic() - started, fake.requests
+
+    response, elapsed, requests = asyncio.run(scenario())
+    assert "get_battery_status" in response.choices[0].message.content
+    assert elapsed < 5 and requests == 2
+    assert main.LLM_HEDGES_WON.values[()] == hedges_won + 1
+    assert gateway.limit.active == 0 # The losing request was cancelled and gave its slot back
+
+
+def test_deadline_bounds_a_hung_request(main, gateway, openai_server, monkeypatch):
+    monkeypatch.setattr(main, "LLM_DEADLINE_SECONDS", 0.2)
+
+    async def scenario():
+        async with openai_server(latency=30) as (fake, llm):
+            started = time.monotonic()
+            with pytest.raises(asyncio.TimeoutError): await complete(gateway, llm)
+            return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 2
+    assert gateway.limit.active == 0 and gateway.failures == 1
+
+
+def test_cancelled_caller_releases_its_slot(main, gateway, openai_server):
+    async def scenario():
+        async with openai_server(latency=30) as (fake, llm):
+            call = asyncio.ensure_future(complete(gateway, llm))
+            await until(lambda: fake.requests == 1)
+            assert gateway.limit.active == 1
+            call.cancel()
+            await asyncio.gather(call, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert gateway.limit.active == 0
+
+
+def test_attempt_cancelled_before_it_starts_releases_its_slot(main, gateway):
+    async def scenario():
+        assert await gateway.limit.acquire()
+        attempt = gateway._start("first", lambda: asyncio.sleep(30))
+        attempt.cancel() # Before its first step
+        await asyncio.gather(attempt, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert gateway.limit.active == 0
@@ -0,0 +1,60 @@
+"""Local interpretation tiers (fast-path matcher, then the classifier): questions must never become writes."""
+import asyncio
+
+import pytest
+
+QUESTIONS = [
+    "check if the wifi is enabled",
+    "tell me if wifi is enabled",
+    "is the wifi up",
+    "check whether bluetooth is on",
+    "is bluetooth enabled?",
+    "wifi on?",
+    "is volume 50?",
+    "is the brightness 40",
+    "wifi status",
+]
+
+
+@pytest.mark.parametrize("command", QUESTIONS)
+def test_questions_are_not_writes(main, command):
+    interpretation = asyncio.run(main.interpret_locally(command))
+    assert interpretation is None or not interpretation["intent"].startswith(("set_", "toggle_"))
+    matched, _ = main.intent_matcher.match(command) # Also the fallback while the LLM is unavailable
+    assert matched is None or not matched["intent"].startswith(("set_", "toggle_"))
+
+
+@pytest.mark.parametrize("command, interpretation", [
+    ("check if the wifi is enabled", {"intent": "get_wifi_status", "parameters": {}}),
+    ("turn wifi on", {"intent": "toggle_wifi", "parameters": {"state": "on"}}),
+    ("please enable the wlan", {"intent": "toggle_wifi", "parameters": {"state": "on"}}),
+    ("switch the wireless off", {"intent": "toggle_wifi", "parameters": {"state": "off"}}),
+    ("bluetooth off", {"intent": "toggle_bluetooth", "parameters": {"state": "off"}}),
+    ("set volume to 40", {"intent": "set_volume", "parameters": {"level": 40}}),
+])
+def test_commands_resolve_locally(main, command, interpretation):
+    assert asyncio.run(main.interpret_locally(command)) == interpretation
+
+
+def test_enabled_and_up_only_switch_on_in_an_order(main):
+    assert main._classifier_parameters("toggle_wifi", "bring the wifi up") == {"state": "on"}
+    assert main._classifier_parameters("toggle_wifi", "can you set bluetooth enabled") == {"state": "on"}
+    assert main._classifier_parameters("toggle_wifi", "the wifi is up") is None
+    assert main._classifier_parameters("toggle_wifi", "wifi enabled") is None
+
+
+@pytest.mark.parametrize("command, interpretation", [
+    ("mute and unmute", {"intent": "set_volume", "parameters": {"level": 0}}),
+    ("cpu and memory usage", {"intent": "batch", "parameters": {"actions": [{"intent": "get_cpu_usage", "parameters": {}},
+                                                                            {"intent": "get_memory_usage", "parameters": {}}]}}),
+    ("brightness 30 and volume 20", {"intent": "batch", "parameters": {"actions": [{"intent": "set_brightness", "parameters": {"level": 30}},
+                                                                                   {"intent": "set_volume", "parameters": {"level": 20}}]}}),
+])
+def test_phrases_joined_by_and_resolve_locally(main, command, interpretation):
+    matched, confidence = main.intent_matcher.match(command)
+    assert matched == interpretation and confidence >= main.FAST_MATCH_THRESHOLD
+
+
+def test_compound_with_an_unmatched_part_is_left_to_the_llm(main):
+    matched, confidence = main.intent_matcher.match("brightness up a little and wifi off")
+    assert confidence < main.FAST_MATCH_THRESHOLD
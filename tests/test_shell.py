@@ -0,0 +1,95 @@
+"""Shell commands: the single result reply for plain-text clients, and streamed jobs for v2 requests."""
+import asyncio
+import os
+import signal
+
+import pytest
+
+SHELL = {"intent": "run_shell_command", "parameters": {"command": "echo hi"}}
+
+
+@pytest.fixture
+def shell(main, monkeypatch):
+    monkeypatch.setattr(main, "ALLOW_SHELL_EXECUTION", True)
+    monkeypatch.setattr(main, "SHELL_STREAMING", True)
+
+
+def test_plain_text_command_gets_one_result_reply(main, shell, session):
+    frame = asyncio.run(main.process_message(session, "run echo hi", interpretation=dict(SHELL)))
+    assert frame["response"]["stdout"] == "hi" and frame["response"]["success"]
+    assert session.websocket.frames == [] # No acknowledgement or unsolicited shell_output/shell_exit frames
+
+
+def run_request(main, session, **request):
+    async def scenario():
+        await session.inflight.acquire()
+        await main.process_request(session, 1, "run echo hi", **request)
+        await asyncio.gather(*session.shell_tasks)
+    asyncio.run(scenario())
+    return session.websocket.frames
+
+
+def test_v2_request_streams(main, shell, session):
+    frames = run_request(main, session, intent="run_shell_command", parameters={"command": "echo hi"})
+    assert frames[0]["id"] == 1 and frames[0]["response"]["status"] == "running"
+    assert [frame.get("type") for frame in frames[1:]] == ["shell_output", "shell_exit"]
+    assert frames[2]["response"]["stdout"] == "hi"
+
+
+def test_v2_request_can_opt_out_of_streaming(main, shell, session):
+    frames = run_request(main, session, intent="run_shell_command", parameters={"command": "echo hi"}, stream=False)
+    assert len(frames) == 1 and frames[0]["response"]["stdout"] == "hi"
+
+
+IGNORES_SIGTERM = "trap '' TERM; echo started; sleep 30"
+posix_only = pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs process groups and /proc")
+
+
+def run_job(main, command, cancel_after=None):
+    """Runs a ShellJob to its result; returns (result, seconds taken, process)."""
+    async def scenario():
+        job = main.ShellJob("job", command, discard)
+        started = asyncio.get_running_loop().time()
+        if cancel_after is not None: asyncio.get_running_loop().call_later(cancel_after, job.cancel)
+        result = await job.run()
+        return result, asyncio.get_running_loop().time() - started, job._process
+    return asyncio.run(scenario())
+
+
+async def discard(frame): pass
+
+
+def live_processes_in_group(pgid):
+    """States of the group's processes that are not zombies (an orphan is reaped by init, whenever it gets to it)."""
+    states = []
+    for entry in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{entry}/stat") as f: fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError): continue
+        if int(fields[2]) == pgid and fields[0] != "Z": states.append(fields[0])
+    return states
+
+
+def assert_group_gone(process):
+    assert process.returncode is not None # Reaped
+    assert live_processes_in_group(process.pid) == [] # "sleep" ignored SIGTERM too
+
+
+@posix_only
+def test_timed_out_command_is_killed_after_the_grace_period(main, monkeypatch):
+    monkeypatch.setattr(main, "SHELL_STREAM_TIMEOUT", 0.3)
+    monkeypatch.setattr(main, "SHELL_KILL_GRACE_SECONDS", 0.3)
+    result, elapsed, process = run_job(main, IGNORES_SIGTERM)
+    assert result["exit_code"] == -signal.SIGKILL and not result["success"]
+    assert result["error_message"] == "Command timed out after 0.3 seconds."
+    assert elapsed < 5
+    assert_group_gone(process)
+
+
+@posix_only
+def test_cancelled_command_is_killed_after_the_grace_period(main, monkeypatch):
+    monkeypatch.setattr(main, "SHELL_KILL_GRACE_SECONDS", 0.3)
+    result, elapsed, process = run_job(main, IGNORES_SIGTERM, cancel_after=0.2)
+    assert result["cancelled"] and result["exit_code"] == -signal.SIGKILL
+    assert elapsed < 5
+    assert_group_gone(process)
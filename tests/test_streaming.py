@@ -0,0 +1,182 @@
+"""Streamed interpretation: the incremental parser, early dispatch against a fake OpenAI server, and settle()."""
+import asyncio
+import contextlib
+import json
+import time
+
+import pytest
+
+HANDLER_SECONDS = {"set_brightness": 0.12, "set_volume": 0.03, "toggle_bluetooth": 0.25, "toggle_wifi": 0.2}
+
+
+def feed_by_char(main, text):
+    """Feeds `text` one character at a time; returns (characters fed, partial, settled) for each report."""
+    partials = []
+    stream = main.InterpretationStream(lambda partial, settled: partials.append((len(stream.text), partial, settled)))
+    for char in text: stream.feed(char)
+    return partials
+
+
+@pytest.fixture
+def started(main, monkeypatch):
+    """Replaces the scene's handlers with slow fakes; maps each intent to the times its handler started."""
+    started = {}
+
+    def fake(intent, latency):
+        async def handler(**parameters):
+            started.setdefault(intent, []).append(time.perf_counter())
+            await asyncio.sleep(latency)
+            return f"{intent} done"
+        return handler
+    for intent, latency in HANDLER_SECONDS.items():
+        monkeypatch.setitem(main.INTENT_HANDLERS, intent, fake(intent, latency))
+        monkeypatch.setitem(main.INTENT_EXECUTION, intent, ("async", 1))
+    return started
+
+
+@pytest.fixture
+def streaming(main, monkeypatch, cache, gateway, started, openai_server):
+    """LLM_STREAMING on; returns an async context manager serving a FakeOpenAIServer as the module's client."""
+    monkeypatch.setattr(main, "LLM_STREAMING", True)
+    monkeypatch.setattr(main, "openai_available", True)
+    interpreted = []
+    interpret = main.interpret_command_with_llm
+    async def timed(*args, **kwargs):
+        try: return await interpret(*args, **kwargs)
+        finally: interpreted.append(time.perf_counter())
+    monkeypatch.setattr(main, "interpret_command_with_llm", timed)
+
+    @contextlib.asynccontextmanager
+    async def serving(**knobs):
+        async with openai_server(**{"token_latency": 0.02, **knobs}) as (fake, llm):
+            monkeypatch.setattr(main, "client", llm)
+            yield fake, interpreted
+    return serving
+
+
+def test_parser_settles_a_single_intent_before_the_object_closes(main):
+    text = json.dumps({"intent": "set_volume", "parameters": {"level": 70}})
+    partials = feed_by_char(main, text)
+    settled = [(at, partial) for at, partial, is_settled in partials if is_settled]
+    assert settled[-1][1] == {"intent": "set_volume", "parameters": {"level": 70}}
+    assert settled[-1][0] < len(text) # Known complete at the closing brace of "parameters"
+    assert [partial for _, partial in settled] == [{"intent": "set_volume"}, {"intent": "set_volume", "parameters": {"level": 70}}]
+
+
+def test_parser_reports_each_batch_action_as_it_closes(main, scene):
+    text = json.dumps({"intent": "batch", "parameters": {"actions": scene}})
+    actions = [partial["parameters"]["actions"] for _, partial, settled in feed_by_char(main, text) if not settled]
+    assert actions == [scene[:n] for n in range(1, len(scene) + 1)]
+
+
+def test_parser_ignores_structure_inside_strings(main):
+    interpretation = {"intent": "run_shell_command", "parameters": {"command": 'echo "}, {[" \\" ,'}}
+    partials = feed_by_char(main, json.dumps(interpretation))
+    assert [partial for _, partial, settled in partials if settled][-1] == interpretation
+    assert all(settled for _, _, settled in partials)
+
+
+def test_single_intent_starts_before_the_interpretation_ends(main, streaming, started, session):
+    async def scenario():
+        async with streaming() as (fake, interpreted):
+            reply = await main.process_message(session, "make it loud (streamed)")
+            return reply, interpreted[-1], fake.requests
+
+    reply, interpreted, requests = asyncio.run(scenario())
+    assert reply == {"response": "set_volume done"}
+    assert len(started["set_volume"]) == 1 and started["set_volume"][0] < interpreted
+    assert requests == 1
+
+
+def test_batch_actions_start_before_the_interpretation_ends(main, streaming, started, session, scene):
+    async def scenario():
+        async with streaming() as (fake, interpreted):
+            reply = await main.process_message(session, "movie mode (streamed)")
+            return reply["response"], interpreted[-1]
+
+    result, interpreted = asyncio.run(scenario())
+    assert result["ok"] == len(scene) and result["failed"] == 0
+    assert all(len(times) == 1 for times in started.values()) # Adopted by execute_batch, not run again
+    first_action = min(times[0] for times in started.values())
+    assert first_action < interpreted
+
+
+def test_stream_failing_before_its_first_token_is_retried(main, streaming, started, session, monkeypatch):
+    monkeypatch.setattr(main, "LLM_RETRIES", 1)
+
+    async def scenario():
+        async with streaming(error_status=503) as (fake, interpreted):
+            fake.fail_next = 1
+            reply = await main.process_message(session, "make it loud (retried)")
+            return reply, fake.requests
+
+    reply, requests = asyncio.run(scenario())
+    assert reply == {"response": "set_volume done"}
+    assert requests == 2
+
+
+def test_progress_frame_comes_before_the_reply(main, streaming, session):
+    async def scenario():
+        async with streaming():
+            await session.inflight.acquire()
+            await main.process_request(session, 7, "make it loud (progress)")
+
+    asyncio.run(scenario())
+    frames = session.websocket.frames
+    assert [frame.get("type") for frame in frames] == ["progress", None]
+    assert frames[0]["stage"] == "interpreting" and frames[1] == {"id": 7, "response": "set_volume done"}
+
+
+def settle_after(main, session, partials, final):
+    """Feeds partial interpretations to an EarlyDispatch, then settles it with `final`."""
+    async def scenario():
+        early = main.EarlyDispatch(session)
+        for partial, settled in partials: early(partial, settled)
+        dispatched = list(early.tasks)
+        await asyncio.sleep(0) # Let them start
+        assert early.settle(final) is final
+        kept = list(early.tasks)
+        await asyncio.gather(*dispatched, return_exceptions=True)
+        return dispatched, kept
+    return asyncio.run(scenario())
+
+
+def test_settle_cancels_a_changed_single_intent(main, started, session):
+    cancelled = main.EARLY_DISPATCHES.values[("cancelled",)]
+    dispatched, kept = settle_after(main, session, [({"intent": "set_volume", "parameters": {"level": 70}}, True)],
+                                    {"intent": "set_volume", "parameters": {"level": 40}})
+    assert len(dispatched) == 1 and kept == []
+    assert dispatched[0].cancelled()
+    assert main.EARLY_DISPATCHES.values[("cancelled",)] == cancelled + 1
+
+
+def test_settle_keeps_an_unchanged_single_intent(main, started, session):
+    interpretation = {"intent": "set_volume", "parameters": {"level": 70}}
+    dispatched, kept = settle_after(main, session, [(interpretation, True)], dict(interpretation))
+    assert kept == dispatched and not dispatched[0].cancelled()
+
+
+def test_settle_keeps_the_confirmed_prefix_of_a_batch(main, started, session, scene):
+    cancelled = main.EARLY_DISPATCHES.values[("cancelled",)]
+    streamed = {"intent": "batch", "parameters": {"actions": scene[:3]}}
+    revised = scene[:1] + [{"intent": "set_volume", "parameters": {"level": 50}}] + scene[2:]
+    dispatched, kept = settle_after(main, session, [(streamed, False)], {"intent": "batch", "parameters": {"actions": revised}})
+    assert len(dispatched) == 3 and kept == dispatched[:1]
+    assert [task.cancelled() for task in dispatched] == [False, True, True]
+    assert main.EARLY_DISPATCHES.values[("cancelled",)] == cancelled + 2
+
+
+def test_cancelled_setter_waiting_in_its_queue_is_never_written(main, started, session, monkeypatch):
+    queue = main.SetterQueue("volume", 5) # One write per 200 ms
+    monkeypatch.setitem(main.setter_queues, "set_volume", queue)
+
+    async def scenario():
+        await main.run_intent("set_volume", {"level": 10}) # The next write has to wait its turn
+        early = main.EarlyDispatch(session)
+        early({"intent": "set_volume", "parameters": {"level": 70}}, True)
+        await asyncio.sleep(0) # Queued behind the rate limit
+        early.settle({"intent": "set_volume", "parameters": {"level": 40}})
+        await asyncio.sleep(0.3) # Past the time it would have been written
+
+    asyncio.run(scenario())
+    assert len(started["set_volume"]) == 1 and queue.applied == 1